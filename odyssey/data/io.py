@@ -0,0 +1,140 @@
+"""Read and write the intermediate data files of the data pipeline."""
+
+import os
+from ast import literal_eval
+from typing import Any, Iterator, List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def parse_literal(value: Any) -> Any:
+    """Parse a list or dict column value read from a csv or parquet file.
+
+    Values read from csv files are Python repr strings, while values read from
+    parquet files with ``read_parquet`` are already Python objects.
+
+    Parameters
+    ----------
+    value : Any
+        The value to parse.
+
+    Returns
+    -------
+    Any
+        The parsed value.
+
+    """
+    return literal_eval(value) if isinstance(value, str) else value
+
+
+def to_dataframe(data: Union[pa.Table, pa.RecordBatch]) -> pd.DataFrame:
+    """Convert Arrow data to a DataFrame of native Python lists and dicts.
+
+    Parameters
+    ----------
+    data : Union[pa.Table, pa.RecordBatch]
+        The Arrow data.
+
+    Returns
+    -------
+    pd.DataFrame
+        The DataFrame, with list columns as lists and map columns as dicts.
+
+    """
+    dataframe = pd.DataFrame(
+        {name: data.column(name).to_pylist() for name in data.schema.names},
+        columns=data.schema.names,
+    )
+    for field in data.schema:
+        if pa.types.is_map(field.type):
+            dataframe[field.name] = dataframe[field.name].map(
+                lambda value: dict(value) if value is not None else {},
+            )
+    return dataframe
+
+
+def parquet_files(path: str) -> List[str]:
+    """Get the files of a parquet file or of a directory of parquet files.
+
+    Parameters
+    ----------
+    path : str
+        The path of a parquet file, or of a directory of parquet part files
+        that are read in the order of their names.
+
+    Returns
+    -------
+    List[str]
+        The paths of the parquet files.
+
+    """
+    if not os.path.isdir(path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return [path]
+    return [
+        os.path.join(path, name)
+        for name in sorted(os.listdir(path))
+        if name.endswith(".parquet")
+    ]
+
+
+def read_parquet(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read a parquet file into a DataFrame of native Python lists and dicts.
+
+    Parameters
+    ----------
+    path : str
+        The path of the parquet file, or of a directory of parquet part files.
+    columns : Optional[List[str]], optional
+        The columns to read, by default None which reads all the columns
+
+    Returns
+    -------
+    pd.DataFrame
+        The data of the file.
+
+    """
+    tables = [pq.read_table(file, columns=columns) for file in parquet_files(path)]
+    if not tables:
+        raise FileNotFoundError(f"No parquet files in {path}.")
+    return to_dataframe(pa.concat_tables(tables))
+
+
+def iter_parquet(path: str, chunksize: Optional[int] = None) -> Iterator[pd.DataFrame]:
+    """Read a parquet file in chunks of rows.
+
+    Chunks have ``chunksize`` rows, except the last one, across the row groups
+    and the part files of a directory.
+
+    Parameters
+    ----------
+    path : str
+        The path of the parquet file, or of a directory of parquet part files.
+    chunksize : Optional[int], optional
+        The number of rows per chunk, by default None which reads the whole
+        file as one chunk
+
+    Yields
+    ------
+    pd.DataFrame
+        The chunks of the file.
+
+    """
+    if chunksize is None:
+        yield read_parquet(path)
+        return
+    pending: Optional[pa.Table] = None
+    for file in parquet_files(path):
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=chunksize):
+            table = pa.Table.from_batches([batch])
+            if pending is not None:
+                table = pa.concat_tables([pending, table])
+            while table.num_rows >= chunksize:
+                yield to_dataframe(table.slice(0, chunksize))
+                table = table.slice(chunksize)
+            pending = table
+    if pending is not None and pending.num_rows > 0:
+        yield to_dataframe(pending)
@@ -0,0 +1,234 @@
+"""Durable progress manifest of the extraction stages of FHIRDataCollector."""
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Set
+
+import pandas as pd
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _to_json(value: Any) -> Any:
+    """Convert the state of a stage to JSON types, with sets as sorted lists."""
+    if isinstance(value, set):
+        return sorted(value)
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    return value
+
+
+def _truncate(path: str, size: int) -> None:
+    """Truncate a file to a size, creating it if it does not exist."""
+    with open(path, "ab") as f:
+        f.truncate(size)
+
+
+def fsync(path: str) -> None:
+    """Flush a file written by another library to disk.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file.
+
+    """
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+class ExtractionManifest:
+    """Progress of the extraction stages, saved in a directory.
+
+    The manifest is a JSON file holding, for each stage, whether it is done,
+    the offset of its output after the last committed buffer and the state it
+    accumulated, such as vocabularies. It is replaced atomically, so a crash
+    leaves the previous version. The IDs of the patients committed by each
+    stage are appended to a log file next to it, whose committed size is kept
+    in the manifest. Stages running in different threads can commit to the
+    same manifest.
+
+    Parameters
+    ----------
+    manifest_dir : str
+        The directory of the manifest.
+
+    """
+
+    def __init__(self, manifest_dir: str) -> None:
+        self.manifest_dir = manifest_dir
+        self.path = os.path.join(manifest_dir, "manifest.json")
+        os.makedirs(manifest_dir, exist_ok=True)
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.stages = json.load(f)
+
+    def save(self) -> None:
+        """Save the manifest atomically."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.stages, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def checkpoint(
+        self,
+        stage: str,
+        output_format: str,
+        data_offset: int,
+        resume: bool = True,
+    ) -> "StageCheckpoint":
+        """Start or resume a stage.
+
+        A stage is started again if its output was saved in another format, or
+        is shorter than at its last commit, e.g. because it was removed, as the
+        committed patients are then missing from it.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage.
+        output_format : str
+            The format of the stage output.
+        data_offset : int
+            The current offset of the stage output.
+        resume : bool, optional
+            Whether to resume from the last commit of the stage, by default
+            True. Otherwise the progress of the stage is discarded.
+
+        Returns
+        -------
+        StageCheckpoint
+            The checkpoint of the stage.
+
+        """
+        with self.lock:
+            entry = self.stages.get(stage)
+            if resume and entry is not None:
+                if entry.get("output_format") != output_format:
+                    LOGGER.warning(
+                        f"Restarting {stage} data, its progress was saved in "
+                        f"{entry.get('output_format')} format.",
+                    )
+                    entry = None
+                elif data_offset < entry["data_offset"]:
+                    LOGGER.warning(
+                        f"Restarting {stage} data, its output is missing or "
+                        f"shorter than at its last commit.",
+                    )
+                    entry = None
+            if not resume or entry is None:
+                self.stages[stage] = {
+                    "output_format": output_format,
+                    "done": False,
+                    "data_offset": 0,
+                    "ids_offset": 0,
+                    "state": {},
+                }
+                self.save()
+        return StageCheckpoint(self, stage)
+
+
+class StageCheckpoint:
+    """Commit the progress of one extraction stage.
+
+    Parameters
+    ----------
+    manifest : ExtractionManifest
+        The manifest of the extraction.
+    stage : str
+        The name of the stage.
+
+    """
+
+    def __init__(self, manifest: ExtractionManifest, stage: str) -> None:
+        self.manifest = manifest
+        self.entry = manifest.stages[stage]
+        self.ids_path = os.path.join(manifest.manifest_dir, f"{stage}.ids")
+        # Drop the IDs logged after the last commit.
+        _truncate(self.ids_path, self.entry["ids_offset"])
+        with open(self.ids_path, "r") as f:
+            self.completed: Set[str] = set(f.read().splitlines())
+        self.state: Dict[str, Any] = self.entry["state"]
+        self._tracked: Dict[str, Any] = {}
+        self._pending: List[str] = []
+
+    @property
+    def data_offset(self) -> int:
+        """Get the offset of the stage output after the last commit."""
+        return self.entry["data_offset"]
+
+    def pending(self, patient_ids: pd.Series) -> pd.Series:
+        """Get the patients that the stage has not committed yet.
+
+        Parameters
+        ----------
+        patient_ids : pd.Series
+            The patient IDs of the stage.
+
+        Returns
+        -------
+        pd.Series
+            The patient IDs that are not committed, in the same order.
+
+        """
+        return patient_ids[~patient_ids.astype(str).isin(self.completed)]
+
+    def track(self, **state: Any) -> None:
+        """Track objects of the stage state that are saved at every commit.
+
+        Parameters
+        ----------
+        **state : Any
+            The objects, updated in place by the stage.
+
+        """
+        self._tracked.update(state)
+
+    def add(self, patient_id: str) -> None:
+        """Add a processed patient, committed with the next buffer.
+
+        Parameters
+        ----------
+        patient_id : str
+            The ID of the patient.
+
+        """
+        self._pending.append(str(patient_id))
+
+    def commit(self, data_offset: int, done: bool = False) -> None:
+        """Commit the processed patients once their data is written.
+
+        Parameters
+        ----------
+        data_offset : int
+            The offset of the stage output after the written data.
+        done : bool, optional
+            Whether the stage is done, by default False
+
+        """
+        with open(self.ids_path, "a") as f:
+            f.writelines(f"{patient_id}\n" for patient_id in self._pending)
+            f.flush()
+            os.fsync(f.fileno())
+        self.completed.update(self._pending)
+        self._pending = []
+        self.state = _to_json({**self.state, **self._tracked})
+        with self.manifest.lock:
+            self.entry.update(
+                {
+                    "done": done,
+                    "data_offset": data_offset,
+                    "ids_offset": os.path.getsize(self.ids_path),
+                    "state": self.state,
+                },
+            )
+            self.manifest.save()
@@ -0,0 +1,209 @@
+"""Quantile bins of lab values, exact or from mergeable sketches."""
+
+import math
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# Count, smallest and largest absolute value of the values in a bucket.
+Bucket = Tuple[int, float, float]
+
+
+def quantile_bin_edges(values: Iterable[float], num_bins: int) -> np.ndarray:
+    """Get the right edges of the quantile bins of some values.
+
+    The edges are those of ``pd.qcut`` with duplicate edges dropped.
+
+    Parameters
+    ----------
+    values : Iterable[float]
+        The values to bin.
+    num_bins : int
+        The number of quantile bins.
+
+    Returns
+    -------
+    np.ndarray
+        The sorted right edges of the bins.
+
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.asarray(
+        pd.qcut(values, q=num_bins, duplicates="drop").categories.right,
+    )
+
+
+def assign_bins(values: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """Assign values to bins, like ``np.digitize(values, edges, right=False)``.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The values to assign.
+    edges : np.ndarray
+        The sorted right edges of the bins.
+
+    Returns
+    -------
+    np.ndarray
+        The bin index of each value.
+
+    """
+    return np.searchsorted(edges, values, side="right")
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch with a relative accuracy guarantee.
+
+    Values are counted in logarithmic buckets, so that the memory used depends
+    on the range of the values rather than on their number, as in DDSketch.
+    Each bucket also keeps the smallest and largest value it counted, so that
+    buckets of a single distinct value, common for lab values recorded with a
+    fixed precision, give exact quantiles. Sketches of disjoint chunks of data
+    can be merged.
+
+    Quantiles interpolate linearly between the values at the neighbouring
+    ranks, as ``np.quantile`` does, and each of these values is within
+    ``relative_accuracy`` of the exact one.
+
+    Parameters
+    ----------
+    relative_accuracy : float, optional
+        The relative accuracy of the quantiles, by default 0.01
+    min_value : float, optional
+        The smallest absolute value distinguished from zero, by default 1e-9
+
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 1e-9):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("The relative accuracy should be between 0 and 1.")
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive: Dict[int, Bucket] = {}
+        self.negative: Dict[int, Bucket] = {}
+        self.zero_count = 0
+        self.count = 0
+
+    @staticmethod
+    def _add_bucket(store: Dict[int, Bucket], index: int, bucket: Bucket) -> None:
+        """Add the values of a bucket to the same bucket of a store."""
+        if index in store:
+            count, low, high = store[index]
+            bucket = (count + bucket[0], min(low, bucket[1]), max(high, bucket[2]))
+        store[index] = bucket
+
+    def _add_to_store(self, store: Dict[int, Bucket], values: np.ndarray) -> None:
+        """Count the absolute values in the buckets of a store."""
+        if len(values) == 0:
+            return
+        indices = np.ceil(np.log(values) / self._log_gamma).astype(np.int64)
+        order = np.argsort(indices, kind="stable")
+        indices, values = indices[order], values[order]
+        unique, starts, counts = np.unique(
+            indices,
+            return_index=True,
+            return_counts=True,
+        )
+        lows = np.minimum.reduceat(values, starts)
+        highs = np.maximum.reduceat(values, starts)
+        for index, count, low, high in zip(unique, counts, lows, highs):
+            self._add_bucket(store, int(index), (int(count), float(low), float(high)))
+
+    def update(self, values: Iterable[float]) -> None:
+        """Add values to the sketch, ignoring missing values.
+
+        Parameters
+        ----------
+        values : Iterable[float]
+            The values to add.
+
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        self._add_to_store(self.positive, values[values > self.min_value])
+        self._add_to_store(self.negative, -values[values < -self.min_value])
+        self.zero_count += int(np.count_nonzero(np.abs(values) <= self.min_value))
+        self.count += len(values)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Merge another sketch with the same accuracy into this sketch.
+
+        Parameters
+        ----------
+        other : QuantileSketch
+            The sketch to merge.
+
+        """
+        if other.gamma != self.gamma or other.min_value != self.min_value:
+            raise ValueError("Only sketches with the same parameters can be merged.")
+        for index, bucket in other.positive.items():
+            self._add_bucket(self.positive, index, bucket)
+        for index, bucket in other.negative.items():
+            self._add_bucket(self.negative, index, bucket)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def _buckets(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Get the count, lowest and highest value of every bucket, in order."""
+        buckets = [
+            (count, -high, -low)
+            for _, (count, low, high) in sorted(self.negative.items(), reverse=True)
+        ]
+        if self.zero_count:
+            buckets.append((self.zero_count, 0.0, 0.0))
+        buckets.extend(bucket for _, bucket in sorted(self.positive.items()))
+        counts, lows, highs = zip(*buckets)
+        return np.asarray(counts), np.asarray(lows), np.asarray(highs)
+
+    def _values_at(self, ranks: np.ndarray) -> np.ndarray:
+        """Estimate the values at some ranks, spread evenly within buckets."""
+        counts, lows, highs = self._buckets()
+        ends = np.cumsum(counts)
+        buckets = np.searchsorted(ends, ranks, side="right")
+        positions = ranks - (ends[buckets] - counts[buckets])
+        spreads = np.maximum(counts[buckets] - 1, 1)
+        return lows[buckets] + (highs[buckets] - lows[buckets]) * positions / spreads
+
+    def quantiles(self, levels: Iterable[float]) -> np.ndarray:
+        """Estimate quantiles of the values added to the sketch.
+
+        Parameters
+        ----------
+        levels : Iterable[float]
+            The levels of the quantiles, between 0 and 1.
+
+        Returns
+        -------
+        np.ndarray
+            The quantiles. The lowest and highest levels give the exact minimum
+            and maximum.
+
+        """
+        levels = np.asarray(levels, dtype=np.float64)
+        if self.count == 0:
+            return np.full(len(levels), np.nan)
+        ranks = levels * (self.count - 1)
+        lower = self._values_at(np.floor(ranks))
+        upper = self._values_at(np.ceil(ranks))
+        return lower + (upper - lower) * (ranks - np.floor(ranks))
+
+    def bin_edges(self, num_bins: int) -> np.ndarray:
+        """Get the right edges of the quantile bins of the values.
+
+        Parameters
+        ----------
+        num_bins : int
+            The number of quantile bins.
+
+        Returns
+        -------
+        np.ndarray
+            The sorted right edges of the bins, with duplicate edges dropped.
+
+        """
+        return np.unique(self.quantiles(np.linspace(0, 1, num_bins + 1)))[1:]
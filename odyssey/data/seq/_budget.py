@@ -0,0 +1,165 @@
+"""Size the chunks of patients to a memory budget."""
+
+from typing import Any, Callable, Iterable, Iterator, List
+
+import numpy as np
+import pandas as pd
+
+
+# Initial estimate of the memory of an event, refined by the observed rounds.
+DEFAULT_BYTES_PER_EVENT = 1024
+
+
+def count_items(values: Iterable[Any]) -> np.ndarray:
+    """Count the items of a column of lists, or of their string literals.
+
+    String literals are counted by their separators, without parsing them.
+
+    Parameters
+    ----------
+    values : Iterable[Any]
+        The lists, as lists, arrays or strings such as ``"['a', 'b']"``.
+
+    Returns
+    -------
+    np.ndarray
+        The number of items of each list.
+
+    """
+    counts = []
+    for value in values:
+        if isinstance(value, str):
+            counts.append(value.count(",") + 1 if value.strip("[] ") else 0)
+        elif value is None or isinstance(value, float):  # Missing lists.
+            counts.append(0)
+        else:
+            counts.append(len(value))
+    return np.array(counts, dtype=np.int64)
+
+
+def memory_usage(frames: Iterable[pd.DataFrame]) -> int:
+    """Get the memory of some dataframes, with their Python objects, in bytes."""
+    return int(sum(frame.memory_usage(deep=True).sum() for frame in frames))
+
+
+class ChunkBudget:
+    """Split blocks of patients into chunks of an estimated memory.
+
+    The memory of a patient is estimated from their number of events, with
+    the bytes per event observed in the previous rounds. Each chunk takes the
+    next patients until their estimated memory reaches the budget, and has at
+    least one patient.
+
+    Parameters
+    ----------
+    memory_budget : int
+        Target memory of a chunk, in bytes
+    bytes_per_event : float, optional
+        Initial estimate of the bytes per event, by default 1024
+
+    """
+
+    def __init__(
+        self,
+        memory_budget: int,
+        bytes_per_event: float = DEFAULT_BYTES_PER_EVENT,
+    ):
+        """Initialize the chunk budget."""
+        if memory_budget <= 0:
+            raise ValueError(f"Memory budget should be positive, got {memory_budget}.")
+        self.memory_budget = memory_budget
+        self.bytes_per_event = bytes_per_event
+        self.observed_events = 0
+        self.observed_bytes = 0
+
+    def observe(self, num_events: int, num_bytes: int) -> float:
+        """Refine the bytes per event with the memory of a round.
+
+        The estimate is the ratio of the bytes and events of all the observed
+        rounds, so it converges as rounds are processed.
+
+        Parameters
+        ----------
+        num_events : int
+            The events of the round
+        num_bytes : int
+            The memory of the round, in bytes
+
+        Returns
+        -------
+        float
+            The bytes per event of the round.
+
+        """
+        self.observed_events += num_events
+        self.observed_bytes += num_bytes
+        if self.observed_events > 0:
+            self.bytes_per_event = self.observed_bytes / self.observed_events
+        return num_bytes / max(num_events, 1)
+
+    def split(self, num_events: np.ndarray) -> List[int]:
+        """Get the end of each chunk of some patients.
+
+        Parameters
+        ----------
+        num_events : np.ndarray
+            The number of events of each patient
+
+        Returns
+        -------
+        List[int]
+            The end of each chunk, the last one being the number of patients.
+
+        """
+        # Patients without events still take some memory.
+        costs = np.cumsum((num_events + 1) * self.bytes_per_event)
+        ends = []
+        start = 0
+        while start < len(costs):
+            used = costs[start - 1] if start > 0 else 0
+            end = int(np.searchsorted(costs, used + self.memory_budget, side="right"))
+            start = max(end, start + 1)
+            ends.append(start)
+        return ends
+
+    def chunks(
+        self,
+        blocks: Iterable[List[pd.DataFrame]],
+        count_events: Callable[[List[pd.DataFrame]], np.ndarray],
+    ) -> Iterator[List[pd.DataFrame]]:
+        """Split blocks of patients into chunks, across the blocks.
+
+        The patients of a block that do not fill a chunk are carried over to
+        the next block, and the estimate is read when each block is split, so
+        it follows the rounds observed meanwhile.
+
+        Parameters
+        ----------
+        blocks : Iterable[List[pd.DataFrame]]
+            The rows of the data files for blocks of patients, aligned by
+            patient
+        count_events : Callable[[List[pd.DataFrame]], np.ndarray]
+            Function counting the events of each patient of a block
+
+        Yields
+        ------
+        List[pd.DataFrame]
+            The rows of the data files for each chunk of patients.
+
+        """
+        pending: List[pd.DataFrame] = []
+        for next_block in blocks:
+            block = next_block
+            if pending:
+                block = [
+                    pd.concat([rest, frame], ignore_index=True)
+                    for rest, frame in zip(pending, next_block)
+                ]
+            ends = self.split(count_events(block))
+            start = 0
+            for end in ends[:-1]:
+                yield [frame.iloc[start:end].reset_index(drop=True) for frame in block]
+                start = end
+            pending = [frame.iloc[start:].reset_index(drop=True) for frame in block]
+        if pending and len(pending[0]) > 0:
+            yield pending
@@ -0,0 +1,631 @@
+"""Columnar engine for patient sequence generation.
+
+The engine explodes the per-patient lists of a chunk into flat tables of
+encounters and events, computes the sequences with vectorized sorts, joins
+and group-wise operations, and nests the tokens back into one row per
+patient. It produces the same sequences as the row-wise processors.
+"""
+
+import logging
+import re
+from datetime import datetime
+from itertools import chain
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from odyssey.data.constants import (
+    CLASS,
+    LAB,
+    MED,
+    PROC,
+    REGISTER,
+    TIME_DELTA,
+    VISIT_END,
+    VISIT_START,
+)
+from odyssey.data.io import parse_literal
+from odyssey.data.seq._conditions import ConditionIndex
+from odyssey.data.seq._data_containers import PatientData
+from odyssey.data.seq._pipeline import ChunkBatch, Stage
+from odyssey.data.seq._tokens import TokenConfig, truncate_or_pad
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Times are in microseconds, which unlike nanoseconds cover any year.
+DAY = 24 * 3600 * 10**6
+# Time of an ISO datetime and its UTC offset, dropped to get its local time.
+UTC_OFFSET = re.compile(
+    r"([T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)(?:Z|[+-]\d{2}:?\d{2})$"
+)
+OFFSET_PARTS = r"[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?([+-])(\d{2}):?(\d{2})$"
+WEEK_TOKENS = np.array([f"[W_{i}]" for i in range(4)], dtype=object)
+MONTH_TOKENS = np.array([f"[M_{i}]" for i in range(13)], dtype=object)
+
+
+def _explode(column: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """Explode a column of lists into the row of each item and the items."""
+    values = [parse_literal(value) for value in column]
+    lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+    rows = np.repeat(np.arange(len(values)), lengths)
+    items = np.empty(int(lengths.sum()), dtype=object)
+    items[:] = list(chain.from_iterable(values))
+    return rows, items
+
+
+def _group_starts(rows: np.ndarray) -> np.ndarray:
+    """Flag the first item of each group of a sorted array of rows."""
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = rows[1:] != rows[:-1]
+    return first
+
+
+def _dates(dates: Any) -> np.ndarray:
+    """Parse dates to microseconds since the epoch, with missing dates as NaT."""
+    return pd.Series(dates, dtype=object).astype("datetime64[us]").to_numpy()
+
+
+def _parse_times(dates: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Parse ISO datetimes to microseconds since the epoch.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The UTC times, and the local times that ignore the UTC offsets.
+
+    """
+    dates = pd.Series(dates, dtype=object)
+    local = _dates(dates.str.replace(UTC_OFFSET, r"\1", regex=True)).astype(np.int64)
+    offsets = dates.str.extract(OFFSET_PARTS)
+    minutes = offsets[1].astype(float) * 60 + offsets[2].astype(float)
+    minutes = np.where(offsets[0] == "-", -minutes, minutes)
+    utc = local - np.nan_to_num(minutes).astype(np.int64) * 60 * 10**6
+    return utc, local
+
+
+def _interval_tokens(days: np.ndarray) -> np.ndarray:
+    """Get the time delta tokens of gaps between encounters, in days."""
+    days = np.maximum(days, 0)
+    return np.where(
+        days < 28,
+        WEEK_TOKENS[np.minimum(days // 7, 3)],
+        np.where(days <= 365, MONTH_TOKENS[np.minimum(days // 30, 12)], "[LT]"),
+    )
+
+
+class ColumnarEngine:
+    """Create the patient sequences of a chunk with vectorized operations.
+
+    Parameters
+    ----------
+    token_config : TokenConfig
+        Token configuration
+    max_seq_lengths : List[int]
+        Maximum sequence lengths, each with its truncated token columns
+    reference_time : datetime
+        Reference time of the encounter time tokens
+    condition_index : ConditionIndex
+        Index of the common and rare condition groups
+
+    """
+
+    def __init__(
+        self,
+        token_config: TokenConfig,
+        max_seq_lengths: List[int],
+        reference_time: datetime,
+        condition_index: ConditionIndex,
+    ):
+        """Initialize the columnar engine."""
+        self.token_config = token_config
+        self.max_seq_lengths = max_seq_lengths
+        self.reference_time = np.datetime64(reference_time, "us").astype(np.int64)
+        self.condition_index = condition_index
+        self.type_ids = token_config.token_type_mapping
+
+    def _encounters(self, patient_data: PatientData) -> pd.DataFrame:
+        """Explode the encounters of the patients, one row per encounter."""
+        rows, encounter_ids = _explode(patient_data.encounters["encounter_ids"])
+        _, starts = _explode(patient_data.encounters["starts"])
+        _, ends = _explode(patient_data.encounters["ends"])
+        return pd.DataFrame(
+            {"row": rows, "encounter_id": encounter_ids, "start": starts, "end": ends},
+        )
+
+    def _events(self, patient_data: PatientData) -> pd.DataFrame:
+        """Explode the events of all types, one row per event.
+
+        Events are ordered by type, procedures first, and by their position in
+        the lists of the patient, which breaks ties when sorting by time.
+
+        """
+        events = []
+        for event_type in [PROC, MED, LAB]:
+            data = patient_data.events[event_type].data
+            rows, codes = _explode(data[f"{event_type}_codes"])
+            _, dates = _explode(data[f"{event_type}_dates"])
+            _, encounter_ids = _explode(data["encounter_ids"])
+            codes = np.array([code.upper() for code in codes], dtype=object)
+            if event_type == LAB:
+                _, bins = _explode(data["binned_values"])
+                codes = np.array(
+                    [f"{code}_{value}" for code, value in zip(codes, bins)],
+                    dtype=object,
+                )
+            events.append(
+                pd.DataFrame(
+                    {
+                        "row": rows,
+                        "encounter_id": encounter_ids,
+                        "date": dates,
+                        "code": codes,
+                        "type_id": self.type_ids[event_type],
+                    },
+                ),
+            )
+        return pd.concat(events, ignore_index=True)
+
+    def _process_encounters(
+        self,
+        encounters: pd.DataFrame,
+        events: pd.DataFrame,
+        patients: pd.DataFrame,
+    ) -> pd.DataFrame:
+        """Keep the encounters with events, sort them and compute their tokens."""
+        keys = pd.MultiIndex.from_arrays(
+            [encounters["row"], encounters["encounter_id"]]
+        )
+        event_keys = pd.MultiIndex.from_arrays([events["row"], events["encounter_id"]])
+        encounters = encounters[keys.isin(event_keys)]
+        encounters = encounters.sort_values(["row", "start", "end", "encounter_id"])
+        encounters = encounters.reset_index(drop=True)
+        rows = encounters["row"].to_numpy()
+        first = _group_starts(rows)
+        encounters["order"] = encounters.groupby("row").cumcount().to_numpy()
+
+        start_times, local_starts = _parse_times(encounters["start"].to_numpy())
+        end_times, local_ends = _parse_times(encounters["end"].to_numpy())
+        birth_dates = _dates(patients["birthDate"]).astype(np.int64)
+        days = (local_starts - birth_dates[rows]) // DAY
+        ages = days // 365
+        first_rows = np.flatnonzero(first)
+        group = np.cumsum(first) - 1
+        initial = ((local_starts[first_rows] - self.reference_time) // DAY) // 7
+        encounters["age"] = ages
+        encounters["time"] = initial[group] + (ages - ages[first_rows][group]) * 53
+
+        encounters["start_time"] = start_times
+        encounters["end_time"] = end_times
+        encounters["local_start"] = local_starts
+        encounters["local_end"] = local_ends
+        # Gap between the end of each encounter and the start of the next one.
+        gaps = np.zeros(len(rows), dtype=np.int64)
+        gaps[1:] = (start_times[1:] - end_times[:-1]) // DAY
+        has_previous = ~first
+        encounters["overlaps_previous"] = has_previous & (gaps < 0)
+        encounters["interval"] = np.where(
+            has_previous & (gaps >= 0),
+            _interval_tokens(gaps),
+            None,
+        )
+        return encounters
+
+    def _process_events(
+        self,
+        events: pd.DataFrame,
+        encounters: pd.DataFrame,
+    ) -> Dict[str, np.ndarray]:
+        """Clip the events to their encounter, sort them and split them in visits.
+
+        Returns
+        -------
+        Dict[str, np.ndarray]
+            The columns of the sorted events, with the position of their
+            encounter in ``encounters`` and the index of their visit.
+
+        """
+        encounter_index = pd.MultiIndex.from_arrays(
+            [encounters["row"], encounters["encounter_id"]],
+        )
+        positions = encounter_index.get_indexer(
+            pd.MultiIndex.from_arrays([events["row"], events["encounter_id"]]),
+        )
+        events = events[positions >= 0]
+        positions = positions[positions >= 0]
+        starts = encounters["start_time"].to_numpy()[positions]
+        ends = encounters["end_time"].to_numpy()[positions]
+        times, local = _parse_times(events["date"].to_numpy())
+        before = times < starts
+        after = ~before & (times > ends)
+        dates = events["date"].to_numpy().copy()
+        dates[before] = encounters["start"].to_numpy()[positions][before]
+        dates[after] = encounters["end"].to_numpy()[positions][after]
+        times = np.where(before, starts, np.where(after, ends, times))
+        local = np.where(
+            before,
+            encounters["local_start"].to_numpy()[positions],
+            np.where(after, encounters["local_end"].to_numpy()[positions], local),
+        )
+
+        # Sort by date string, then encounter order, keeping ties in type order.
+        rows = events["row"].to_numpy()
+        date_codes = pd.factorize(dates, sort=True)[0]
+        order = np.lexsort(
+            (encounters["order"].to_numpy()[positions], date_codes, rows),
+        )
+        sorted_events = {
+            "row": rows[order],
+            "code": events["code"].to_numpy()[order],
+            "type_id": events["type_id"].to_numpy()[order],
+            "local": local[order],
+            "encounter": positions[order],
+        }
+        elapsed = (times - starts)[order] / 10**6 / 3600
+        sorted_events["elapsed"] = np.array(
+            [round(hours, 2) for hours in elapsed.tolist()],
+            dtype=np.float64,
+        )
+
+        # A new visit starts at each encounter, unless it overlaps the previous one.
+        encounter = sorted_events["encounter"]
+        first = _group_starts(sorted_events["row"])
+        previous = np.roll(encounter, 1)
+        overlaps = encounters["overlaps_previous"].to_numpy()[
+            np.maximum(encounter, previous)
+        ]
+        same_visit = (encounter == previous) | (
+            (np.abs(encounter - previous) == 1) & overlaps
+        )
+        new_visit = first | ~same_visit
+        visits = np.cumsum(new_visit)
+        group = np.cumsum(first) - 1
+        sorted_events["visit"] = visits - visits[np.flatnonzero(first)][group]
+        sorted_events["new_visit"] = new_visit
+        return sorted_events
+
+    def _mortality(
+        self,
+        patients: pd.DataFrame,
+        encounters: pd.DataFrame,
+        last_times: np.ndarray,
+        rows: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Get the mortality labels of the patients of some rows.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+            Whether each patient is deceased, the days from the start and end of
+            the last encounter to the death, and whether an event of the patient
+            is after the death.
+
+        """
+        death_dates = _dates(patients["deceasedDateTime"].to_numpy()[rows])
+        deceased = ~np.isnat(death_dates)
+        death_days = np.where(deceased, death_dates.astype(np.int64), 0) // DAY
+        is_last = np.roll(_group_starts(encounters["row"].to_numpy()), -1)
+        last_encounters = encounters[is_last].set_index("row").loc[rows]
+
+        def days_to_death(times: np.ndarray) -> np.ndarray:
+            return death_days - times // DAY
+
+        after_death = deceased & (days_to_death(last_times) < 0)
+        return (
+            deceased,
+            days_to_death(last_encounters["local_start"].to_numpy()),
+            days_to_death(last_encounters["local_end"].to_numpy()),
+            after_death,
+        )
+
+    def _condition_labels(
+        self,
+        conditions: pd.DataFrame,
+        encounters: pd.DataFrame,
+        rows: np.ndarray,
+    ) -> Dict[str, np.ndarray]:
+        """Flag the common and rare condition groups of the patients of some rows."""
+        values = [parse_literal(value) for value in conditions["encounter_conditions"]]
+        lengths = np.fromiter(
+            (sum(map(len, value.values())) for value in values),
+            dtype=np.int64,
+            count=len(values),
+        )
+        condition_rows = np.repeat(np.arange(len(values)), lengths)
+        condition_encounters = np.array(
+            [
+                encounter_id
+                for value in values
+                for encounter_id, codes in value.items()
+                for _ in codes
+            ],
+            dtype=object,
+        )
+        codes = np.array(
+            [code for value in values for codes in value.values() for code in codes],
+            dtype=object,
+        )
+        # Keep the conditions of the encounters of the sequences.
+        keep = pd.MultiIndex.from_arrays(
+            [condition_rows, condition_encounters],
+        ).isin(
+            pd.MultiIndex.from_arrays([encounters["row"], encounters["encounter_id"]])
+        )
+        patient_index = np.full(len(values), -1)
+        patient_index[rows] = np.arange(len(rows))
+        patients = patient_index[condition_rows]
+        keep &= patients >= 0
+        return self.condition_index.label_rows(
+            patients[keep],
+            codes[keep],
+            len(rows),
+        )
+
+    def _tokens(
+        self,
+        events: Dict[str, np.ndarray],
+        encounters: pd.DataFrame,
+    ) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """Lay out the tokens of the sorted events with their special tokens.
+
+        Each sequence starts with a class token, and each visit is wrapped in
+        visit start, visit end and register tokens, with a time delta token
+        between two visits.
+
+        Returns
+        -------
+        Tuple[Dict[str, np.ndarray], np.ndarray]
+            The flat token columns of all the sequences, and the offset of each
+            sequence in them.
+
+        """
+        first = _group_starts(events["row"])
+        first_index = np.flatnonzero(first)
+        group = np.cumsum(first) - 1
+        num_events = np.diff(np.append(first_index, len(first)))
+        num_visits = events["visit"][np.append(first_index[1:], len(first)) - 1] + 1
+        lengths = num_events + 4 * num_visits
+        offsets = np.cumsum(lengths) - lengths
+        total = int(lengths.sum())
+        ages = encounters["age"].to_numpy()[events["encounter"]]
+        times = encounters["time"].to_numpy()[events["encounter"]]
+        segments = np.where(events["visit"] % 2 == 0, 2, 1)
+
+        tokens = {
+            "event_tokens": np.empty(total, dtype=object),
+            "type_tokens": np.zeros(total, dtype=np.int64),
+            "age_tokens": np.zeros(total, dtype=np.int64),
+            "time_tokens": np.zeros(total, dtype=np.int64),
+            "visit_tokens": np.zeros(total, dtype=np.int64),
+            "position_tokens": np.zeros(total, dtype=np.int64),
+            "elapsed_tokens": np.full(total, -2.0),
+        }
+
+        def put(
+            index: np.ndarray,
+            token: Any,
+            type_name: str,
+            source: np.ndarray,
+            position: np.ndarray,
+        ) -> None:
+            """Set the special tokens at some indices, from some source events."""
+            tokens["event_tokens"][index] = token
+            tokens["type_tokens"][index] = self.type_ids[type_name]
+            tokens["age_tokens"][index] = ages[source]
+            tokens["time_tokens"][index] = times[source]
+            tokens["visit_tokens"][index] = segments[source]
+            tokens["position_tokens"][index] = position
+
+        index = offsets[group] + 2 + 4 * events["visit"] + np.arange(len(group))
+        index -= first_index[group]
+        for name, values in [
+            ("event_tokens", events["code"]),
+            ("type_tokens", events["type_id"]),
+            ("age_tokens", ages),
+            ("time_tokens", times),
+            ("visit_tokens", segments),
+            ("position_tokens", events["visit"] + 1),
+            ("elapsed_tokens", events["elapsed"]),
+        ]:
+            tokens[name][index] = values
+
+        starts = np.flatnonzero(events["new_visit"])
+        put(
+            index[starts] - 1,
+            self.token_config.visit_start_token,
+            VISIT_START,
+            starts,
+            events["visit"][starts] + 1,
+        )
+        tokens["elapsed_tokens"][index[starts] - 1] = -1.0
+
+        # The end of the previous visit and the time delta before the next one.
+        starts = np.flatnonzero(events["new_visit"] & ~first)
+        previous = starts - 1
+        put(
+            index[starts] - 4,
+            self.token_config.visit_end_token,
+            VISIT_END,
+            previous,
+            events["visit"][starts],
+        )
+        put(
+            index[starts] - 3,
+            self.token_config.register_token,
+            REGISTER,
+            previous,
+            events["visit"][starts],
+        )
+        intervals = encounters["interval"].to_numpy()[events["encounter"][starts]]
+        missing = pd.isna(intervals)
+        if missing.any():
+            # The encounter overlaps one that is not in the previous visit, so the
+            # time delta is measured from the encounter of the previous event.
+            gaps = (
+                encounters["start_time"].to_numpy()[events["encounter"][starts]]
+                - encounters["end_time"].to_numpy()[events["encounter"][previous]]
+            ) // DAY
+            intervals[missing] = _interval_tokens(gaps[missing])
+        delta_index = index[starts] - 2
+        tokens["event_tokens"][delta_index] = intervals
+        tokens["type_tokens"][delta_index] = self.type_ids[TIME_DELTA]
+        tokens["position_tokens"][delta_index] = events["visit"][starts]
+
+        tokens["event_tokens"][offsets] = self.token_config.class_token
+        tokens["type_tokens"][offsets] = self.type_ids[CLASS]
+        last = np.append(first_index[1:], len(first)) - 1
+        put(
+            offsets + lengths - 2,
+            self.token_config.visit_end_token,
+            VISIT_END,
+            last,
+            num_visits,
+        )
+        put(
+            offsets + lengths - 1,
+            self.token_config.register_token,
+            REGISTER,
+            last,
+            num_visits,
+        )
+        return tokens, offsets
+
+    def stages(self) -> List[Stage]:
+        """Get the stages creating the sequences of a chunk.
+
+        The stages pass the flat tables of the chunk in the state of the batch,
+        and the sequences are nested from the tokens of the kept patients.
+
+        Returns
+        -------
+        List[Stage]
+            The stages, in order.
+
+        """
+        return [
+            Stage("combine", self._combine_stage),
+            Stage("encounters", self._encounter_stage, requires=("combine",)),
+            Stage("events", self._event_stage, requires=("encounters",)),
+            Stage("mortality", self._mortality_stage, requires=("events",)),
+            Stage("tokens", self._token_stage, requires=("events",)),
+            Stage("truncation", self._truncation_stage, requires=("tokens",)),
+            Stage("conditions", self._condition_stage, requires=("tokens",)),
+        ]
+
+    def _combine_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Explode the events of the chunk."""
+        batch.state["events"] = self._events(batch.patient_data)
+        return batch
+
+    def _encounter_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Explode and process the encounters of the chunk."""
+        batch.state["encounters"] = self._process_encounters(
+            self._encounters(batch.patient_data),
+            batch.state["events"],
+            batch.patient_data.patients,
+        )
+        return batch
+
+    def _event_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Process the events, and keep the patients with enough events and visits."""
+        state = batch.state
+        events = self._process_events(state["events"], state["encounters"])
+        first = _group_starts(events["row"])
+        first_index = np.flatnonzero(first)
+        last_index = np.append(first_index[1:], len(first)) - 1
+        num_events = last_index - first_index + 1
+        num_visits = events["visit"][last_index] + 1
+        state.update(
+            events=events,
+            rows=events["row"][first_index],
+            last_index=last_index,
+            num_events=num_events,
+            num_visits=num_visits,
+            keep=(num_events > batch.min_events) & (num_visits > batch.min_visits),
+        )
+        return batch
+
+    def _mortality_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Label the mortality of the patients, skipping those dead before events."""
+        state = batch.state
+        patients = batch.patient_data.patients
+        rows = state["rows"]
+        deceased, death_after_start, death_after_end, after_death = self._mortality(
+            patients,
+            state["encounters"],
+            state["events"]["local"][state["last_index"]],
+            rows,
+        )
+        patient_ids = patients["patient_id"].to_numpy()[rows]
+        for patient_id in patient_ids[state["keep"] & after_death]:
+            LOGGER.info(f"After death events {patient_id}")
+            batch.after_death_events.append(patient_id)
+        state["keep"] &= ~np.isin(patient_ids, batch.after_death_events)
+        state["mortality"] = (deceased, death_after_start, death_after_end)
+        return batch
+
+    def _token_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Lay out the tokens of the kept patients, and nest them in sequences."""
+        state = batch.state
+        keep = state["keep"]
+        events = state["events"]
+        selected = keep[np.cumsum(_group_starts(events["row"])) - 1]
+        events = {name: values[selected] for name, values in events.items()}
+        rows = state["rows"][keep]
+        tokens, offsets = self._tokens(events, state["encounters"])
+        sequences = pd.DataFrame(
+            {
+                "patient_id": batch.patient_data.patients["patient_id"].to_numpy()[
+                    rows
+                ],
+                "num_visits": state["num_visits"][keep],
+            },
+            # Patients without encounters are dropped before indexing them.
+            index=np.searchsorted(np.unique(state["encounters"]["row"]), rows),
+        )
+        if "mortality" in state:
+            deceased, death_after_start, death_after_end = state["mortality"]
+            deceased = deceased[keep]
+            sequences["deceased"] = deceased.astype(np.int64)
+            # As with the row engine, the days to death are only set for deceased
+            # patients, so they are missing from chunks without deceased patients.
+            if deceased.any():
+                for name, days_to_death in [
+                    ("death_after_start", death_after_start),
+                    ("death_after_end", death_after_end),
+                ]:
+                    days = pd.Series(days_to_death[keep], index=sequences.index)
+                    sequences[name] = days if deceased.all() else days.where(deceased)
+        sequences["length"] = state["num_events"][keep]
+        sequences["token_length"] = np.diff(
+            np.append(offsets, len(tokens["event_tokens"]))
+        )
+        for name, values in tokens.items():
+            sequences[name] = np.split(values, offsets[1:])
+        state.update(tokens=tokens, offsets=offsets, rows=rows)
+        batch.sequences = sequences
+        return batch
+
+    def _truncation_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Add the truncated token columns of each max sequence length."""
+        for max_length in self.max_seq_lengths:
+            for name, values in truncate_or_pad(
+                batch.state["tokens"],
+                batch.state["offsets"],
+                max_length,
+                self.token_config,
+                batch.pad_events,
+            ).items():
+                batch.sequences[f"{name}_{max_length}"] = values
+        return batch
+
+    def _condition_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Flag the common and rare condition groups of the sequences."""
+        for name, flags in self._condition_labels(
+            batch.patient_data.conditions,
+            batch.state["encounters"],
+            batch.state["rows"],
+        ).items():
+            batch.sequences[name] = list(flags)
+        return batch
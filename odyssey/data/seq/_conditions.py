@@ -0,0 +1,133 @@
+"""Index of the condition groups labelling the patient sequences."""
+
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+CONDITION_GROUPS = ["common", "rare"]
+
+
+class ConditionIndex:
+    """Map condition codes to bitmasks of the condition groups including them.
+
+    The groups of ``common_conditions.json`` and ``rare_conditions.json`` are
+    compiled once, when first used, so the labels of a patient take one pass
+    over their codes.
+
+    Parameters
+    ----------
+    json_dir : str
+        Directory of the common and rare condition groups
+
+    """
+
+    def __init__(self, json_dir: str):
+        """Initialize the condition index."""
+        self.json_dir = json_dir
+        self._num_groups: Dict[str, int] = {}
+        self._bitmasks: Dict[str, Dict[str, int]] = {}
+        self._codes: Optional[pd.Index] = None
+        self._words: Dict[str, np.ndarray] = {}
+
+    def _compile(self) -> None:
+        """Load the condition groups and compile the bitmasks of their codes."""
+        for name in CONDITION_GROUPS:
+            with open(os.path.join(self.json_dir, f"{name}_conditions.json")) as f:
+                groups = json.load(f)
+            bitmasks: Dict[str, int] = {}
+            for i, codes in enumerate(groups.values()):
+                for code in codes:
+                    bitmasks[code] = bitmasks.get(code, 0) | 1 << i
+            self._num_groups[name] = len(groups)
+            self._bitmasks[name] = bitmasks
+        self._codes = pd.Index(
+            sorted(set().union(*(self._bitmasks[name] for name in CONDITION_GROUPS))),
+        )
+        # Bitmasks as 64-bit words, with a last row of zeros for other codes.
+        for name in CONDITION_GROUPS:
+            num_words = max((self._num_groups[name] + 63) // 64, 1)
+            words = np.zeros((len(self._codes) + 1, num_words), dtype=np.uint64)
+            for row, code in enumerate(self._codes):
+                bitmask = self._bitmasks[name].get(code, 0)
+                for word in range(num_words):
+                    words[row, word] = (bitmask >> 64 * word) & (2**64 - 1)
+            self._words[name] = words
+
+    @property
+    def codes(self) -> pd.Index:
+        """Get the codes of the condition groups."""
+        if self._codes is None:
+            self._compile()
+        return self._codes
+
+    def label_codes(self, codes: Iterable[str]) -> Dict[str, List[int]]:
+        """Flag the condition groups of the codes of a patient.
+
+        Parameters
+        ----------
+        codes : Iterable[str]
+            The condition codes of the patient
+
+        Returns
+        -------
+        Dict[str, List[int]]
+            The flag of each common and rare condition group, by label column.
+
+        """
+        if self._codes is None:
+            self._compile()
+        codes = set(codes)
+        labels = {}
+        for name in CONDITION_GROUPS:
+            bitmasks = self._bitmasks[name]
+            bitmask = 0
+            for code in codes:
+                bitmask |= bitmasks.get(code, 0)
+            labels[f"{name}_conditions"] = [
+                bitmask >> i & 1 for i in range(self._num_groups[name])
+            ]
+        return labels
+
+    def label_rows(
+        self,
+        rows: np.ndarray,
+        codes: np.ndarray,
+        num_rows: int,
+    ) -> Dict[str, np.ndarray]:
+        """Flag the condition groups of the codes of many patients at once.
+
+        The codes are joined with the index, and their bitmasks are combined
+        by patient with a bitwise OR.
+
+        Parameters
+        ----------
+        rows : np.ndarray
+            The patient row of each code
+        codes : np.ndarray
+            The condition codes
+        num_rows : int
+            The number of patients
+
+        Returns
+        -------
+        Dict[str, np.ndarray]
+            The flags of the common and rare condition groups of each patient,
+            by label column.
+
+        """
+        code_rows = self.codes.get_indexer(codes)
+        labels = {}
+        for name in CONDITION_GROUPS:
+            words = self._words[name]
+            patient_words = np.zeros((num_rows, words.shape[1]), dtype=np.uint64)
+            np.bitwise_or.at(patient_words, rows, words[code_rows])
+            groups = np.arange(self._num_groups[name])
+            labels[f"{name}_conditions"] = (
+                (patient_words[:, groups // 64] >> (groups % 64).astype(np.uint64))
+                & np.uint64(1)
+            ).astype(np.int64)
+        return labels
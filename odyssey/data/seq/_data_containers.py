@@ -1,10 +1,12 @@
 """Data containers for the patient sequences."""
 
 from dataclasses import dataclass
-from typing import Dict
+from typing import Dict, Optional
 
 import pandas as pd
 
+from odyssey.data.seq._timestamps import EpochIndex
+
 
 @dataclass
 class EventData:
@@ -39,6 +41,8 @@ class PatientData:
         Conditions dataframe.
     events: Dict[str, EventData]
         Event dataframes.
+    epochs: Optional[EpochIndex]
+        Epoch seconds of the dates of the dataframes, once they are parsed.
 
     """
 
@@ -46,3 +50,4 @@ class PatientData:
     encounters: pd.DataFrame
     conditions: pd.DataFrame
     events: Dict[str, EventData]
+    epochs: Optional[EpochIndex] = None
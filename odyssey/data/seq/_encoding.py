@@ -0,0 +1,172 @@
+"""Encode the event tokens of the patient sequences as vocabulary IDs."""
+
+import hashlib
+import json
+from itertools import chain
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+def vocab_fingerprint(vocab: Dict[str, int]) -> str:
+    """Hash a vocabulary, to check that IDs were encoded with it.
+
+    Parameters
+    ----------
+    vocab : Dict[str, int]
+        The ID of each token, as ``ConceptTokenizer.tokenizer_vocab``.
+
+    Returns
+    -------
+    str
+        The fingerprint, which changes with any token or ID.
+
+    """
+    items = sorted(vocab.items(), key=lambda item: (item[1], item[0]))
+    return hashlib.sha256(json.dumps(items).encode()).hexdigest()[:16]
+
+
+class ConceptEncoder:
+    """Map event tokens to the IDs of the vocabulary of a concept tokenizer.
+
+    A token gets its ID in the vocabulary, and other tokens the ID of the
+    unknown token, as the tokenizer does for tokens without whitespace.
+
+    Parameters
+    ----------
+    vocab : Dict[str, int]
+        The ID of each token
+    pad_token : str, optional
+        Padding token, by default "[PAD]"
+    unknown_token : str, optional
+        Unknown token, by default "[UNK]"
+
+    """
+
+    def __init__(
+        self,
+        vocab: Dict[str, int],
+        pad_token: str = "[PAD]",
+        unknown_token: str = "[UNK]",
+    ):
+        """Initialize the concept encoder."""
+        for token in [pad_token, unknown_token]:
+            if token not in vocab:
+                raise ValueError(f"Token {token} is not in the vocabulary.")
+        if max(vocab.values()) > np.iinfo(np.int32).max:
+            raise ValueError("Vocabulary IDs do not fit in 32-bit integers.")
+        self.tokens = pd.Index(list(vocab))
+        self.ids = np.append(
+            np.fromiter(vocab.values(), dtype=np.int32, count=len(vocab)),
+            np.int32(vocab[unknown_token]),
+        )
+        self.pad_id = vocab[pad_token]
+        self.fingerprint = vocab_fingerprint(vocab)
+
+    @classmethod
+    def from_tokenizer(cls, path: str) -> "ConceptEncoder":
+        """Load the vocabulary of a tokenizer saved by ``ConceptTokenizer.save``.
+
+        Parameters
+        ----------
+        path : str
+            Path of the ``tokenizer.json`` file.
+
+        Returns
+        -------
+        ConceptEncoder
+            The encoder of the vocabulary.
+
+        """
+        with open(path) as f:
+            config = json.load(f)
+        return cls(
+            config["tokenizer_vocab"],
+            pad_token=config["pad_token"],
+            unknown_token=config["unknown_token"],
+        )
+
+    def encode(
+        self,
+        tokens: np.ndarray,
+        offsets: np.ndarray,
+        max_length: int,
+    ) -> np.ndarray:
+        """Encode flat token columns of sequences, padded to a fixed width.
+
+        Parameters
+        ----------
+        tokens : np.ndarray
+            The event tokens of all the sequences, each of at most
+            ``max_length`` tokens
+        offsets : np.ndarray
+            The offset of each sequence in the tokens
+        max_length : int
+            The width of the encoded sequences
+
+        Returns
+        -------
+        np.ndarray
+            The IDs of the tokens of each sequence, padded with the ID of the
+            padding token, as an int32 array of shape
+            ``(len(offsets), max_length)``.
+
+        """
+        lengths = np.diff(np.append(offsets, len(tokens)))
+        rows = np.repeat(np.arange(len(offsets)), lengths)
+        columns = np.arange(len(tokens)) - np.repeat(offsets, lengths)
+        ids = np.full((len(offsets), max_length), self.pad_id, dtype=np.int32)
+        # Unknown tokens are at -1, the position of the unknown ID.
+        ids[rows, columns] = self.ids[self.tokens.get_indexer(tokens)]
+        return ids
+
+    def encode_lists(self, sequences: pd.Series, max_length: int) -> List[np.ndarray]:
+        """Encode the token lists of some sequences, padded to a fixed width.
+
+        Parameters
+        ----------
+        sequences : pd.Series
+            The event tokens of each sequence, of at most ``max_length`` tokens
+        max_length : int
+            The width of the encoded sequences
+
+        Returns
+        -------
+        List[np.ndarray]
+            The int32 IDs of each sequence.
+
+        """
+        lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+        tokens = np.empty(int(lengths.sum()), dtype=object)
+        tokens[:] = list(chain.from_iterable(sequences))
+        return list(self.encode(tokens, np.cumsum(lengths) - lengths, max_length))
+
+    def encode_array(self, sequences: pa.ChunkedArray, max_length: int) -> pa.Array:
+        """Encode an Arrow list column of event tokens, padded to a fixed width.
+
+        Parameters
+        ----------
+        sequences : pa.ChunkedArray
+            The event tokens of each sequence, of at most ``max_length`` tokens
+        max_length : int
+            The width of the encoded sequences
+
+        Returns
+        -------
+        pa.Array
+            The int32 IDs of each sequence, as a list column.
+
+        """
+        sequences = sequences.combine_chunks()
+        offsets = sequences.offsets.to_numpy()
+        ids = self.encode(
+            sequences.flatten().to_numpy(zero_copy_only=False),
+            (offsets - offsets[0])[:-1].astype(np.int64),
+            max_length,
+        )
+        return pa.ListArray.from_arrays(
+            pa.array(np.arange(len(ids) + 1) * max_length, type=pa.int32()),
+            pa.array(ids.ravel()),
+        )
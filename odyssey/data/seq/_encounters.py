@@ -1,11 +1,16 @@
 """Encounter processor module for patient sequence generation."""
 
-from ast import literal_eval
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import pandas as pd
-from dateutil import parser
+
+from odyssey.data.io import parse_literal
+from odyssey.data.seq._timestamps import DAY, EpochIndex, to_epoch
+
+
+# Position, start and end of an encounter, keyed by its ID.
+EncounterIndex = Dict[str, Tuple[int, str, str]]
 
 
 class EncounterProcessor:
@@ -32,11 +37,11 @@ class EncounterProcessor:
         """
         encounter_ids = []
         for _, event_row in events_row.items():
-            event_encounter_ids = set(literal_eval(event_row["encounter_ids"]))
+            event_encounter_ids = set(parse_literal(event_row["encounter_ids"]))
             encounter_ids.append(event_encounter_ids)
         valid_encounters = set.union(*encounter_ids)
         for col in ["encounter_ids", "starts", "ends"]:
-            encounter_row[col] = literal_eval(encounter_row[col])
+            encounter_row[col] = parse_literal(encounter_row[col])
         encounter_ids = encounter_row["encounter_ids"]
         encounter_starts = encounter_row["starts"]
         encounter_ends = encounter_row["ends"]
@@ -83,7 +88,10 @@ class EncounterProcessor:
         return encounter_row
 
     def calculate_patient_ages(
-        self, encounter_row: pd.Series, patient_row: pd.Series
+        self,
+        encounter_row: pd.Series,
+        patient_row: pd.Series,
+        epochs: EpochIndex,
     ) -> pd.Series:
         """Calculate patient ages at the time of encounters.
 
@@ -93,6 +101,8 @@ class EncounterProcessor:
             Encounter row
         patient_row : pd.Series
             Patient row
+        epochs : EpochIndex
+            Epoch seconds of the dates of the chunk
 
         Returns
         -------
@@ -100,11 +110,10 @@ class EncounterProcessor:
             Encounter row with ages
 
         """
-        birth_date = patient_row["birthDate"]
+        birth_date = epochs.local(patient_row["birthDate"])
         encounter_dates = encounter_row["starts"]
-        birth_date = datetime.strptime(birth_date, "%Y-%m-%d")
         ages = [
-            (parser.parse(e_date).replace(tzinfo=None) - birth_date).days // 365
+            (epochs.local(e_date) - birth_date) // DAY // 365
             for e_date in encounter_dates
         ]
         encounter_row["ages"] = ages
@@ -112,7 +121,10 @@ class EncounterProcessor:
         return encounter_row
 
     def calculate_encounter_times(
-        self, encounter_row: pd.Series, reference_time: str
+        self,
+        encounter_row: pd.Series,
+        reference_time: datetime,
+        epochs: EpochIndex,
     ) -> pd.Series:
         """Calculate time of encounters in weeks with respect to a reference time.
 
@@ -120,8 +132,10 @@ class EncounterProcessor:
         ----------
         encounter_row : pd.Series
             Encounter row
-        reference_time : str
+        reference_time : datetime
             Reference time
+        epochs : EpochIndex
+            Epoch seconds of the dates of the chunk
 
         Returns
         -------
@@ -129,21 +143,27 @@ class EncounterProcessor:
             Updated row with encounter times
 
         """
-        first_encounter = parser.parse(encounter_row["starts"][0]).replace(tzinfo=None)
-        initial_value = (first_encounter - reference_time).days // 7
+        first_encounter = epochs.local(encounter_row["starts"][0])
+        initial_value = (first_encounter - to_epoch(reference_time)) // DAY // 7
         ages = encounter_row["ages"]
         time_values = [initial_value + (age - ages[0]) * 53 for age in ages]
         encounter_row["times"] = time_values
 
         return encounter_row
 
-    def calculate_intervals(self, encounter_row: pd.Series) -> pd.Series:
+    def calculate_intervals(
+        self,
+        encounter_row: pd.Series,
+        epochs: EpochIndex,
+    ) -> pd.Series:
         """Calculate the intervals between encounters.
 
         Parameters
         ----------
         encounter_row : pd.Series
             Encounter row
+        epochs : EpochIndex
+            Epoch seconds of the dates of the chunk
 
         Returns
         -------
@@ -156,12 +176,11 @@ class EncounterProcessor:
         intervals: Dict[str, str] = {}
         eq_encounters: Dict[str, List[str]] = {}
         for i in range(len(start_times) - 1):
-            start = parser.parse(start_times[i + 1])
+            start = epochs.utc(start_times[i + 1])
             start_id = encounter_row["encounter_ids"][i + 1]
-            end = parser.parse(end_times[i])
+            end = epochs.utc(end_times[i])
             end_id = encounter_row["encounter_ids"][i]
-            delta = start - end
-            days = delta.days
+            days = (start - end) // DAY
             # If the difference between the end of the current encounter
             # and the start of the next encounter is negative, we consider
             # them to be a single encounter
@@ -186,3 +205,31 @@ class EncounterProcessor:
         encounter_row["eq_encounters"] = eq_encounters
 
         return encounter_row
+
+    def index_encounters(self, encounter_row: pd.Series) -> pd.Series:
+        """Index the encounters by ID, for the lookups of the event stages.
+
+        Parameters
+        ----------
+        encounter_row : pd.Series
+            Encounter row
+
+        Returns
+        -------
+        pd.Series
+            Updated row with the position, start and end of each encounter,
+            keyed by its ID. The first of duplicate IDs is kept.
+
+        """
+        encounter_index: EncounterIndex = {}
+        for i, (encounter_id, start, end) in enumerate(
+            zip(
+                encounter_row["encounter_ids"],
+                encounter_row["starts"],
+                encounter_row["ends"],
+            ),
+        ):
+            encounter_index.setdefault(encounter_id, (i, start, end))
+        encounter_row["encounter_index"] = encounter_index
+
+        return encounter_row
@@ -1,14 +1,15 @@
 """Events processor module for patient sequence generation."""
 
-from ast import literal_eval
-from typing import Dict, List
+from typing import Any, Dict, List, Set
 
+import numpy as np
 import pandas as pd
-from dateutil import parser
 
 from odyssey.data.constants import LAB, MED, PROC
+from odyssey.data.io import parse_literal
 from odyssey.data.seq._data_containers import PatientData
-from odyssey.odyssey.data.seq._tokens import TokenConfig
+from odyssey.data.seq._timestamps import EpochIndex
+from odyssey.data.seq._tokens import TokenConfig
 
 
 class EventProcessor:
@@ -30,6 +31,7 @@ class EventProcessor:
         row: pd.Series,
         encounter_row: pd.Series,
         concept_name: str,
+        epochs: EpochIndex,
     ) -> pd.Series:
         """Edit the datetimes of events to fit within the encounter time frame.
 
@@ -38,9 +40,11 @@ class EventProcessor:
         row : pd.Series
             Events row
         encounter_row : pd.Series
-            Encounter row
+            Encounter row, with its encounter index
         concept_name : str
             Name of the event concept
+        epochs : EpochIndex
+            Epoch seconds of the dates of the chunk
 
         Returns
         -------
@@ -57,26 +61,23 @@ class EventProcessor:
                 "lab_values",
                 "lab_units",
             ]:
-                row[name] = literal_eval(row[name])
+                row[name] = parse_literal(row[name])
         elif concept_name == MED:
             for name in ["encounter_ids", "med_dates", "med_codes"]:
-                row[name] = literal_eval(row[name])
+                row[name] = parse_literal(row[name])
         elif concept_name == PROC:
             for name in ["encounter_ids", "proc_dates", "proc_codes"]:
-                row[name] = literal_eval(row[name])
+                row[name] = parse_literal(row[name])
         if row["length"] == 0:
             return row
         dates = []
         date_column = f"{concept_name}_dates"
-        for i, date in enumerate(row[date_column]):
-            encounter_index = encounter_row["encounter_ids"].index(
-                row["encounter_ids"][i],
-            )
-            encounter_start = encounter_row["starts"][encounter_index]
-            encounter_end = encounter_row["ends"][encounter_index]
-            start_parsed = parser.parse(encounter_start)
-            end_parsed = parser.parse(encounter_end)
-            date_parsed = parser.parse(date)
+        encounter_index = encounter_row["encounter_index"]
+        for encounter_id, date in zip(row["encounter_ids"], row[date_column]):
+            _, encounter_start, encounter_end = encounter_index[encounter_id]
+            start_parsed = epochs.utc(encounter_start)
+            end_parsed = epochs.utc(encounter_end)
+            date_parsed = epochs.utc(date)
             enc_date = date
             if date_parsed < start_parsed:
                 enc_date = encounter_start
@@ -137,26 +138,84 @@ class EventProcessor:
         self,
         row: pd.Series,
         encounter_row: pd.Series,
+        epochs: EpochIndex,
     ) -> pd.Series:
         """Calculate the time of the events after the admission."""
         elapsed_times = []
+        encounter_index = encounter_row["encounter_index"]
         for event_time, encounter_id in zip(row["proc_dates"], row["encounter_ids"]):
-            encounter_index = encounter_row["encounter_ids"].index(encounter_id)
-            start_time = encounter_row["starts"][encounter_index]
-            start_time = parser.parse(start_time)
-            event_time_ = parser.parse(event_time)
-            elapsed_time = round((event_time_ - start_time).total_seconds() / 3600, 2)
+            start_time = epochs.utc(encounter_index[encounter_id][1])
+            elapsed_time = round((epochs.utc(event_time) - start_time) / 3600, 2)
             elapsed_times.append(elapsed_time)
         row["elapsed_time"] = elapsed_times
 
         return row
 
+    def _flatten_events(
+        self,
+        patient_data: PatientData,
+    ) -> Dict[str, np.ndarray]:
+        """Flatten the events of all types of a chunk, one item per event.
+
+        Events are ordered by patient, then by type, procedures first, and by
+        their position in the lists of the patient.
+
+        Parameters
+        ----------
+        patient_data : PatientData
+            Patient data
+
+        Returns
+        -------
+        Dict[str, np.ndarray]
+            The patient row, code, date, encounter ID and type ID of the events.
+
+        """
+        columns: Dict[str, List[Any]] = {
+            "row": [],
+            "code": [],
+            "date": [],
+            "encounter_id": [],
+            "type_id": [],
+        }
+        for event_type in [PROC, MED, LAB]:
+            data = patient_data.events[event_type].data
+            type_id = self.token_config.token_type_mapping.get(event_type)
+            code_lists = data[f"{event_type}_codes"]
+            if event_type == LAB:
+                code_lists = [
+                    [f"{code.upper()}_{value}" for code, value in zip(codes, bins)]
+                    for codes, bins in zip(code_lists, data["binned_values"])
+                ]
+            else:
+                code_lists = [[code.upper() for code in codes] for codes in code_lists]
+            for row, codes, dates, encounter_ids in zip(
+                range(len(data)),
+                code_lists,
+                data[f"{event_type}_dates"],
+                data["encounter_ids"],
+            ):
+                columns["row"].extend([row] * len(codes))
+                columns["code"].extend(codes)
+                columns["date"].extend(dates)
+                columns["encounter_id"].extend(encounter_ids)
+                columns["type_id"].extend([type_id] * len(codes))
+        return {
+            name: np.array(values, dtype=np.int64 if name == "row" else object)
+            for name, values in columns.items()
+        }
+
     def combine_events(
         self,
         patient_data: PatientData,
     ) -> pd.DataFrame:
         """Combine the events of different concepts.
 
+        The events of the whole chunk are sorted at once, by patient, date and
+        encounter order, keeping the order of their types for ties. Dates are
+        compared through their ranks among the distinct date strings, which
+        order them as the strings do.
+
         Parameters
         ----------
         patient_data : PatientData
@@ -169,91 +228,79 @@ class EventProcessor:
 
         """
         procedures = patient_data.events[PROC].data
-        procedures["type_ids"] = [None] * len(procedures)
-        if patient_data.conditions is not None:
-            procedures["encounter_conditions"] = [None] * len(procedures)
-
-        for i in range(len(procedures)):
-            proc_codes = procedures.iloc[i]["proc_codes"]
-            proc_codes = [code.upper() for code in proc_codes]
-
-            med_codes = patient_data.events[MED].data.iloc[i]["med_codes"]
-            med_codes = [code.upper() for code in med_codes]
-
-            lab_codes = patient_data.events[LAB].data.iloc[i]["lab_codes"]
-            lab_codes = [code.upper() for code in lab_codes]
-            lab_bins = patient_data.events[LAB].data.iloc[i]["binned_values"]
-            lab_codes = [f"{el1}_{el2}" for el1, el2 in zip(lab_codes, lab_bins)]
-
-            proc_type_ids = [self.token_config.token_type_mapping.get(PROC)] * len(
-                proc_codes
-            )
-            med_type_ids = [self.token_config.token_type_mapping.get(MED)] * len(
-                med_codes
-            )
-            lab_type_ids = [self.token_config.token_type_mapping.get(LAB)] * len(
-                lab_codes
-            )
-            proc_dates = procedures.iloc[i]["proc_dates"]
-            med_dates = patient_data.events[MED].data.iloc[i]["med_dates"]
-            lab_dates = patient_data.events[LAB].data.iloc[i]["lab_dates"]
-
-            proc_encounters = procedures.iloc[i]["encounter_ids"]
-            med_encounters = patient_data.events[MED].data.iloc[i]["encounter_ids"]
-            lab_encounters = patient_data.events[LAB].data.iloc[i]["encounter_ids"]
-
-            combined_codes = proc_codes + med_codes + lab_codes
-            combined_dates = proc_dates + med_dates + lab_dates
-            combined_encounters = proc_encounters + med_encounters + lab_encounters
-            combined_type_ids = proc_type_ids + med_type_ids + lab_type_ids
-
-            encounter_order = {
-                encounter: i
-                for i, encounter in enumerate(
-                    patient_data.encounters.iloc[i]["encounter_ids"]
+        events = self._flatten_events(patient_data)
+        encounter_orders = [
+            {encounter: i for i, encounter in enumerate(encounter_ids)}
+            for encounter_ids in patient_data.encounters["encounter_ids"]
+        ]
+        orders = np.fromiter(
+            (
+                encounter_orders[row][encounter_id]
+                for row, encounter_id in zip(
+                    events["row"].tolist(),
+                    events["encounter_id"],
                 )
-            }
-
-            combined = sorted(
-                zip(
-                    combined_dates,
-                    combined_codes,
-                    combined_encounters,
-                    combined_type_ids,
-                ),
-                key=lambda x: (x[0], encounter_order.get(x[2])),
-            )
-            sorted_dates, sorted_codes, sorted_encounters, sorted_type_ids = (
-                zip(*combined) if combined else ([], [], [], [])
-            )
-
-            if patient_data.conditions is not None:
-                cond_codes = patient_data.conditions.iloc[i]["encounter_conditions"]
-                # keep the conditions of the existing encounters
-                filtered_conditions = {
-                    k: v for k, v in cond_codes.items() if k in combined_encounters
-                }
-                sorted_conditions = dict(
-                    sorted(
-                        filtered_conditions.items(),
-                        key=lambda item: encounter_order.get(item[0], float("inf")),
+            ),
+            dtype=np.int64,
+            count=len(events["row"]),
+        )
+        date_ranks = pd.factorize(events["date"], sort=True)[0]
+        order = np.lexsort((orders, date_ranks, events["row"]))
+        split = np.cumsum(np.bincount(events["row"], minlength=len(procedures)))[:-1]
+        sorted_events = {
+            name: [values.tolist() for values in np.split(values[order], split)]
+            for name, values in events.items()
+        }
+
+        if patient_data.conditions is not None:
+            procedures["encounter_conditions"] = [
+                [
+                    self._combine_conditions(
+                        encounter_conditions,
+                        set(encounter_ids),
+                        encounter_order,
+                        eq_encounters,
                     ),
+                ]
+                for encounter_conditions, encounter_ids, encounter_order, eq_encounters in zip(
+                    patient_data.conditions["encounter_conditions"],
+                    sorted_events["encounter_id"],
+                    encounter_orders,
+                    patient_data.encounters["eq_encounters"],
                 )
-                # Concat conditions if their encounters are equal
-                encounter_order_eq = self._update_encounter_order(
-                    encounter_order,
-                    patient_data.encounters.iloc[i]["eq_encounters"],
-                )
-                concatenated_conditions = self._concat_conditions(
-                    sorted_conditions,
-                    encounter_order_eq,
-                )
-                procedures.at[i, "encounter_conditions"] = [concatenated_conditions]
-
-            procedures.at[i, "proc_dates"] = list(sorted_dates)
-            procedures.at[i, "proc_codes"] = list(sorted_codes)
-            procedures.at[i, "encounter_ids"] = list(sorted_encounters)
-            procedures.at[i, "type_ids"] = list(sorted_type_ids)
-            procedures.at[i, "length"] = len(sorted_dates)
+            ]
+        procedures["proc_dates"] = sorted_events["date"]
+        procedures["proc_codes"] = sorted_events["code"]
+        procedures["encounter_ids"] = sorted_events["encounter_id"]
+        procedures["type_ids"] = sorted_events["type_id"]
+        procedures["length"] = [len(dates) for dates in sorted_events["date"]]
 
         return procedures
+
+    def _combine_conditions(
+        self,
+        encounter_conditions: Dict[str, List[str]],
+        encounter_ids: Set[str],
+        encounter_order: Dict[str, int],
+        eq_encounters: Dict[str, List[str]],
+    ) -> Dict[int, List[str]]:
+        """Group the conditions of the encounters with events of a patient."""
+        # keep the conditions of the existing encounters
+        filtered_conditions = {
+            k: v for k, v in encounter_conditions.items() if k in encounter_ids
+        }
+        sorted_conditions = dict(
+            sorted(
+                filtered_conditions.items(),
+                key=lambda item: encounter_order.get(item[0], float("inf")),
+            ),
+        )
+        # Concat conditions if their encounters are equal
+        encounter_order_eq = self._update_encounter_order(
+            encounter_order,
+            eq_encounters,
+        )
+        return self._concat_conditions(
+            sorted_conditions,
+            encounter_order_eq,
+        )
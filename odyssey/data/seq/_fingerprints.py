@@ -0,0 +1,109 @@
+"""Fingerprints of the input rows of the patients of the sequences."""
+
+import os
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+def fingerprint_rows(dataframes: List[pd.DataFrame]) -> np.ndarray:
+    """Hash the rows of the input files of each patient of a chunk.
+
+    Parameters
+    ----------
+    dataframes : List[pd.DataFrame]
+        The chunks of the input files, aligned by patient.
+
+    Returns
+    -------
+    np.ndarray
+        The fingerprint of each patient, which changes with any of their rows.
+
+    """
+    hashes = [
+        pd.util.hash_pandas_object(frame.astype(str), index=False).to_numpy()
+        for frame in dataframes
+    ]
+    return pd.util.hash_pandas_object(
+        pd.DataFrame(np.column_stack(hashes)),
+        index=False,
+    ).to_numpy()
+
+
+def fingerprint_path(fingerprint_dir: str, round_number: int) -> str:
+    """Get the path of the fingerprints of the patients of a round.
+
+    Parameters
+    ----------
+    fingerprint_dir : str
+        The directory of the fingerprints.
+    round_number : int
+        The round.
+
+    Returns
+    -------
+    str
+        The path of the file.
+
+    """
+    return os.path.join(fingerprint_dir, f"fingerprints_{round_number}.parquet")
+
+
+def write_fingerprints(
+    fingerprint_dir: str,
+    round_number: int,
+    patient_ids: pd.Series,
+    fingerprints: np.ndarray,
+) -> None:
+    """Write the fingerprints of the patients of a round.
+
+    Parameters
+    ----------
+    fingerprint_dir : str
+        The directory of the fingerprints.
+    round_number : int
+        The round, whose output files have the sequences of the patients.
+    patient_ids : pd.Series
+        The IDs of the patients.
+    fingerprints : np.ndarray
+        The fingerprints of their input rows.
+
+    """
+    pd.DataFrame(
+        {
+            "patient_id": patient_ids.astype(str).to_numpy(),
+            "fingerprint": np.asarray(fingerprints, dtype=np.uint64),
+            "round": np.full(len(patient_ids), round_number, dtype=np.int64),
+        },
+    ).to_parquet(fingerprint_path(fingerprint_dir, round_number), engine="pyarrow")
+
+
+def read_fingerprints(fingerprint_dir: str) -> pd.DataFrame:
+    """Read the fingerprints of all the patients.
+
+    Parameters
+    ----------
+    fingerprint_dir : str
+        The directory of the fingerprints.
+
+    Returns
+    -------
+    pd.DataFrame
+        The ID, fingerprint and round of each patient.
+
+    """
+    files = [
+        os.path.join(fingerprint_dir, name)
+        for name in sorted(os.listdir(fingerprint_dir))
+        if name.startswith("fingerprints_")
+    ]
+    if not files:
+        return pd.DataFrame(
+            {
+                "patient_id": pd.Series(dtype=str),
+                "fingerprint": pd.Series(dtype=np.uint64),
+                "round": pd.Series(dtype=np.int64),
+            },
+        )
+    return pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
@@ -1,16 +1,158 @@
 """Label assignment module for patient sequence generation."""
 
+import logging
+from typing import List
+
+import pandas as pd
+
+from odyssey.data.seq._conditions import ConditionIndex
+from odyssey.data.seq._timestamps import EpochIndex
+
+
+LOGGER = logging.getLogger(__name__)
+
 
 class LabelAssigner:
-    """Assign labels to the patient sequences."""
+    """Assign labels to the patient sequences.
+
+    Parameters
+    ----------
+    json_dir : str
+        Directory of the common and rare condition groups
 
-    def __init__(self, json_dir):
+    """
+
+    def __init__(self, json_dir: str):
+        """Initialize the label assigner."""
         self.json_dir = json_dir
+        self.condition_index = ConditionIndex(json_dir)
+
+    def _mortality_label(
+        self,
+        row: pd.Series,
+        patient_row: pd.Series,
+        encounter_row: pd.Series,
+        epochs: EpochIndex,
+        after_death_events: List[str],
+    ) -> pd.Series:
+        """Get the mortality label for the patient.
+
+        Parameters
+        ----------
+        row : pd.Series
+            Combined events row
+        patient_row : pd.Series
+            Patient row
+        encounter_row : pd.Series
+            Encounter row
+        epochs : EpochIndex
+            Epoch seconds of the dates of the chunk
+        after_death_events : List[str]
+            IDs of the patients with events after their death, to which the
+            patient is added if their last event is after their death
+
+        Returns
+        -------
+        pd.Series
+            Updated row with mortality label
+        """
+        death_date = patient_row["deceasedDateTime"]
+        if not isinstance(death_date, str) and pd.isna(death_date):
+            row["deceased"] = 0
+            return row
+        death_date = epochs.local_day(death_date)
+        encounter_starts = encounter_row["starts"]
+        encounter_ends = encounter_row["ends"]
+        last_start = epochs.local_day(encounter_starts[-1])
+        last_end = epochs.local_day(encounter_ends[-1])
+        last_code_date = epochs.local_day(row["proc_dates"][-1])
+
+        if death_date - last_code_date < 0:
+            LOGGER.info(f"After death events {row['patient_id']}")
+            after_death_events.append(row["patient_id"])
+
+        row["deceased"] = 1
+        row["death_after_start"] = death_date - last_start
+        row["death_after_end"] = death_date - last_end
+        return row
+
+    def assign_mortality_label(
+        self,
+        events: pd.DataFrame,
+        patients: pd.DataFrame,
+        encounters: pd.DataFrame,
+        epochs: EpochIndex,
+        after_death_events: List[str],
+    ) -> pd.DataFrame:
+        """Assign mortality labels based on patient death information.
+
+        Parameters
+        ----------
+        events : pd.DataFrame
+            The sequences, one row per patient, indexed like the patients
+        patients : pd.DataFrame
+            The patients of the chunk
+        encounters : pd.DataFrame
+            The processed encounters of the chunk
+        epochs : EpochIndex
+            Epoch seconds of the dates of the chunk
+        after_death_events : List[str]
+            IDs of the patients with events after their death, which are
+            removed. The patients of the chunk with such events are added to it.
+
+        Returns
+        -------
+        pd.DataFrame
+            The labelled sequences.
+
+        """
+        events = events.apply(
+            lambda row: self._mortality_label(
+                row,
+                patients.iloc[row.name],
+                encounters.iloc[row.name],
+                epochs,
+                after_death_events,
+            ),
+            axis=1,
+        )
+        return events[~events["patient_id"].isin(after_death_events)]
+
+    def assign_condition_labels(
+        self,
+        events: pd.DataFrame,
+        conditions: pd.DataFrame,
+    ) -> pd.DataFrame:
+        """Assign labels for common and rare conditions.
+
+        Only the conditions of the encounters of each sequence are labelled.
+
+        Parameters
+        ----------
+        events : pd.DataFrame
+            The sequences, one row per patient, indexed like the conditions
+        conditions : pd.DataFrame
+            The parsed conditions of the chunk, by encounter
+
+        Returns
+        -------
+        pd.DataFrame
+            The sequences with their ``common_conditions`` and
+            ``rare_conditions`` flags.
+
+        """
 
-    def assign_mortality_label(self, events, patients, encounters):
-        """Assign mortality labels based on patient death information."""
-        pass
+        def label(row: pd.Series) -> pd.Series:
+            encounter_ids = set(row["encounter_ids"])
+            codes = conditions.iloc[row.name]["encounter_conditions"]
+            labels = self.condition_index.label_codes(
+                code
+                for encounter_id, encounter_codes in codes.items()
+                if encounter_id in encounter_ids
+                for code in encounter_codes
+            )
+            for name, flags in labels.items():
+                row[name] = flags
+            return row
 
-    def assign_condition_labels(self, events, conditions):
-        """Assign labels for common and rare conditions."""
-        pass
+        return events.apply(label, axis=1)
@@ -0,0 +1,225 @@
+"""Partition the input files of the sequence generator by patient."""
+
+import os
+import shutil
+from typing import Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from odyssey.data.io import parquet_files, read_parquet
+
+
+def shard_ids(patient_ids: pd.Series, num_shards: int) -> np.ndarray:
+    """Get the shards of some patients, from a stable hash of their IDs.
+
+    Parameters
+    ----------
+    patient_ids : pd.Series
+        The patient IDs.
+    num_shards : int
+        The number of shards.
+
+    Returns
+    -------
+    np.ndarray
+        The shard of each patient, the same in every process.
+
+    """
+    hashes = pd.util.hash_array(patient_ids.astype(str).to_numpy(dtype=object))
+    return (hashes % np.uint64(num_shards)).astype(np.int64)
+
+
+def shard_path(shard_dir: str, shard: int, name: str, input_format: str) -> str:
+    """Get the path of an input file of a shard.
+
+    Parameters
+    ----------
+    shard_dir : str
+        The directory of the shards.
+    shard : int
+        The shard.
+    name : str
+        The name of the input file, without extension.
+    input_format : str
+        The format of the input files, "csv" or "parquet".
+
+    Returns
+    -------
+    str
+        The path of the file.
+
+    """
+    return os.path.join(shard_dir, f"shard_{shard:05d}", f"{name}.{input_format}")
+
+
+def _partition_csv(path: str, paths: List[str], buffer_size: int) -> np.ndarray:
+    """Copy the rows of a csv file to the files of their shards.
+
+    Values are copied as strings, so the shard files parse as the input does.
+
+    """
+    counts = np.zeros(len(paths), dtype=np.int64)
+    reader = pd.read_csv(
+        path,
+        dtype=str,
+        keep_default_na=False,
+        chunksize=buffer_size,
+    )
+    header = pd.read_csv(path, dtype=str, nrows=0)
+    for shard_file in paths:
+        header.to_csv(shard_file, index=False)
+    for chunk in reader:
+        shards = shard_ids(chunk["patient_id"], len(paths))
+        counts += np.bincount(shards, minlength=len(paths))
+        for shard, rows in chunk.groupby(shards):
+            rows.to_csv(paths[shard], mode="a", header=False, index=False)
+    return counts
+
+
+def _partition_parquet(path: str, paths: List[str], buffer_size: int) -> np.ndarray:
+    """Copy the rows of a parquet file to the files of their shards."""
+    counts = np.zeros(len(paths), dtype=np.int64)
+    files = parquet_files(path)
+    schema = pq.read_schema(files[0])
+    writers = [pq.ParquetWriter(shard_file, schema) for shard_file in paths]
+    try:
+        for file in files:
+            for batch in pq.ParquetFile(file).iter_batches(batch_size=buffer_size):
+                shards = shard_ids(
+                    batch.column("patient_id").to_pandas(),
+                    len(paths),
+                )
+                counts += np.bincount(shards, minlength=len(paths))
+                order = np.argsort(shards, kind="stable")
+                starts = np.searchsorted(shards[order], np.arange(len(paths) + 1))
+                for shard, writer in enumerate(writers):
+                    rows = order[starts[shard] : starts[shard + 1]]
+                    if len(rows) > 0:
+                        writer.write_batch(batch.take(rows))
+    finally:
+        for writer in writers:
+            writer.close()
+    return counts
+
+
+def partition_inputs(
+    data_dir: str,
+    names: List[str],
+    input_format: str,
+    shard_dir: str,
+    num_shards: int,
+    buffer_size: int = 10000,
+) -> List[int]:
+    """Partition input files into shards by a hash of the patient IDs.
+
+    Each file is read once, in buffers of rows, and each row is appended to
+    the file of its shard, in the input format. The rows of a patient are in
+    the same shard in every file, whatever their order in the inputs.
+
+    Parameters
+    ----------
+    data_dir : str
+        The directory of the input files.
+    names : List[str]
+        The names of the input files, without extension. The first file has
+        one row per patient of the cohort.
+    input_format : str
+        The format of the input files, "csv" or "parquet".
+    shard_dir : str
+        The directory of the shards, replaced if it exists.
+    num_shards : int
+        The number of shards.
+    buffer_size : int, optional
+        The number of rows read at a time, by default 10000
+
+    Returns
+    -------
+    List[int]
+        The number of patients of each shard, from the first file.
+
+    """
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    for shard in range(num_shards):
+        os.makedirs(os.path.dirname(shard_path(shard_dir, shard, "", "")))
+    partition = _partition_parquet if input_format == "parquet" else _partition_csv
+    num_patients = []
+    for name in names:
+        counts = partition(
+            os.path.join(data_dir, f"{name}.{input_format}"),
+            [
+                shard_path(shard_dir, shard, name, input_format)
+                for shard in range(num_shards)
+            ],
+            buffer_size,
+        )
+        if not num_patients:
+            num_patients = counts.tolist()
+    return num_patients
+
+
+def _empty_value(column: str) -> object:
+    """Get the value of a column for a patient without rows in a file."""
+    if column == "length":
+        return 0
+    if column == "encounter_conditions":
+        return {}
+    return []
+
+
+def read_shard(
+    shard_dir: str,
+    shard: int,
+    names: List[str],
+    input_format: str,
+    chunksize: Optional[int] = None,
+) -> Iterator[List[pd.DataFrame]]:
+    """Read the files of a shard, joined on the patients of the first file.
+
+    Parameters
+    ----------
+    shard_dir : str
+        The directory of the shards.
+    shard : int
+        The shard.
+    names : List[str]
+        The names of the input files, without extension, the first one having
+        one row per patient.
+    input_format : str
+        The format of the input files, "csv" or "parquet".
+    chunksize : Optional[int], optional
+        The number of patients per chunk, by default None which reads the
+        whole shard as one chunk
+
+    Yields
+    ------
+    List[pd.DataFrame]
+        The rows of the files for a chunk of patients, aligned by patient in
+        the order of the first file. Patients without rows in a file have empty
+        lists.
+
+    """
+    read = read_parquet if input_format == "parquet" else pd.read_csv
+    frames = [read(shard_path(shard_dir, shard, name, input_format)) for name in names]
+    patient_ids = frames[0]["patient_id"]
+    joined = [frames[0].reset_index(drop=True)]
+    for frame in frames[1:]:
+        missing = np.flatnonzero(~patient_ids.isin(frame["patient_id"]))
+        aligned = frame.set_index("patient_id").reindex(patient_ids).reset_index()
+        if len(missing) > 0:
+            for column in aligned.columns[1:]:
+                values = aligned[column].astype(object).to_numpy()
+                for row in missing:
+                    values[row] = _empty_value(column)
+                aligned[column] = values
+            if "length" in aligned.columns:
+                aligned["length"] = aligned["length"].astype(np.int64)
+        joined.append(aligned)
+    chunksize = chunksize or max(len(patient_ids), 1)
+    for start in range(0, len(patient_ids), chunksize):
+        yield [
+            frame.iloc[start : start + chunksize].reset_index(drop=True)
+            for frame in joined
+        ]
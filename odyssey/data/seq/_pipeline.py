@@ -0,0 +1,183 @@
+"""Pipeline of the stages creating the patient sequences of a chunk."""
+
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from odyssey.data.seq._data_containers import PatientData
+from odyssey.data.seq._timing import StageTimer
+
+
+@dataclass
+class ChunkBatch:
+    """A chunk of patients, passed through the stages of a pipeline.
+
+    Parameters
+    ----------
+    patient_data : PatientData
+        Patient data of the chunk
+    after_death_events : List[str]
+        IDs of the patients with events after their death, which are skipped.
+        The patients of the chunk with such events are added to it.
+    min_events : int, optional
+        Patients with at most this number of events are skipped, by default 0
+    min_visits : int, optional
+        Patients with at most this number of visits are skipped, by default 0
+    pad_events : bool, optional
+        Whether to pad the truncated event tokens, by default False
+    round_number : Optional[int], optional
+        Round of the chunk, by default None
+    sequences : Optional[pd.DataFrame], optional
+        The sequences of the chunk, one row per patient, once created
+    state : Dict[str, Any], optional
+        Intermediate results passed between the stages, such as the flat
+        tables of the columnar engine
+
+    """
+
+    patient_data: PatientData
+    after_death_events: List[str]
+    min_events: int = 0
+    min_visits: int = 0
+    pad_events: bool = False
+    round_number: Optional[int] = None
+    sequences: Optional[pd.DataFrame] = None
+    state: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def num_rows(self) -> int:
+        """Get the number of sequences, or of patients before they are created."""
+        if self.sequences is not None:
+            return len(self.sequences)
+        return len(self.patient_data.patients)
+
+
+@dataclass(frozen=True)
+class Stage:
+    """A stage of a pipeline, consuming and producing a whole chunk batch.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, unique in its pipeline and used in the run report
+    run : Callable[[ChunkBatch], ChunkBatch]
+        Function processing the batch, which may update it in place
+    requires : Tuple[str, ...], optional
+        Names of the stages whose outputs are used by this one, by default ()
+    columns : Tuple[str, ...], optional
+        Columns added by the stage to the sequences, which are saved with the
+        label columns, by default ()
+
+    """
+
+    name: str
+    run: Callable[[ChunkBatch], ChunkBatch]
+    requires: Tuple[str, ...] = ()
+    columns: Tuple[str, ...] = ()
+
+
+class StagePipeline:
+    """Run stages on chunk batches, in an order satisfying their requirements.
+
+    The stages form a directed acyclic graph through their requirements. They
+    run in the order in which they are given, except that a stage is delayed
+    until the stages it requires have run. Each stage is timed with the stage
+    timer, and stages that nothing requires can be skipped.
+
+    Parameters
+    ----------
+    stages : List[Stage]
+        The stages
+    stage_timer : StageTimer
+        Timer recording the stages of each chunk
+    skip : Optional[Iterable[str]], optional
+        Names of the stages skipped on every run, by default None
+
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        stage_timer: StageTimer,
+        skip: Optional[Iterable[str]] = None,
+    ):
+        """Initialize the stage pipeline."""
+        self.stages: Dict[str, Stage] = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Stage {stage.name} is defined more than once.")
+            self.stages[stage.name] = stage
+        for stage in stages:
+            unknown = set(stage.requires).difference(self.stages)
+            if unknown:
+                raise ValueError(
+                    f"Stage {stage.name} requires unknown stages {sorted(unknown)}.",
+                )
+        self.order = self._sort()
+        self.stage_timer = stage_timer
+        self.skip = frozenset(skip or ())
+        self.stages_to_run(())
+
+    def _sort(self) -> List[str]:
+        """Sort the stages topologically, keeping their order where possible."""
+        order: List[str] = []
+        pending = list(self.stages)
+        while pending:
+            for name in pending:
+                if set(self.stages[name].requires).issubset(order):
+                    order.append(name)
+                    pending.remove(name)
+                    break
+            else:
+                raise ValueError(f"The requirements of stages {pending} form a cycle.")
+        return order
+
+    def stages_to_run(self, skip: Iterable[str]) -> List[Stage]:
+        """Get the stages of a run, in order, without the skipped ones.
+
+        Parameters
+        ----------
+        skip : Iterable[str]
+            Names of the stages skipped in addition to those of the pipeline
+
+        Returns
+        -------
+        List[Stage]
+            The stages to run.
+
+        """
+        skip = self.skip.union(skip)
+        unknown = skip.difference(self.stages)
+        if unknown:
+            raise ValueError(f"Cannot skip unknown stages {sorted(unknown)}.")
+        stages = [self.stages[name] for name in self.order if name not in skip]
+        for stage in stages:
+            skipped = skip.intersection(stage.requires)
+            if skipped:
+                raise ValueError(
+                    f"Cannot skip stages {sorted(skipped)} required by {stage.name}.",
+                )
+        return stages
+
+    def run(self, batch: ChunkBatch, skip: Iterable[str] = ()) -> ChunkBatch:
+        """Run the stages on a batch.
+
+        Parameters
+        ----------
+        batch : ChunkBatch
+            The batch
+        skip : Iterable[str], optional
+            Names of the stages skipped in this run, by default ()
+
+        Returns
+        -------
+        ChunkBatch
+            The batch output by the last stage.
+
+        """
+        for stage in self.stages_to_run(skip):
+            with self.stage_timer.stage(stage.name, batch.num_rows) as record:
+                batch = stage.run(batch)
+                record["rows_out"] = batch.num_rows
+        return batch
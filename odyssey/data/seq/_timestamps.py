@@ -0,0 +1,133 @@
+"""Timestamps of the patient sequences, parsed once to epoch seconds."""
+
+import calendar
+import re
+from datetime import datetime
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+from dateutil import parser
+
+
+# Seconds in a day, to turn epoch seconds into days.
+DAY = 24 * 3600
+# ISO dates and datetimes with an optional UTC offset, parsed without dateutil.
+ISO_DATETIME = re.compile(
+    r"(?P<local>\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?)"
+    r"(?:Z|(?P<sign>[+-])(?P<hours>\d{2}):?(?P<minutes>\d{2}))?",
+)
+
+
+def to_epoch(timestamp: datetime) -> int:
+    """Convert a datetime to epoch seconds, naive datetimes being in UTC.
+
+    Parameters
+    ----------
+    timestamp : datetime
+        The datetime.
+
+    Returns
+    -------
+    int
+        The seconds since the epoch.
+
+    """
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def _parse_fallback(date: str) -> Tuple[int, int]:
+    """Parse a datetime that is not in ISO format with dateutil."""
+    timestamp = parser.parse(date)
+    return to_epoch(timestamp), to_epoch(timestamp.replace(tzinfo=None))
+
+
+class EpochIndex:
+    """Epoch seconds of the date strings of a chunk of patients.
+
+    Each distinct date string is parsed once, and its epoch seconds are then
+    looked up by the processors, which compare and subtract integers. ISO
+    datetimes are parsed with vectorized operations, and other formats are
+    parsed one by one with dateutil.
+
+    Parameters
+    ----------
+    dates : Iterable[str]
+        The date strings to parse. Missing values are ignored.
+
+    """
+
+    def __init__(self, dates: Iterable[str]):
+        """Parse the distinct date strings."""
+        unique = pd.unique(
+            pd.Series([date for date in dates if isinstance(date, str)], dtype=object),
+        )
+        parts = pd.Series(unique, dtype=object).str.fullmatch(ISO_DATETIME)
+        iso = parts.fillna(False).to_numpy(dtype=bool)
+        fields = pd.Series(unique[iso], dtype=object).str.extract(ISO_DATETIME)
+        local = (
+            fields["local"].to_numpy(dtype=str).astype("datetime64[s]").astype(np.int64)
+        )
+        offsets = (
+            fields["hours"].astype(float).fillna(0) * 3600
+            + fields["minutes"].astype(float).fillna(0) * 60
+        ).to_numpy()
+        offsets = np.where(fields["sign"] == "-", -offsets, offsets).astype(np.int64)
+        self.epochs: Dict[str, Tuple[int, int]] = dict(
+            zip(unique[iso], zip((local - offsets).tolist(), local.tolist())),
+        )
+        self.num_fallbacks = int((~iso).sum())
+        for date in unique[~iso]:
+            self.epochs[date] = _parse_fallback(date)
+
+    def __len__(self) -> int:
+        """Get the number of distinct date strings."""
+        return len(self.epochs)
+
+    def utc(self, date: str) -> int:
+        """Get the UTC epoch seconds of a date string.
+
+        Parameters
+        ----------
+        date : str
+            The date string, in the index.
+
+        Returns
+        -------
+        int
+            The seconds since the epoch, taking the UTC offset into account.
+
+        """
+        return self.epochs[date][0]
+
+    def local(self, date: str) -> int:
+        """Get the local epoch seconds of a date string, ignoring its UTC offset.
+
+        Parameters
+        ----------
+        date : str
+            The date string, in the index.
+
+        Returns
+        -------
+        int
+            The seconds since the epoch of the local time.
+
+        """
+        return self.epochs[date][1]
+
+    def local_day(self, date: str) -> int:
+        """Get the days since the epoch of the local date of a date string.
+
+        Parameters
+        ----------
+        date : str
+            The date string, in the index.
+
+        Returns
+        -------
+        int
+            The days since the epoch.
+
+        """
+        return self.epochs[date][1] // DAY
@@ -0,0 +1,136 @@
+"""Time the stages of the sequence generation, for a run report."""
+
+import json
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+
+def peak_rss() -> Optional[int]:
+    """Get the peak resident set size of the process, in bytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageTimer:
+    """Record the wall time, rows and peak memory growth of stages.
+
+    Each record has the round of the chunk, the stage, its wall time in
+    seconds, the rows it reads and outputs and the output rows per second,
+    and the growth of the peak RSS of the process during the stage, in bytes.
+    The stages of a chunk count its patients until the sequences are created,
+    and then its sequences. Recording takes two clock reads and two
+    ``getrusage`` calls per stage.
+
+    """
+
+    def __init__(self) -> None:
+        """Initialize the stage timer."""
+        self.round_number: Optional[int] = None
+        self.records: List[Dict[str, Any]] = []
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int) -> Iterator[Dict[str, Any]]:
+        """Time a stage, whose output rows are set in the yielded record.
+
+        Parameters
+        ----------
+        name : str
+            The stage.
+        rows_in : int
+            The rows read by the stage, which are also its output rows unless
+            ``rows_out`` is set in the record.
+
+        Yields
+        ------
+        Dict[str, Any]
+            The record of the stage.
+
+        """
+        record: Dict[str, Any] = {"rows_out": rows_in}
+        start_rss = peak_rss()
+        start = time.perf_counter()
+        yield record
+        seconds = time.perf_counter() - start
+        end_rss = peak_rss()
+        rows_out = record["rows_out"]
+        self.records.append(
+            {
+                "round": (
+                    int(self.round_number) if self.round_number is not None else None
+                ),
+                "stage": name,
+                "seconds": round(seconds, 6),
+                "rows_in": int(rows_in),
+                "rows_out": int(rows_out),
+                "rows_per_second": round(rows_out / seconds, 1) if seconds else None,
+                "peak_rss_delta": (
+                    end_rss - start_rss
+                    if start_rss is not None and end_rss is not None
+                    else None
+                ),
+            },
+        )
+
+    def pop_records(self) -> List[Dict[str, Any]]:
+        """Remove and return the records."""
+        records, self.records = self.records, []
+        return records
+
+
+def write_report(path: str, records: List[Dict[str, Any]], mode: str = "a") -> None:
+    """Write stage records to a JSON lines run report.
+
+    Parameters
+    ----------
+    path : str
+        The path of the report.
+    records : List[Dict[str, Any]]
+        The stage records.
+    mode : str, optional
+        The mode of opening the report, by default "a" which appends to it
+
+    """
+    with open(path, mode) as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def summarize(records: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """Sum the time and output rows of each stage over rounds.
+
+    Parameters
+    ----------
+    records : List[Dict[str, Any]]
+        The stage records.
+
+    Returns
+    -------
+    Dict[str, Dict[str, float]]
+        The total seconds and output rows, and the largest peak RSS growth of
+        each stage, in the order in which the stages first ran.
+
+    """
+    summary: Dict[str, Dict[str, float]] = defaultdict(
+        lambda: {"seconds": 0.0, "rows_out": 0, "peak_rss_delta": 0},
+    )
+    for record in records:
+        stage = summary[record["stage"]]
+        stage["seconds"] += record["seconds"]
+        stage["rows_out"] += record["rows_out"]
+        stage["peak_rss_delta"] = max(
+            stage["peak_rss_delta"],
+            record["peak_rss_delta"] or 0,
+        )
+    return dict(summary)
@@ -1,8 +1,12 @@
 """Token generation for the patient sequences."""
 
 from dataclasses import dataclass, field
-from typing import Dict, List
+from itertools import chain
+from typing import Dict, List, Tuple, Union
 
+import numpy as np
+import pandas as pd
+import pyarrow as pa
 from dateutil import parser
 
 from odyssey.data.constants import (
@@ -25,6 +29,24 @@ from odyssey.data.constants import (
 )
 
 
+TIME_DELTA_PREFIXES = ("[W_", "[M_", "[LT")
+TOKEN_DTYPES = {
+    "event_tokens": object,
+    "type_tokens": np.int64,
+    "age_tokens": np.int64,
+    "time_tokens": np.int64,
+    "visit_tokens": np.int64,
+    "position_tokens": np.int64,
+    "elapsed_tokens": np.float64,
+}
+
+
+def _ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Concatenate the ranges ``starts[i], ..., starts[i] + lengths[i] - 1``."""
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + np.arange(int(lengths.sum())) - offsets
+
+
 @dataclass
 class TokenConfig:
     """Token configuration for the patient sequences.
@@ -96,13 +118,232 @@ class TokenConfig:
         ] + self.time_delta_tokens
 
 
+def flatten_tokens(
+    sequences: pd.DataFrame,
+) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    """Flatten the token lists of some sequences into token columns.
+
+    Parameters
+    ----------
+    sequences : pd.DataFrame
+        The sequences, with their untruncated token lists
+
+    Returns
+    -------
+    Tuple[Dict[str, np.ndarray], np.ndarray]
+        The flat token columns of all the sequences, and the offset of each
+        sequence in them.
+
+    """
+    lengths = np.fromiter(
+        map(len, sequences["event_tokens"]),
+        dtype=np.int64,
+        count=len(sequences),
+    )
+    tokens = {}
+    for name, dtype in TOKEN_DTYPES.items():
+        values = np.empty(int(lengths.sum()), dtype=dtype)
+        values[:] = list(chain.from_iterable(sequences[name]))
+        tokens[name] = values
+    return tokens, np.cumsum(lengths) - lengths
+
+
+def _truncate_flat(
+    tokens: Dict[str, np.ndarray],
+    offsets: np.ndarray,
+    max_length: int,
+    token_config: TokenConfig,
+    pad_events: bool = False,
+) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    """Truncate or pad flat token columns, see ``truncate_or_pad``.
+
+    Returns
+    -------
+    Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]
+        The flat truncated token columns, and the bounds of the sequences in
+        each of them, with one more bound than sequences.
+
+    """
+    type_ids = token_config.token_type_mapping
+    event_tokens = tokens["event_tokens"]
+    lengths = np.diff(np.append(offsets, len(event_tokens)))
+    truncated = lengths > max_length
+    starts = np.where(truncated, lengths - max_length + 2, 0)
+    start_tokens = event_tokens[offsets + starts]
+    starts += (
+        np.select(
+            [
+                start_tokens == token_config.visit_end_token,
+                start_tokens == token_config.register_token,
+                np.array(
+                    [token.startswith(TIME_DELTA_PREFIXES) for token in start_tokens]
+                ),
+            ],
+            [3, 2, 1],
+            0,
+        )
+        * truncated
+    )
+    add_visit_start = truncated & (
+        event_tokens[offsets + starts] != token_config.visit_start_token
+    )
+    # Each sequence is a class token, a visit start token and a window.
+    segment_starts = np.stack([offsets, offsets + starts, offsets + starts], axis=1)
+    segment_lengths = np.stack(
+        [truncated, add_visit_start, lengths - starts],
+        axis=1,
+    ).astype(np.int64)
+    source = _ranges(segment_starts.ravel(), segment_lengths.ravel())
+    new_lengths = segment_lengths.sum(axis=1)
+    new_offsets = np.cumsum(new_lengths) - new_lengths
+    window = {name: values[source] for name, values in tokens.items()}
+
+    visit_starts = new_offsets[add_visit_start] + 1
+    window["event_tokens"][visit_starts] = token_config.visit_start_token
+    window["type_tokens"][visit_starts] = type_ids[VISIT_START]
+    window["elapsed_tokens"][visit_starts] = -1.0
+
+    group = np.repeat(np.arange(len(new_lengths)), new_lengths)
+    in_group = np.arange(len(group)) - new_offsets[group]
+    is_visit_start = window["event_tokens"] == token_config.visit_start_token
+    counts = np.cumsum(is_visit_start)
+    counts -= (counts - is_visit_start)[new_offsets][group]
+    recompute = truncated[group]
+    window["position_tokens"] = np.where(
+        recompute,
+        counts,
+        window["position_tokens"],
+    )
+    window["visit_tokens"] = np.where(
+        recompute,
+        np.where(in_group == 0, 0, np.where(counts % 2 == 1, 2, 1)),
+        window["visit_tokens"],
+    )
+
+    bounds = np.append(new_offsets, len(group))
+    padded_bounds = np.arange(len(new_lengths) + 1) * max_length
+    columns, column_bounds = {}, {}
+    for name, values in window.items():
+        if name == "elapsed_tokens" or (name == "event_tokens" and not pad_events):
+            columns[name], column_bounds[name] = values, bounds
+            continue
+        fill = token_config.pad_token if name == "event_tokens" else 0
+        padded = np.full(
+            (len(new_lengths), max_length),
+            fill,
+            dtype=values.dtype,
+        )
+        padded[group, in_group] = values
+        columns[name], column_bounds[name] = padded.ravel(), padded_bounds
+    return columns, column_bounds
+
+
+def truncate_or_pad(
+    tokens: Dict[str, np.ndarray],
+    offsets: np.ndarray,
+    max_length: int,
+    token_config: TokenConfig,
+    pad_events: bool = False,
+) -> Dict[str, List[np.ndarray]]:
+    """Keep the most recent tokens of the sequences longer than a maximum.
+
+    Truncated sequences start with a class token and a visit start token,
+    and their visit and position tokens are recomputed. The type, age,
+    time, visit and position tokens are padded to the maximum length. All
+    the sequences are truncated at once, by slicing the flat token columns.
+
+    Parameters
+    ----------
+    tokens : Dict[str, np.ndarray]
+        The flat token columns of the untruncated sequences
+    offsets : np.ndarray
+        The offset of each sequence in the token columns
+    max_length : int
+        Maximum sequence length
+    token_config : TokenConfig
+        Token configuration
+    pad_events : bool, optional
+        Whether to pad the truncated event tokens, by default False
+
+    Returns
+    -------
+    Dict[str, List[np.ndarray]]
+        The truncated token lists of each sequence.
+
+    """
+    columns, column_bounds = _truncate_flat(
+        tokens,
+        offsets,
+        max_length,
+        token_config,
+        pad_events,
+    )
+    return {
+        name: np.split(values, column_bounds[name][1:-1]) if len(offsets) else []
+        for name, values in columns.items()
+    }
+
+
+def truncate_table(
+    table: pa.Table,
+    max_length: int,
+    token_config: TokenConfig,
+    pad_events: bool = False,
+) -> pa.Table:
+    """Add the truncated token columns of a max length to a table of sequences.
+
+    The token list columns are truncated on their flat values and offsets,
+    without converting the sequences to Python lists.
+
+    Parameters
+    ----------
+    table : pa.Table
+        The sequences, with their untruncated token list columns
+    max_length : int
+        Maximum sequence length
+    token_config : TokenConfig
+        Token configuration
+    pad_events : bool, optional
+        Whether to pad the truncated event tokens, by default False
+
+    Returns
+    -------
+    pa.Table
+        The table with the ``*_tokens_{max_length}`` columns.
+
+    """
+    tokens = {}
+    for name, dtype in TOKEN_DTYPES.items():
+        column = table.column(name).combine_chunks()
+        offsets = column.offsets.to_numpy()
+        tokens[name] = column.flatten().to_numpy(zero_copy_only=False).astype(dtype)
+    offsets = (offsets - offsets[0])[:-1].astype(np.int64)
+    columns, column_bounds = _truncate_flat(
+        tokens,
+        offsets,
+        max_length,
+        token_config,
+        pad_events,
+    )
+    for name, values in columns.items():
+        table = table.append_column(
+            f"{name}_{max_length}",
+            pa.ListArray.from_arrays(
+                pa.array(column_bounds[name], type=pa.int32()),
+                pa.array(values),
+            ),
+        )
+    return table
+
+
 class TokenGenerator:
     """Generate tokens for the patient sequences.
 
     Parameters
     ----------
-    max_seq_length : int
-        Maximum sequence length
+    max_seq_length : Union[int, List[int]]
+        Maximum sequence length, or a list of them, the first one being the
+        primary length
     token_config : TokenConfig
         Token configuration, by default TokenConfig()
     reference_time : str
@@ -112,19 +353,240 @@ class TokenGenerator:
 
     def __init__(
         self,
-        max_seq_length: int,
+        max_seq_length: Union[int, List[int]],
         token_config: TokenConfig,
         reference_time: str,
     ):
         """Initialize the token generator."""
-        self.max_seq_length = max_seq_length
+        if isinstance(max_seq_length, int):
+            max_seq_length = [max_seq_length]
+        self.max_seq_lengths = list(max_seq_length)
+        self.max_seq_length = self.max_seq_lengths[0]
         self.token_config = token_config
         self.reference_time = parser.parse(reference_time)
 
-    def add_tokens(self, events, encounters):
-        """Add tokens to the events."""
-        pass
+    def _add_row_tokens(
+        self,
+        row: pd.Series,
+        encounter_row: pd.Series,
+    ) -> pd.Series:
+        """Add tokens to the events.
+
+        Parameters
+        ----------
+        row : pd.Series
+            Combined events row
+        encounter_row : pd.Series
+            Encounter row
+
+        Returns
+        -------
+        pd.Series
+            Updated row with tokens
+        """
+        events = row["proc_codes"]
+        if len(events) == 0:
+            row["event_tokens"] = []
+            row["age_tokens"] = []
+            row["time_tokens"] = []
+            row["visit_tokens"] = []
+            row["type_ids"] = []
+            row["position_tokens"] = []
+            row["num_visits"] = 0
+            return row
+
+        events_encounters = row["encounter_ids"]
+        events_types = row["type_ids"]
+        events_elapsed_time = row["elapsed_time"]
+        ecounters = encounter_row["encounter_ids"]
+        intervals = encounter_row["intervals"]
+        eq_encounters = encounter_row["eq_encounters"]
+        age_mapping = dict(zip(ecounters, encounter_row["ages"]))
+        time_mapping = dict(zip(ecounters, encounter_row["times"]))
+
+        event_tokens = [self.token_config.class_token]
+        type_tokens = [self.token_config.token_type_mapping.get(CLASS)]
+        age_tokens = [0]
+        time_tokens = [0]
+        visit_segments = [0]
+        position_tokens = [0]
+        elapsed_tokens = [-2]
+
+        segment_value = 1
+        position_value = 0
+
+        prev_encounter = None
+
+        for event, event_encounter, event_type, elapsed_time in zip(
+            events,
+            events_encounters,
+            events_types,
+            events_elapsed_time,
+        ):
+            is_different_encounter = event_encounter != prev_encounter
+            has_no_equal = event_encounter not in eq_encounters
+            is_not_equal = prev_encounter not in eq_encounters.get(event_encounter, [])
+
+            if is_different_encounter and (has_no_equal or is_not_equal):
+                if prev_encounter is not None:
+                    # Adding Visit End Token
+                    event_tokens.append(self.token_config.visit_end_token)
+                    type_tokens.append(
+                        self.token_config.token_type_mapping.get(VISIT_END)
+                    )
+                    age_tokens.append(age_mapping[prev_encounter])
+                    time_tokens.append(time_mapping[prev_encounter])
+                    visit_segments.append(segment_value)
+                    position_tokens.append(position_value)
+                    elapsed_tokens.append(-2)
+
+                    # Adding Register Token
+                    event_tokens.append(self.token_config.register_token)
+                    type_tokens.append(
+                        self.token_config.token_type_mapping.get(REGISTER)
+                    )
+                    age_tokens.append(age_mapping[prev_encounter])
+                    time_tokens.append(time_mapping[prev_encounter])
+                    visit_segments.append(segment_value)
+                    position_tokens.append(position_value)
+                    elapsed_tokens.append(-2)
+
+                    # Adding interval token
+                    event_tokens.append(intervals[event_encounter])
+                    type_tokens.append(
+                        self.token_config.token_type_mapping.get(TIME_DELTA)
+                    )
+                    age_tokens.append(0)
+                    time_tokens.append(0)
+                    visit_segments.append(0)
+                    position_tokens.append(position_value)
+                    elapsed_tokens.append(-2)
+
+                # Adding Visit Start Token
+                event_tokens.append(self.token_config.visit_start_token)
+                type_tokens.append(
+                    self.token_config.token_type_mapping.get(VISIT_START)
+                )
+                age_tokens.append(age_mapping[event_encounter])
+                time_tokens.append(time_mapping[event_encounter])
+                elapsed_tokens.append(-1)
+
+                segment_value = 1 if segment_value == 2 else 2
+                visit_segments.append(segment_value)
+
+                if len(event_tokens) == 1 or event_tokens[-2] != "W0":
+                    position_value = position_value + 1
+                position_tokens.append(position_value)
+
+            # Adding intermediate tokens
+            event_tokens.append(event)
+            type_tokens.append(event_type)
+            age_tokens.append(age_mapping[event_encounter])
+            time_tokens.append(time_mapping[event_encounter])
+            visit_segments.append(segment_value)
+            position_tokens.append(position_value)
+            elapsed_tokens.append(elapsed_time)
+            prev_encounter = event_encounter
+
+        # Adding Visit End Token
+        event_tokens.append(self.token_config.visit_end_token)
+        type_tokens.append(self.token_config.token_type_mapping.get(VISIT_END))
+        age_tokens.append(age_mapping[event_encounter])
+        time_tokens.append(time_mapping[event_encounter])
+        visit_segments.append(segment_value)
+        position_tokens.append(position_value)
+        elapsed_tokens.append(-2)
+
+        # Adding Register Token
+        event_tokens.append(self.token_config.register_token)
+        type_tokens.append(self.token_config.token_type_mapping.get(REGISTER))
+        age_tokens.append(age_mapping[event_encounter])
+        time_tokens.append(time_mapping[event_encounter])
+        visit_segments.append(segment_value)
+        position_tokens.append(position_value)
+        elapsed_tokens.append(-2)
+
+        assert (
+            len(event_tokens)
+            == len(type_tokens)
+            == len(age_tokens)
+            == len(time_tokens)
+            == len(visit_segments)
+            == len(position_tokens)
+            == len(elapsed_tokens)
+        )
+
+        row["token_length"] = len(event_tokens)
+        row["event_tokens"] = event_tokens
+        row["type_tokens"] = type_tokens
+        row["age_tokens"] = age_tokens
+        row["time_tokens"] = time_tokens
+        row["visit_tokens"] = visit_segments
+        row["position_tokens"] = position_tokens
+        row["elapsed_tokens"] = elapsed_tokens
+        row["num_visits"] = len(set(position_tokens)) - 1
+        return row
+
+    def add_tokens(
+        self,
+        events: pd.DataFrame,
+        encounters: pd.DataFrame,
+    ) -> pd.DataFrame:
+        """Add the tokens of the combined events of a chunk.
+
+        Parameters
+        ----------
+        events : pd.DataFrame
+            The combined events, one row per patient, indexed like the
+            encounters
+        encounters : pd.DataFrame
+            The processed encounters of the chunk
+
+        Returns
+        -------
+        pd.DataFrame
+            The events with their untruncated token lists.
+
+        """
+        return events.apply(
+            lambda row: self._add_row_tokens(row, encounters.iloc[row.name]),
+            axis=1,
+        )
+
+    def truncate_or_pad(
+        self,
+        events: pd.DataFrame,
+        pad_events: bool = False,
+    ) -> pd.DataFrame:
+        """Add the truncated token columns of each max sequence length.
+
+        The token lists are flattened once, and truncated to every length by
+        slicing the flat token columns.
+
+        Parameters
+        ----------
+        events : pd.DataFrame
+            The sequences, with their untruncated token lists
+        pad_events : bool, optional
+            Whether to pad the truncated event tokens, by default False
+
+        Returns
+        -------
+        pd.DataFrame
+            The sequences with the ``*_tokens_{max_length}`` columns.
 
-    def truncate_or_pad(self, events, pad_events=False):
-        """Truncate or pad the events."""
-        pass
+        """
+        if len(events) == 0:
+            return events
+        tokens, offsets = flatten_tokens(events)
+        truncated = {}
+        for max_length in self.max_seq_lengths:
+            for name, values in truncate_or_pad(
+                tokens,
+                offsets,
+                max_length,
+                self.token_config,
+                pad_events,
+            ).items():
+                truncated[f"{name}_{max_length}"] = values
+        return events.assign(**truncated)
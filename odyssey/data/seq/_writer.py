@@ -0,0 +1,202 @@
+"""Stream the sequence files of the rounds into compact parquet outputs."""
+
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from odyssey.data.seq._partition import shard_ids
+
+
+def unify_schema(paths: List[str]) -> pa.Schema:
+    """Get a schema of all the columns of some sequence files.
+
+    Columns missing from some files, such as the days to death of chunks
+    without deceased patients, are kept, and integer columns that are floats
+    in other files are promoted. The pandas index is dropped.
+
+    Parameters
+    ----------
+    paths : List[str]
+        The paths of the files, whose footers only are read.
+
+    Returns
+    -------
+    pa.Schema
+        The schema, without pandas metadata.
+
+    """
+    schema = pa.unify_schemas(
+        [pq.read_schema(path).remove_metadata() for path in paths],
+        promote_options="permissive",
+    )
+    return pa.schema(
+        [field for field in schema if not field.name.startswith("__index_level_")],
+    )
+
+
+def conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Conform a table to a schema, with missing columns as nulls.
+
+    Parameters
+    ----------
+    table : pa.Table
+        The table.
+    schema : pa.Schema
+        The schema, with all the columns of the table.
+
+    Returns
+    -------
+    pa.Table
+        The table with the columns and types of the schema.
+
+    """
+    columns = [
+        table.column(field.name).cast(field.type)
+        if field.name in table.column_names
+        else pa.nulls(table.num_rows, type=field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class SequenceWriter:
+    """Stream tables of sequences to a parquet file, in row groups of a size.
+
+    Small tables are buffered until they fill a row group, so the file has
+    row groups of ``row_group_size`` rows, except for the last one.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file
+    schema : pa.Schema
+        Schema of the file, to which the tables are conformed
+    row_group_size : int
+        Number of rows of each row group
+    compression : str
+        Compression codec of the file
+    metadata_collector : Optional[List[pq.FileMetaData]], optional
+        List to which the metadata of the file is appended when it is closed,
+        by default None
+
+    """
+
+    def __init__(
+        self,
+        path: str,
+        schema: pa.Schema,
+        row_group_size: int,
+        compression: str,
+        metadata_collector: Optional[List[pq.FileMetaData]] = None,
+    ):
+        """Initialize the sequence writer."""
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.writer = pq.ParquetWriter(
+            path,
+            schema,
+            compression=compression,
+            metadata_collector=metadata_collector,
+        )
+        self.buffer: List[pa.Table] = []
+        self.num_buffered = 0
+
+    def write(self, table: pa.Table) -> None:
+        """Buffer a table, and write the row groups it fills."""
+        self.buffer.append(conform(table, self.schema))
+        self.num_buffered += table.num_rows
+        if self.num_buffered >= self.row_group_size:
+            buffered = pa.concat_tables(self.buffer)
+            size = self.num_buffered - self.num_buffered % self.row_group_size
+            self.writer.write_table(
+                buffered.slice(0, size),
+                row_group_size=self.row_group_size,
+            )
+            self.buffer = [buffered.slice(size)]
+            self.num_buffered -= size
+
+    def close(self) -> None:
+        """Write the buffered rows and close the file."""
+        if self.num_buffered > 0:
+            self.writer.write_table(pa.concat_tables(self.buffer))
+        self.buffer = []
+        self.num_buffered = 0
+        self.writer.close()
+
+
+def compact_sequences(
+    paths: List[str],
+    output_path: str,
+    row_group_size: int,
+    compression: str = "snappy",
+    num_partitions: Optional[int] = None,
+) -> None:
+    """Stream sequence files into one parquet file or a partitioned dataset.
+
+    The files are read one row group at a time, in order, so the sequences of
+    the output are in the same order as in the files.
+
+    Parameters
+    ----------
+    paths : List[str]
+        The paths of the sequence files.
+    output_path : str
+        The path of the parquet file, or of the directory of the dataset.
+    row_group_size : int
+        The number of rows of each row group.
+    compression : str, optional
+        The compression codec, by default "snappy"
+    num_partitions : Optional[int], optional
+        The number of partitions of the dataset, by default None which writes
+        a single file. Otherwise, the patients are partitioned by a hash of
+        their IDs, as the shards of the data files, into the hive partitions
+        ``shard=<k>`` of the dataset, and the footers of the files are
+        collected in its ``_metadata`` file.
+
+    """
+    schema = unify_schema(paths)
+    writers: Dict[int, SequenceWriter] = {}
+    metadata_collector: List[pq.FileMetaData] = []
+    if num_partitions is None:
+        writers[0] = SequenceWriter(output_path, schema, row_group_size, compression)
+    try:
+        for path in paths:
+            parquet_file = pq.ParquetFile(path)
+            for row_group in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(row_group)
+                if num_partitions is None:
+                    writers[0].write(table)
+                    continue
+                shards = shard_ids(
+                    table.column("patient_id").to_pandas(),
+                    num_partitions,
+                )
+                for shard in np.unique(shards).tolist():
+                    if shard not in writers:
+                        partition = os.path.join(output_path, f"shard={shard}")
+                        os.makedirs(partition, exist_ok=True)
+                        writers[shard] = SequenceWriter(
+                            os.path.join(partition, "part-0.parquet"),
+                            schema,
+                            row_group_size,
+                            compression,
+                            metadata_collector,
+                        )
+                    writers[shard].write(table.filter(pa.array(shards == shard)))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    if num_partitions is None:
+        return
+    os.makedirs(output_path, exist_ok=True)
+    for shard, metadata in zip(writers, metadata_collector):
+        metadata.set_file_path(f"shard={shard}/part-0.parquet")
+    pq.write_metadata(schema, os.path.join(output_path, "_common_metadata"))
+    pq.write_metadata(
+        schema,
+        os.path.join(output_path, "_metadata"),
+        metadata_collector=metadata_collector,
+    )
@@ -4,30 +4,52 @@ import json
 import logging
 import math
 import os
+import re
+import shutil
 import time
-from ast import literal_eval
-from datetime import datetime
-from typing import Any, List, Optional, Union
+from collections import deque
+from itertools import chain
+from multiprocessing import Pool
+from multiprocessing.pool import AsyncResult
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 import pandas as pd
-from dateutil import parser
-
-from odyssey.data.constants import (
-    CLASS,
-    LAB,
-    MED,
-    PAD,
-    PROC,
-    REGISTER,
-    TIME_DELTA,
-    VISIT_END,
-    VISIT_START,
-)
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from odyssey.data.constants import LAB, MED, PROC
+from odyssey.data.io import iter_parquet, parquet_files, parse_literal
+from odyssey.data.seq._budget import ChunkBudget, count_items, memory_usage
+from odyssey.data.seq._columnar import ColumnarEngine
 from odyssey.data.seq._data_containers import EventData, PatientData
+from odyssey.data.seq._encoding import ConceptEncoder
 from odyssey.data.seq._encounters import EncounterProcessor
-from odyssey.odyssey.data.seq._events import EventProcessor
-from odyssey.odyssey.data.seq._tokens import TokenConfig, TokenGenerator
+from odyssey.data.seq._events import EventProcessor
+from odyssey.data.seq._fingerprints import (
+    fingerprint_path,
+    fingerprint_rows,
+    read_fingerprints,
+    write_fingerprints,
+)
+from odyssey.data.seq._labels import LabelAssigner
+from odyssey.data.seq._partition import partition_inputs, read_shard
+from odyssey.data.seq._pipeline import ChunkBatch, Stage, StagePipeline
+from odyssey.data.seq._timestamps import EpochIndex
+from odyssey.data.seq._timing import StageTimer, summarize, write_report
+from odyssey.data.seq._tokens import TokenConfig, TokenGenerator, truncate_table
+from odyssey.data.seq._writer import compact_sequences
 from odyssey.utils.log import setup_logging
 
 
@@ -36,65 +58,85 @@ LOGGER = logging.getLogger(__name__)
 setup_logging(print_level="INFO", logger=LOGGER)
 
 
-def _to_list(input_value: Union[np.ndarray, List]) -> Any:
-    """Convert the input value to a list if it is an instance of numpy array.
-
-    Parameters
-    ----------
-    input_value : Union[np.ndarray, List]
-        Input value.
+# Data files read by the generator, the first one having a row per patient.
+INPUT_FILES = [
+    "inpatient",
+    "encounters",
+    "procedures",
+    "med_requests",
+    "processed_labs",
+    "conditions",
+]
+# Rounds, sequences, after death patient IDs and stage records of a task, and the
+# patients, events and bytes of each of its rounds.
+TaskResult = Tuple[
+    int,
+    int,
+    List[str],
+    List[Dict[str, Any]],
+    List[Tuple[int, int, int]],
+]
+# Generator of the worker processes, copied once when they start.
+_WORKER_GENERATOR: Optional["PatientSequenceGenerator"] = None
+
+
+def _init_worker(generator: "PatientSequenceGenerator") -> None:
+    """Set the generator of a worker process."""
+    global _WORKER_GENERATOR  # noqa: PLW0603
+    _WORKER_GENERATOR = generator
+
+
+def _run_task(method: str, *args: Any) -> TaskResult:
+    """Run a task of the generator of a worker process.
 
     Returns
     -------
-    Any
-        Converted value
+    TaskResult
+        The number of rounds and of saved sequences of the task, the IDs of the
+        patients with events after their death, the records of its stages and
+        the sizes of its rounds.
 
     """
-    return input_value.tolist() if isinstance(input_value, np.ndarray) else input_value
+    return getattr(_WORKER_GENERATOR, method)(*args)
 
 
 class SequenceSaver:
-    """Save patient sequences to disk."""
-
-    def __init__(self, save_dir):
-        """Initialize the sequence saver."""
-        self.save_dir = save_dir
+    """Save patient sequences to disk.
 
-    def save_sequences(self, sequences, round_number):
-        """Save the patient sequences to disk."""
-        pass
+    The sequences of each round are saved with all their tokens in the "all"
+    directory, and with the tokens truncated to each max sequence length in
+    the directory of the length.
 
+    Parameters
+    ----------
+    save_dir : str
+        Directory to save the sequences
+    max_seq_lengths : List[int]
+        Maximum sequence lengths, each with its directory
+    label_columns : Optional[List[str]], optional
+        Columns of additional labels saved in every directory, by default None
 
-class PatientSequenceGenerator:
-    """Generate patient sequences from the events dataframes."""
+    """
 
     def __init__(
         self,
-        max_seq_length: int,
-        data_dir: str = "data_files",
-        json_dir: str = "json_files",
-        save_dir: str = "data_files",
+        save_dir: str,
+        max_seq_lengths: List[int],
+        label_columns: Optional[List[str]] = None,
     ):
-        self.max_seq_length = max_seq_length
-        self.token_config = TokenConfig()
-        self.token_generator = TokenGenerator(
-            max_seq_length, self.token_config, reference_time="2020-01-01 00:00:00"
-        )
-        self.data_dir = data_dir
-        self.json_dir = json_dir
-        self.max_dir = os.path.join(save_dir, str(self.max_seq_length))
+        """Initialize the sequence saver."""
+        self.save_dir = save_dir
+        self.label_columns = list(label_columns or [])
+        self.max_dirs = {
+            length: os.path.join(save_dir, str(length)) for length in max_seq_lengths
+        }
         self.all_dir = os.path.join(save_dir, "all")
-
-        self.encounter_processor = EncounterProcessor()
-        self.event_processor = EventProcessor(token_config=self.token_config)
-        self.after_death_events: List[str] = []
-
-        os.makedirs(self.max_dir, exist_ok=True)
+        for max_dir in self.max_dirs.values():
+            os.makedirs(max_dir, exist_ok=True)
         os.makedirs(self.all_dir, exist_ok=True)
 
-    @property
-    def get_max_column_names(self) -> List[str]:
-        """Get the column names for the max sequence length."""
+    def max_column_names(self, max_length: int) -> List[str]:
+        """Get the column names for a max sequence length."""
         return [
             "patient_id",
             "num_visits",
@@ -103,19 +145,22 @@ class PatientSequenceGenerator:
             "death_after_end",
             "length",
             "token_length",
-            f"event_tokens_{self.max_seq_length}",
-            f"type_tokens_{self.max_seq_length}",
-            f"age_tokens_{self.max_seq_length}",
-            f"time_tokens_{self.max_seq_length}",
-            f"visit_tokens_{self.max_seq_length}",
-            f"position_tokens_{self.max_seq_length}",
-            f"elapsed_tokens_{self.max_seq_length}",
+            f"event_tokens_{max_length}",
+            f"type_tokens_{max_length}",
+            f"age_tokens_{max_length}",
+            f"time_tokens_{max_length}",
+            f"visit_tokens_{max_length}",
+            f"position_tokens_{max_length}",
+            f"elapsed_tokens_{max_length}",
+            f"concept_ids_{max_length}",
+            "vocab_fingerprint",
             "common_conditions",
             "rare_conditions",
+            *self.label_columns,
         ]
 
     @property
-    def get_all_column_names(self) -> List[str]:
+    def all_column_names(self) -> List[str]:
         """Get the column names for all sequence lengths."""
         return [
             "patient_id",
@@ -134,428 +179,221 @@ class PatientSequenceGenerator:
             "elapsed_tokens",
             "common_conditions",
             "rare_conditions",
+            *self.label_columns,
         ]
 
-    def _add_tokens(
+    def stems(self) -> Dict[str, str]:
+        """Get the paths of the files without round and extension, by directory."""
+        stems = {self.all_dir: f"{self.all_dir}/patient_sequences"}
+        for max_length, max_dir in self.max_dirs.items():
+            stems[max_dir] = f"{max_dir}/patient_sequences_{max_length}"
+        return stems
+
+    def saved_paths(self, directory: str) -> List[str]:
+        """Get the paths of the saved files of the rounds of a directory, in order."""
+        pattern = re.compile(
+            rf"{re.escape(os.path.basename(self.stems()[directory]))}_(\d+)\.parquet"
+        )
+        rounds = []
+        for name in os.listdir(directory):
+            match = pattern.fullmatch(name)
+            if match:
+                rounds.append(int(match.group(1)))
+        return [self.paths(round_number)[directory] for round_number in sorted(rounds)]
+
+    def remove_rounds(self) -> None:
+        """Remove the saved files of the rounds of every directory."""
+        for directory in self.stems():
+            for path in self.saved_paths(directory):
+                os.remove(path)
+
+    def paths(self, round_number: int) -> Dict[str, str]:
+        """Get the paths of the files of a round, keyed by their directory."""
+        return {
+            directory: f"{stem}_{round_number}.parquet"
+            for directory, stem in self.stems().items()
+        }
+
+    def columns(self) -> Dict[str, List[str]]:
+        """Get the columns of the files of each directory."""
+        columns = {self.all_dir: self.all_column_names}
+        for max_length, max_dir in self.max_dirs.items():
+            columns[max_dir] = self.max_column_names(max_length)
+        return columns
+
+    def save_sequences(self, sequences: pd.DataFrame, round_number: int) -> None:
+        """Save the sequences of a round, with all the tokens and truncated."""
+        paths = self.paths(round_number)
+        for directory, column_names in self.columns().items():
+            sequences.loc[:, sequences.columns.intersection(column_names)].to_parquet(
+                paths[directory],
+                engine="pyarrow",
+            )
+
+    def update_sequences(
         self,
-        row: pd.Series,
-        encounter_row: pd.Series,
-    ) -> pd.Series:
-        """Add tokens to the events.
+        sequences: pd.DataFrame,
+        round_number: int,
+        replaced_ids: Set[str],
+    ) -> None:
+        """Replace the sequences of some patients in the files of a round.
 
         Parameters
         ----------
-        row : pd.Series
-            Combined events row
-        encounter_row : pd.Series
-            Encounter row
+        sequences : pd.DataFrame
+            The new sequences of the round.
+        round_number : int
+            The round of the files.
+        replaced_ids : Set[str]
+            The IDs of the patients whose saved sequences are removed.
 
-        Returns
-        -------
-        pd.Series
-            Updated row with tokens
         """
-        events = row["proc_codes"]
-        if len(events) == 0:
-            row["event_tokens"] = []
-            row["age_tokens"] = []
-            row["time_tokens"] = []
-            row["visit_tokens"] = []
-            row["type_ids"] = []
-            row["position_tokens"] = []
-            row["num_visits"] = 0
-            return row
-
-        events_encounters = row["encounter_ids"]
-        events_types = row["type_ids"]
-        events_elapsed_time = row["elapsed_time"]
-        ecounters = encounter_row["encounter_ids"]
-        intervals = encounter_row["intervals"]
-        eq_encounters = encounter_row["eq_encounters"]
-        age_mapping = dict(zip(ecounters, encounter_row["ages"]))
-        time_mapping = dict(zip(ecounters, encounter_row["times"]))
-
-        event_tokens = [self.token_config.class_token]
-        type_tokens = [self.token_config.token_type_mapping.get(CLASS)]
-        age_tokens = [0]
-        time_tokens = [0]
-        visit_segments = [0]
-        position_tokens = [0]
-        elapsed_tokens = [-2]
-
-        segment_value = 1
-        position_value = 0
-
-        prev_encounter = None
-
-        for event, event_encounter, event_type, elapsed_time in zip(
-            events,
-            events_encounters,
-            events_types,
-            events_elapsed_time,
-        ):
-            is_different_encounter = event_encounter != prev_encounter
-            has_no_equal = event_encounter not in eq_encounters
-            is_not_equal = prev_encounter not in eq_encounters.get(event_encounter, [])
-
-            if is_different_encounter and (has_no_equal or is_not_equal):
-                if prev_encounter is not None:
-                    # Adding Visit End Token
-                    event_tokens.append(self.token_config.visit_end_token)
-                    type_tokens.append(
-                        self.token_config.token_type_mapping.get(VISIT_END)
-                    )
-                    age_tokens.append(age_mapping[prev_encounter])
-                    time_tokens.append(time_mapping[prev_encounter])
-                    visit_segments.append(segment_value)
-                    position_tokens.append(position_value)
-                    elapsed_tokens.append(-2)
-
-                    # Adding Register Token
-                    event_tokens.append(self.token_config.register_token)
-                    type_tokens.append(
-                        self.token_config.token_type_mapping.get(REGISTER)
-                    )
-                    age_tokens.append(age_mapping[prev_encounter])
-                    time_tokens.append(time_mapping[prev_encounter])
-                    visit_segments.append(segment_value)
-                    position_tokens.append(position_value)
-                    elapsed_tokens.append(-2)
-
-                    # Adding interval token
-                    event_tokens.append(intervals[event_encounter])
-                    type_tokens.append(
-                        self.token_config.token_type_mapping.get(TIME_DELTA)
-                    )
-                    age_tokens.append(0)
-                    time_tokens.append(0)
-                    visit_segments.append(0)
-                    position_tokens.append(position_value)
-                    elapsed_tokens.append(-2)
-
-                # Adding Visit Start Token
-                event_tokens.append(self.token_config.visit_start_token)
-                type_tokens.append(
-                    self.token_config.token_type_mapping.get(VISIT_START)
-                )
-                age_tokens.append(age_mapping[event_encounter])
-                time_tokens.append(time_mapping[event_encounter])
-                elapsed_tokens.append(-1)
-
-                segment_value = 1 if segment_value == 2 else 2
-                visit_segments.append(segment_value)
-
-                if len(event_tokens) == 1 or event_tokens[-2] != "W0":
-                    position_value = position_value + 1
-                position_tokens.append(position_value)
-
-            # Adding intermediate tokens
-            event_tokens.append(event)
-            type_tokens.append(event_type)
-            age_tokens.append(age_mapping[event_encounter])
-            time_tokens.append(time_mapping[event_encounter])
-            visit_segments.append(segment_value)
-            position_tokens.append(position_value)
-            elapsed_tokens.append(elapsed_time)
-            prev_encounter = event_encounter
-
-        # Adding Visit End Token
-        event_tokens.append(self.token_config.visit_end_token)
-        type_tokens.append(self.token_config.token_type_mapping.get(VISIT_END))
-        age_tokens.append(age_mapping[event_encounter])
-        time_tokens.append(time_mapping[event_encounter])
-        visit_segments.append(segment_value)
-        position_tokens.append(position_value)
-        elapsed_tokens.append(-2)
-
-        # Adding Register Token
-        event_tokens.append(self.token_config.register_token)
-        type_tokens.append(self.token_config.token_type_mapping.get(REGISTER))
-        age_tokens.append(age_mapping[event_encounter])
-        time_tokens.append(time_mapping[event_encounter])
-        visit_segments.append(segment_value)
-        position_tokens.append(position_value)
-        elapsed_tokens.append(-2)
-
-        assert (
-            len(event_tokens)
-            == len(type_tokens)
-            == len(age_tokens)
-            == len(time_tokens)
-            == len(visit_segments)
-            == len(position_tokens)
-            == len(elapsed_tokens)
-        )
-
-        row["token_length"] = len(event_tokens)
-        row["event_tokens"] = event_tokens
-        row["type_tokens"] = type_tokens
-        row["age_tokens"] = age_tokens
-        row["time_tokens"] = time_tokens
-        row["visit_tokens"] = visit_segments
-        row["position_tokens"] = position_tokens
-        row["elapsed_tokens"] = elapsed_tokens
-        row["num_visits"] = len(set(position_tokens)) - 1
-        return row
-
-    def _get_mortality_label(
-        self,
-        row: pd.Series,
-        patient_row: pd.Series,
-        encounter_row: pd.Series,
-    ) -> pd.Series:
-        """Get the mortality label for the patient.
+        columns = self.columns()
+        for directory, path in self.paths(round_number).items():
+            saved = pd.read_parquet(path)
+            saved = saved[~saved["patient_id"].astype(str).isin(replaced_ids)]
+            pd.concat(
+                [
+                    saved,
+                    sequences.loc[
+                        :,
+                        sequences.columns.intersection(columns[directory]),
+                    ],
+                ],
+            ).to_parquet(path, engine="pyarrow")
 
-        Parameters
-        ----------
-        row : pd.Series
-            Combined events row
-        patient_row : pd.Series
-            Patient row
-        encounter_row : pd.Series
-            Encounter row
 
-        Returns
-        -------
-        pd.Series
-            Updated row with mortality label
-        """
-        death_date = patient_row["deceasedDateTime"]
-        if not isinstance(death_date, str) and math.isnan(float(death_date)):
-            row["deceased"] = 0
-            return row
-        death_date = datetime.strptime(death_date, "%Y-%m-%d").date()
-        encounter_starts = encounter_row["starts"]
-        encounter_ends = encounter_row["ends"]
-        last_start = parser.parse(encounter_starts[-1]).replace(tzinfo=None).date()
-        last_end = parser.parse(encounter_ends[-1]).replace(tzinfo=None).date()
-        last_code_date = parser.parse(row["proc_dates"][-1]).replace(tzinfo=None).date()
-
-        death_start = death_date - last_start
-        death_end = death_date - last_end
-        death_code = death_date - last_code_date
-
-        if death_code.days < 0:
-            LOGGER.info(f"After death events {row['patient_id']}")
-            self.after_death_events.append(row["patient_id"])
-
-        row["deceased"] = 1
-        row["death_after_start"] = death_start.days
-        row["death_after_end"] = death_end.days
-        return row
-
-    def _get_condition_label(
-        self,
-        row: pd.Series,
-        condition_row: pd.Series,
-    ) -> pd.Series:
-        """Get the condition labels for the patient."""
-        encounter_ids = set(row["encounter_ids"])
-        common_file = os.path.join(self.json_dir, "common_conditions.json")
-        rare_file = os.path.join(self.json_dir, "rare_conditions.json")
-
-        with open(common_file, "r") as f:
-            common_conditions = json.load(f)
-        with open(rare_file, "r") as f:
-            rare_conditions = json.load(f)
-
-        conditions = condition_row["encounter_conditions"]
-        valid_conditions = {k: v for k, v in conditions.items() if k in encounter_ids}
-        patient_conditions = [
-            item for sublist in valid_conditions.values() for item in sublist
-        ]
+class PatientSequenceGenerator:
+    """Generate patient sequences from the events dataframes.
 
-        common_labels = []
-        for _, codes in common_conditions.items():
-            condition_found = set(codes).intersection(set(patient_conditions))
-            if condition_found:
-                common_labels.append(1)
-            else:
-                common_labels.append(0)
+    Parameters
+    ----------
+    max_seq_length : Union[int, List[int]]
+        Maximum sequence length, or a list of them. The sequences are created
+        once and truncated to each length, the first one being the primary
+        length of ``max_seq_length`` and ``max_dir``.
+    data_dir : str, optional
+        Directory of the collected data files, by default "data_files"
+    json_dir : str, optional
+        Directory of the condition groups, by default "json_files"
+    save_dir : str, optional
+        Directory to save the sequences, by default "data_files"
+    input_format : str, optional
+        Format of the data files, "csv" or "parquet", by default "csv"
+    engine : str, optional
+        Engine creating the sequences of each chunk, by default "row". The "row"
+        engine processes each patient row by row, while the "columnar" engine
+        works on flat tables of all the events of the chunk with vectorized
+        operations, and is much faster for the same sequences.
+    stages : Optional[List[Stage]], optional
+        Additional stages run on each chunk before the sequences are written,
+        by default None. They can require the stages of the engine, such as
+        "tokens" or "truncation", to add task labels to the sequences, whose
+        columns are saved with the others.
+    skip_stages : Optional[List[str]], optional
+        Names of the stages skipped on each chunk, by default None. Only the
+        stages that no other stage requires can be skipped, such as
+        "mortality" or "conditions".
+    vocab_path : Optional[str], optional
+        Path of a tokenizer saved by ``ConceptTokenizer.save``, by default
+        None. If set, the truncated event tokens of each max sequence length
+        are encoded with the IDs of its vocabulary, in the int32 columns
+        ``concept_ids_{max_length}`` padded to the length, and the fingerprint
+        of the vocabulary is saved in the ``vocab_fingerprint`` column.
 
-        rare_labels = []
-        for _, codes in rare_conditions.items():
-            condition_found = set(codes).intersection(set(patient_conditions))
-            if condition_found:
-                rare_labels.append(1)
-            else:
-                rare_labels.append(0)
-
-        row["common_conditions"] = common_labels
-        row["rare_conditions"] = rare_labels
-        return row
-
-    def _create_postition_tokens(self, event_tokens: List[str]) -> List[int]:
-        """Create position tokens."""
-        position_tokens = []
-        token = 0
-        for i in range(len(event_tokens)):
-            if event_tokens[i] == self.token_config.visit_start_token:
-                token = token + 1
-            position_tokens.append(token)
-        return position_tokens
-
-    def _create_visit_tokens(self, event_tokens: List[str]) -> List[int]:
-        """Create visit tokens."""
-        visit_segments = [0]
-        segment = 1
-        for i in range(1, len(event_tokens)):
-            if event_tokens[i] == self.token_config.visit_start_token:
-                segment = 1 if segment == 2 else 2
-            visit_segments.append(segment)
-        return visit_segments
-
-    def _truncate_or_pad(
+    """
+
+    def __init__(
         self,
-        row: pd.Series,
-        pad_events: bool = False,
-    ) -> pd.Series:
-        """Truncate or pads the sequence to max_seq_length.
+        max_seq_length: Union[int, List[int]],
+        data_dir: str = "data_files",
+        json_dir: str = "json_files",
+        save_dir: str = "data_files",
+        input_format: str = "csv",
+        engine: str = "row",
+        stages: Optional[List[Stage]] = None,
+        skip_stages: Optional[List[str]] = None,
+        vocab_path: Optional[str] = None,
+    ):
+        if input_format not in ("csv", "parquet"):
+            raise ValueError(
+                f"Input format should be csv or parquet, got {input_format}.",
+            )
+        if engine not in ("row", "columnar"):
+            raise ValueError(f"Engine should be row or columnar, got {engine}.")
+        if isinstance(max_seq_length, int):
+            max_seq_length = [max_seq_length]
+        if not max_seq_length or len(set(max_seq_length)) < len(max_seq_length):
+            raise ValueError(
+                f"Max sequence lengths should be distinct, got {max_seq_length}.",
+            )
+        self.max_seq_lengths = list(max_seq_length)
+        self.max_seq_length = self.max_seq_lengths[0]
+        self.input_format = input_format
+        self.engine = engine
+        self.token_config = TokenConfig()
+        self.token_generator = TokenGenerator(
+            self.max_seq_lengths,
+            self.token_config,
+            reference_time="2020-01-01 00:00:00",
+        )
+        self.data_dir = data_dir
+        self.json_dir = json_dir
+        stages = list(stages or [])
+        self.sequence_saver = SequenceSaver(
+            save_dir,
+            self.max_seq_lengths,
+            [column for stage in stages for column in stage.columns],
+        )
+        self.max_dirs = self.sequence_saver.max_dirs
+        self.max_dir = self.max_dirs[self.max_seq_length]
+        self.all_dir = self.sequence_saver.all_dir
+        self.shard_dir = os.path.join(save_dir, "shards")
+        self.fingerprint_dir = os.path.join(save_dir, "fingerprints")
+        self.report_path = os.path.join(save_dir, "run_report.jsonl")
+        self.stage_timer = StageTimer()
 
-        Parameters
-        ----------
-        row : pd.Series
-            row of the combined events dataframe
+        self.encounter_processor = EncounterProcessor()
+        self.event_processor = EventProcessor(token_config=self.token_config)
+        self.label_assigner = LabelAssigner(json_dir)
+        self.columnar_engine = ColumnarEngine(
+            self.token_config,
+            self.max_seq_lengths,
+            self.token_generator.reference_time,
+            self.label_assigner.condition_index,
+        )
+        engine_stages = (
+            self.columnar_engine.stages()
+            if engine == "columnar"
+            else self._row_stages()
+        )
+        self.concept_encoder = (
+            ConceptEncoder.from_tokenizer(vocab_path) if vocab_path else None
+        )
+        if self.concept_encoder is not None:
+            engine_stages.append(
+                Stage("encoding", self._encoding_stage, requires=("truncation",)),
+            )
+        self.pipeline = StagePipeline(
+            engine_stages
+            + stages
+            + [Stage("write", self._write_stage, requires=("tokens",))],
+            self.stage_timer,
+            skip_stages,
+        )
+        self.after_death_events: List[str] = []
 
-        Returns
-        -------
-        pd.Series
-            Updated row with truncated or padded sequence
-        """
-        sequence = _to_list(row["event_tokens"])
-        t_type = _to_list(row["type_tokens"])
-        age = _to_list(row["age_tokens"])
-        time = _to_list(row["time_tokens"])
-        visit = _to_list(row["visit_tokens"])
-        position = _to_list(row["position_tokens"])
-        elapsed = _to_list(row["elapsed_tokens"])
-        seq_length = row["token_length"]
-        truncated = False
-        padded_length = 0
-
-        if seq_length == self.max_seq_length:
-            row[f"event_tokens_{self.max_seq_length}"] = sequence
-            row[f"type_tokens_{self.max_seq_length}"] = t_type
-            row[f"age_tokens_{self.max_seq_length}"] = age
-            row[f"time_tokens_{self.max_seq_length}"] = time
-            row[f"visit_tokens_{self.max_seq_length}"] = visit
-            row[f"position_tokens_{self.max_seq_length}"] = position
-            row[f"elapsed_tokens_{self.max_seq_length}"] = elapsed
-            return row
-
-        if seq_length > self.max_seq_length:
-            truncated = True
-            # get the recent max_length tokens
-            start_index = int(seq_length - self.max_seq_length) + 2
-            end_index = int(seq_length)
-
-            if sequence[start_index] == self.token_config.visit_end_token:
-                start_index += 3
-            elif sequence[start_index] == self.token_config.register_token:
-                start_index += 2
-            elif sequence[start_index].startswith(("[W_", "[M_", "[LT")):
-                start_index += 1
-
-            if sequence[start_index] != self.token_config.visit_start_token:
-                new_sequence = [
-                    self.token_config.class_token,
-                    self.token_config.visit_start_token,
-                ] + sequence[start_index:end_index]
-                new_type = [
-                    self.token_config.token_type_mapping.get(CLASS),
-                    self.token_config.token_type_mapping.get(VISIT_START),
-                ] + t_type[start_index:end_index]
-                new_age = [0, age[start_index]] + age[start_index:end_index]
-                new_time = [0, time[start_index]] + time[start_index:end_index]
-                new_visit = self._create_visit_tokens(new_sequence)
-                new_position = self._create_postition_tokens(new_sequence)
-                new_elasped = [-2, -1] + elapsed[start_index:end_index]
-            else:
-                new_sequence = [self.token_config.class_token] + sequence[
-                    start_index:end_index
-                ]
-                new_type = [self.token_config.token_type_mapping.get(CLASS)] + t_type[
-                    start_index:end_index
-                ]
-                new_age = [0] + age[start_index:end_index]
-                new_time = [0] + time[start_index:end_index]
-                new_visit = self._create_visit_tokens(new_sequence)
-                new_position = self._create_postition_tokens(new_sequence)
-                new_elasped = [-2] + elapsed[start_index:end_index]
-
-            row[f"event_tokens_{self.max_seq_length}"] = new_sequence
-            row[f"type_tokens_{self.max_seq_length}"] = new_type
-            row[f"age_tokens_{self.max_seq_length}"] = new_age
-            row[f"time_tokens_{self.max_seq_length}"] = new_time
-            row[f"visit_tokens_{self.max_seq_length}"] = new_visit
-            row[f"position_tokens_{self.max_seq_length}"] = new_position
-            row[f"elapsed_tokens_{self.max_seq_length}"] = new_elasped
-            seq_length = len(new_sequence)
-
-        if seq_length < self.max_seq_length:
-            padded_length = int(max(0, self.max_seq_length - seq_length))
-            if truncated:
-                if pad_events:
-                    row[f"event_tokens_{self.max_seq_length}"] = (
-                        row[f"event_tokens_{self.max_seq_length}"]
-                        + [self.token_config.pad_token] * padded_length
-                    )
-                else:
-                    # padding will be done in the tokenizer
-                    row[f"event_tokens_{self.max_seq_length}"] = row[
-                        f"event_tokens_{self.max_seq_length}"
-                    ]
-
-                row[f"type_tokens_{self.max_seq_length}"] = (
-                    row[f"type_tokens_{self.max_seq_length}"]
-                    + [self.token_config.token_type_mapping.get(PAD)] * padded_length
-                )
-                row[f"age_tokens_{self.max_seq_length}"] = (
-                    row[f"age_tokens_{self.max_seq_length}"] + [0] * padded_length
-                )
-                row[f"time_tokens_{self.max_seq_length}"] = (
-                    row[f"time_tokens_{self.max_seq_length}"] + [0] * padded_length
-                )
-                row[f"visit_tokens_{self.max_seq_length}"] = (
-                    row[f"visit_tokens_{self.max_seq_length}"] + [0] * padded_length
-                )
-                row[f"position_tokens_{self.max_seq_length}"] = (
-                    row[f"position_tokens_{self.max_seq_length}"] + [0] * padded_length
-                )
-            else:
-                if pad_events:
-                    row[f"event_tokens_{self.max_seq_length}"] = (
-                        sequence + [self.token_config.pad_token] * padded_length
-                    )
-                else:
-                    # padding will be done in the tokenizer
-                    row[f"event_tokens_{self.max_seq_length}"] = sequence
+        os.makedirs(self.fingerprint_dir, exist_ok=True)
 
-                row[f"type_tokens_{self.max_seq_length}"] = (
-                    t_type
-                    + [self.token_config.token_type_mapping.get(PAD)] * padded_length
-                )
-                row[f"age_tokens_{self.max_seq_length}"] = age + [0] * padded_length
-                row[f"time_tokens_{self.max_seq_length}"] = time + [0] * padded_length
-                row[f"visit_tokens_{self.max_seq_length}"] = visit + [0] * padded_length
-                row[f"position_tokens_{self.max_seq_length}"] = (
-                    position + [0] * padded_length
-                )
-                row[f"elapsed_tokens_{self.max_seq_length}"] = elapsed
-
-        for key in [
-            f"type_tokens_{self.max_seq_length}",
-            f"age_tokens_{self.max_seq_length}",
-            f"time_tokens_{self.max_seq_length}",
-            f"visit_tokens_{self.max_seq_length}",
-            f"position_tokens_{self.max_seq_length}",
-        ]:
-            assert (
-                len(row[key]) == self.max_seq_length
-            ), f"Length of {key} is {len(row[key])} and max_length is {self.max_seq_length}"
-            row[key] = np.array(row[key])
-
-        return row
+    @property
+    def get_max_column_names(self) -> List[str]:
+        """Get the column names for the max sequence length."""
+        return self.sequence_saver.max_column_names(self.max_seq_length)
+
+    @property
+    def get_all_column_names(self) -> List[str]:
+        """Get the column names for all sequence lengths."""
+        return self.sequence_saver.all_column_names
 
     def _remove_patients_with_no_encounters(
         self,
@@ -595,6 +433,46 @@ class PatientSequenceGenerator:
 
         return patient_data
 
+    def _normalize_timestamps(
+        self,
+        patient_data: PatientData,
+    ) -> PatientData:
+        """Parse the list columns with dates, and every date of the chunk once.
+
+        Parameters
+        ----------
+        patient_data : PatientData
+            Patient data
+
+        Returns
+        -------
+        PatientData
+            Updated patient data, with the epoch seconds of its dates
+
+        """
+        encounters = patient_data.encounters
+        columns = [(encounters, name) for name in ["encounter_ids", "starts", "ends"]]
+        for event_type, event_data in patient_data.events.items():
+            columns.extend(
+                (event_data.data, name)
+                for name in ["encounter_ids", f"{event_type}_dates"]
+            )
+        for data, name in columns:
+            data[name] = data[name].map(parse_literal)
+        patient_data.epochs = EpochIndex(
+            chain(
+                patient_data.patients["birthDate"],
+                patient_data.patients["deceasedDateTime"],
+                *(
+                    chain.from_iterable(data[name])
+                    for data, name in columns
+                    if name != "encounter_ids"
+                ),
+            ),
+        )
+
+        return patient_data
+
     def _process_encounters(
         self,
         patient_data: PatientData,
@@ -630,6 +508,7 @@ class PatientSequenceGenerator:
             lambda row: self.encounter_processor.calculate_patient_ages(
                 row,
                 patient_data.patients.iloc[row.name],
+                patient_data.epochs,
             ),
             axis=1,
         )
@@ -637,11 +516,19 @@ class PatientSequenceGenerator:
             lambda row: self.encounter_processor.calculate_encounter_times(
                 row,
                 self.token_generator.reference_time,
+                patient_data.epochs,
+            ),
+            axis=1,
+        )
+        patient_data.encounters = patient_data.encounters.apply(
+            lambda row: self.encounter_processor.calculate_intervals(
+                row,
+                patient_data.epochs,
             ),
             axis=1,
         )
         patient_data.encounters = patient_data.encounters.apply(
-            lambda row: self.encounter_processor.calculate_intervals(row),
+            lambda row: self.encounter_processor.index_encounters(row),
             axis=1,
         )
 
@@ -672,135 +559,846 @@ class PatientSequenceGenerator:
                     row,
                     patient_data.encounters.iloc[row.name],
                     event_type,
+                    patient_data.epochs,
                 ),
                 axis=1,
             )
 
         return patient_data
 
+    def _row_stages(self) -> List[Stage]:
+        """Get the stages creating the sequences of a chunk row by row."""
+        return [
+            Stage("encounters", self._encounter_stage),
+            Stage("events", self._event_stage, requires=("encounters",)),
+            Stage("combine", self._combine_stage, requires=("events",)),
+            Stage("tokens", self._token_stage, requires=("combine",)),
+            Stage("mortality", self._mortality_stage, requires=("tokens",)),
+            Stage("truncation", self._truncation_stage, requires=("tokens",)),
+            Stage("conditions", self._condition_stage, requires=("combine",)),
+        ]
+
+    def _encounter_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Parse the dates once, and process the encounters."""
+        patient_data = self._normalize_timestamps(batch.patient_data)
+        batch.patient_data = self._process_encounters(patient_data)
+        return batch
+
+    def _event_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Process the events, and parse the conditions."""
+        patient_data = self._process_events(batch.patient_data)
+        patient_data.conditions["encounter_conditions"] = patient_data.conditions[
+            "encounter_conditions"
+        ].apply(parse_literal)
+        batch.patient_data = patient_data
+        return batch
+
+    def _combine_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Combine the events, keeping the patients with enough events."""
+        patient_data = batch.patient_data
+        combined_events = self.event_processor.combine_events(patient_data)
+        combined_events = combined_events[combined_events["length"] > batch.min_events]
+        # add elapsed time after admission for all events
+        batch.sequences = combined_events.apply(
+            lambda row: self.event_processor.calculate_time_after_admission(
+                row,
+                patient_data.encounters.iloc[row.name],
+                patient_data.epochs,
+            ),
+            axis=1,
+        )
+        return batch
+
+    def _token_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Add the special tokens, keeping the patients with enough visits."""
+        sequences = self.token_generator.add_tokens(
+            batch.sequences,
+            batch.patient_data.encounters,
+        )
+        batch.sequences = sequences[sequences["num_visits"] > batch.min_visits]
+        return batch
+
+    def _mortality_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Label the mortality, skipping the patients with after death events."""
+        patient_data = batch.patient_data
+        batch.sequences = self.label_assigner.assign_mortality_label(
+            batch.sequences,
+            patient_data.patients,
+            patient_data.encounters,
+            patient_data.epochs,
+            batch.after_death_events,
+        )
+        return batch
+
+    def _truncation_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Add the truncated token columns of each max sequence length."""
+        batch.sequences = self.token_generator.truncate_or_pad(
+            batch.sequences,
+            batch.pad_events,
+        )
+        return batch
+
+    def _condition_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Flag the common and rare condition groups of the sequences."""
+        batch.sequences = self.label_assigner.assign_condition_labels(
+            batch.sequences,
+            batch.patient_data.conditions,
+        )
+        return batch
+
+    def _encoding_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Encode the truncated event tokens with the IDs of the vocabulary."""
+        encoded = {
+            f"concept_ids_{max_length}": self.concept_encoder.encode_lists(
+                batch.sequences[f"event_tokens_{max_length}"],
+                max_length,
+            )
+            for max_length in self.max_seq_lengths
+        }
+        batch.sequences = batch.sequences.assign(
+            **encoded,
+            vocab_fingerprint=self.concept_encoder.fingerprint,
+        )
+        return batch
+
+    def _write_stage(self, batch: ChunkBatch) -> ChunkBatch:
+        """Save the sequences in the files of the round of the batch."""
+        self.sequence_saver.save_sequences(batch.sequences, batch.round_number)
+        return batch
+
+    def _read_chunks(
+        self, chunksize: Optional[int] = None
+    ) -> Iterator[List[pd.DataFrame]]:
+        """Read the data files in chunks of patients.
+
+        Parameters
+        ----------
+        chunksize : Optional[int], optional
+            Number of patients per chunk, by default None which reads the whole
+            files as one chunk
+
+        Yields
+        ------
+        List[pd.DataFrame]
+            The chunks of the patient, encounter, procedure, medication, lab and
+            condition files, aligned by patient.
+
+        """
+        file_paths = [
+            f"{self.data_dir}/{name}.{self.input_format}" for name in INPUT_FILES
+        ]
+        if self.input_format == "parquet":
+            readers = [iter_parquet(path, chunksize=chunksize) for path in file_paths]
+        else:
+            readers = [pd.read_csv(path, chunksize=chunksize) for path in file_paths]
+            if chunksize is None:
+                readers = [iter([reader]) for reader in readers]
+        while True:
+            try:
+                yield [next(reader).reset_index(drop=True) for reader in readers]
+            except StopIteration:
+                return
+
+    def _count_patients(self) -> int:
+        """Count the patients of the data files."""
+        path = f"{self.data_dir}/inpatient.{self.input_format}"
+        if self.input_format == "parquet":
+            return sum(
+                pq.ParquetFile(file).metadata.num_rows for file in parquet_files(path)
+            )
+        return len(pd.read_csv(path, usecols=["patient_id"]))
+
+    def _count_events(self, dataframes: List[pd.DataFrame]) -> np.ndarray:
+        """Count the procedures, medications and labs of each patient of a chunk."""
+        _, _, procedures, medications, labs, _ = dataframes
+        return sum(
+            count_items(frame[f"{event_type}_codes"])
+            for frame, event_type in [
+                (procedures, PROC),
+                (medications, MED),
+                (labs, LAB),
+            ]
+        )
+
+    def _chunk_sequences(
+        self,
+        dataframes: List[pd.DataFrame],
+        round_number: int,
+        skip: Iterable[str] = (),
+        min_events: int = 0,
+        min_visits: int = 0,
+        pad_events: bool = False,
+    ) -> pd.DataFrame:
+        """Create the sequences of a chunk with the stages of the pipeline.
+
+        Parameters
+        ----------
+        dataframes : List[pd.DataFrame]
+            The chunks of the data files, as read by ``_read_chunks``
+        round_number : int
+            Round of the chunk, numbering its files
+        skip : Iterable[str], optional
+            Names of the stages skipped for this chunk, by default ()
+        min_events : int, optional
+            Patients with at most this number of events are skipped, by default 0
+        min_visits : int, optional
+            Patients with at most this number of visits are skipped, by default 0
+        pad_events : bool, optional
+            Whether to pad the truncated event tokens, by default False
+
+        Returns
+        -------
+        pd.DataFrame
+            The sequences, one row per patient.
+
+        """
+        patients, encounters, procedures, medications, labs, conditions = dataframes
+        patient_data = PatientData(
+            patients=patients,
+            encounters=encounters,
+            conditions=conditions,
+            events={
+                PROC: EventData(event_type=PROC, data=procedures),
+                MED: EventData(event_type=MED, data=medications),
+                LAB: EventData(event_type=LAB, data=labs),
+            },
+        )
+        batch = self.pipeline.run(
+            ChunkBatch(
+                patient_data,
+                self.after_death_events,
+                min_events=min_events,
+                min_visits=min_visits,
+                pad_events=pad_events,
+                round_number=round_number,
+            ),
+            skip,
+        )
+        return batch.sequences
+
+    def _create_chunk_sequences(
+        self,
+        dataframes: List[pd.DataFrame],
+        round_number: int,
+        min_events: int = 0,
+        min_visits: int = 0,
+        pad_events: bool = False,
+    ) -> pd.DataFrame:
+        """Create the sequences of a chunk and save them in the files of its round.
+
+        The fingerprints of the input rows of the patients are saved with them.
+
+        Parameters
+        ----------
+        dataframes : List[pd.DataFrame]
+            The chunks of the data files, as read by ``_read_chunks``
+        round_number : int
+            Round of the chunk, numbering its files
+        min_events : int, optional
+            Patients with at most this number of events are skipped, by default 0
+        min_visits : int, optional
+            Patients with at most this number of visits are skipped, by default 0
+        pad_events : bool, optional
+            Whether to pad the truncated event tokens, by default False
+
+        Returns
+        -------
+        pd.DataFrame
+            The saved sequences.
+
+        """
+        self.stage_timer.round_number = round_number
+        # The processing edits the rows, so they are hashed first.
+        fingerprints = fingerprint_rows(dataframes)
+        patient_ids = dataframes[0]["patient_id"].copy()
+        combined_events = self._chunk_sequences(
+            dataframes,
+            round_number,
+            min_events=min_events,
+            min_visits=min_visits,
+            pad_events=pad_events,
+        )
+        write_fingerprints(
+            self.fingerprint_dir,
+            round_number,
+            patient_ids,
+            fingerprints,
+        )
+        return combined_events
+
+    def _run_chunks(
+        self,
+        chunks: Iterable[List[pd.DataFrame]],
+        first_round: int,
+        options: Dict[str, Any],
+        budget: Optional[ChunkBudget] = None,
+    ) -> TaskResult:
+        """Create the sequences of consecutive chunks, numbered from a round.
+
+        The patients with events after their death found in the chunks are
+        removed from ``after_death_events`` and returned, for the caller to add
+        them in round order, as are the records of the stages.
+
+        With a memory budget, the events and memory of each round are measured
+        and observed by the budget. In a worker process, the budget is a copy,
+        so the caller observes the returned sizes in its own budget.
+
+        Returns
+        -------
+        TaskResult
+            The number of rounds and of saved sequences, the IDs of the patients
+            with events after their death, the records of the stages, and the
+            patients, events and bytes of each round, the last two being 0
+            without a memory budget.
+
+        """
+        num_after_death = len(self.after_death_events)
+        rounds = num_sequences = 0
+        round_sizes = []
+        for rounds, dataframes in enumerate(chunks, start=1):
+            num_patients = len(dataframes[0])
+            num_events = num_bytes = 0
+            if budget is not None:
+                num_events = int(self._count_events(dataframes).sum())
+            sequences = self._create_chunk_sequences(
+                dataframes,
+                first_round + rounds - 1,
+                **options,
+            )
+            num_sequences += len(sequences)
+            if budget is not None:
+                # The rows are parsed in place, so they are measured once processed.
+                num_bytes = memory_usage([*dataframes, sequences])
+                budget.observe(num_events, num_bytes)
+            round_sizes.append((num_patients, num_events, num_bytes))
+        after_death_events = self.after_death_events[num_after_death:]
+        del self.after_death_events[num_after_death:]
+        return (
+            rounds,
+            num_sequences,
+            after_death_events,
+            self.stage_timer.pop_records(),
+            round_sizes,
+        )
+
+    def _run_shard(
+        self,
+        shard: int,
+        first_round: int,
+        chunksize: Optional[int],
+        options: Dict[str, Any],
+        budget: Optional[ChunkBudget] = None,
+    ) -> TaskResult:
+        """Read a shard joined on its patients and create its sequences.
+
+        With a memory budget, the blocks of ``chunksize`` patients read from the
+        shard are split into chunks of the budget.
+
+        """
+        chunks = read_shard(
+            self.shard_dir,
+            shard,
+            INPUT_FILES,
+            self.input_format,
+            chunksize,
+        )
+        if budget is not None:
+            chunks = budget.chunks(chunks, self._count_events)
+        return self._run_chunks(chunks, first_round, options, budget)
+
     def create_patient_sequence(
         self,
         chunksize: Optional[int] = None,
         min_events: int = 0,
         min_visits: int = 0,
         pad_events: bool = False,
+        num_workers: int = 1,
+        num_shards: Optional[int] = None,
+        output_layout: str = "rounds",
+        row_group_size: int = 1000,
+        compression: str = "snappy",
+        num_partitions: int = 1,
+        memory_budget: Optional[int] = None,
     ) -> None:
-        """Create patient sequences and saves them as a parquet file."""
-        file_paths = [
-            f"{self.data_dir}/inpatient.csv",
-            f"{self.data_dir}/encounters.csv",
-            f"{self.data_dir}/procedures.csv",
-            f"{self.data_dir}/med_requests.csv",
-            f"{self.data_dir}/processed_labs.csv",
-            f"{self.data_dir}/conditions.csv",
-        ]
-        rounds = 0
-        more_chunks = True
-        readers = [pd.read_csv(path, chunksize=chunksize) for path in file_paths]
-        while more_chunks:
-            try:
-                dataframes = [next(reader).reset_index(drop=True) for reader in readers]
-            except StopIteration:
-                more_chunks = False
-                break
-            patients, encounters, procedures, medications, labs, conditions = dataframes
-            patient_data = PatientData(
-                patients=patients,
-                encounters=encounters,
-                conditions=conditions,
-                events={
-                    PROC: EventData(event_type=PROC, data=procedures),
-                    MED: EventData(event_type=MED, data=medications),
-                    LAB: EventData(event_type=LAB, data=labs),
-                },
-            )
-            start_time = time.time()
-            ## Process encounters.
-            patient_data = self._process_encounters(patient_data)
+        """Create patient sequences and saves them as a parquet file.
 
-            # Process events.
-            patient_data = self._process_events(patient_data)
+        Each chunk of patients is saved in its own files, numbered by the round
+        of the chunk. With more than one worker, the chunks or shards are
+        dispatched to a process pool, and the same files are saved as with one
+        worker. The files of the rounds can then be streamed into a single file
+        or dataset per directory, which is faster to list and read.
 
-            # Conditions.
-            patient_data.conditions["encounter_conditions"] = patient_data.conditions[
-                "encounter_conditions"
-            ].apply(literal_eval)
+        Parameters
+        ----------
+        chunksize : Optional[int], optional
+            Number of patients per chunk, by default None which processes all
+            the patients as one chunk. With a memory budget, it is the number of
+            patients read at once, which are split into chunks of the budget.
+        min_events : int, optional
+            Patients with at most this number of events are skipped, by default 0
+        min_visits : int, optional
+            Patients with at most this number of visits are skipped, by default 0
+        pad_events : bool, optional
+            Whether to pad the truncated event tokens, by default False
+        num_workers : int, optional
+            Number of worker processes creating the sequences, by default 1
+        num_shards : Optional[int], optional
+            Number of shards of patients, by default None which reads the data
+            files in lockstep, assuming that their rows are aligned by patient.
+            Otherwise, the data files are first partitioned into shards by a
+            hash of the patient IDs, and the files of each shard are joined on
+            the patient IDs, so their rows may be in any order. Each worker
+            reads and processes whole shards, in chunks of patients.
+        output_layout : str, optional
+            Layout of the saved sequences, by default "rounds" which keeps the
+            files of the rounds, and is the only one that can be updated. With
+            "file", the rounds are streamed into a single ``.parquet`` file per
+            directory, and with "dataset" into a hive-partitioned dataset with
+            a ``_metadata`` file of the footers of its files
+        row_group_size : int, optional
+            Number of sequences per row group of the "file" and "dataset"
+            layouts, by default 1000
+        compression : str, optional
+            Compression codec of the "file" and "dataset" layouts, by default
+            "snappy"
+        num_partitions : int, optional
+            Number of partitions of the "dataset" layout, by default 1. The
+            patients are partitioned by a hash of their IDs.
+        memory_budget : Optional[int], optional
+            Target memory of a chunk in bytes, by default None which chunks the
+            patients by ``chunksize``. Otherwise, the memory of each patient is
+            estimated from their number of events, with the bytes per event
+            observed in the previous rounds, so the chunks vary in patients. The
+            rounds of the shards are then numbered from the patients before
+            them, and may not be consecutive.
 
-            # Combine events.
-            combined_events = self.event_processor.combine_events(
-                patient_data,
+        """
+        if output_layout not in ("rounds", "file", "dataset"):
+            raise ValueError(
+                f"Output layout should be rounds, file or dataset, got "
+                f"{output_layout}.",
             )
-            # Filter patients based on min_events.
-            combined_events = combined_events[combined_events["length"] > min_events]
-            # add elapsed time after admission for all events
-            combined_events = combined_events.apply(
-                lambda row: self.event_processor.calculate_time_after_admission(
-                    row,
-                    patient_data.encounters.iloc[row.name],
-                ),
-                axis=1,
+        options = {
+            "min_events": min_events,
+            "min_visits": min_visits,
+            "pad_events": pad_events,
+        }
+        self._reset_fingerprints(
+            {
+                **options,
+                "output_layout": output_layout,
+                "vocab_fingerprint": self._vocab_fingerprint(),
+            },
+        )
+        # The rounds of a previous run may be numbered differently.
+        self.sequence_saver.remove_rounds()
+        # The report of a previous run is replaced.
+        self.stage_timer.pop_records()
+        write_report(self.report_path, [], mode="w")
+        budget = ChunkBudget(memory_budget) if memory_budget is not None else None
+        tasks, num_patients = self._tasks(chunksize, num_shards, options, budget)
+        start_time = time.time()
+        rounds = patients = samples = 0
+        records = self._report_stages()
+
+        def log_progress(result: TaskResult) -> None:
+            """Record the results of a task and log the estimated time left."""
+            nonlocal rounds, patients, samples
+            task_rounds, num_sequences, after_death_events, task_records, sizes = result
+            self.after_death_events.extend(after_death_events)
+            records.extend(self._report_stages(task_records))
+            rounds += task_rounds
+            patients += sum(size[0] for size in sizes)
+            samples += num_sequences
+            elapsed = time.time() - start_time
+            remaining = elapsed / max(patients, 1) * max(num_patients - patients, 0)
+            LOGGER.info(
+                f"Round {rounds} done in {elapsed:.2f} s, "
+                f"{patients}/{num_patients} patients and {samples} samples done, "
+                f"ETA {remaining:.0f} s."
             )
-            # add special tokens to the events
-            combined_events = combined_events.apply(
-                lambda row: self._add_tokens(
-                    row, patient_data.encounters.iloc[row.name]
-                ),
-                axis=1,
+            if budget is not None:
+                if num_workers > 1:
+                    # The workers observed copies of the budget.
+                    for _, num_events, num_bytes in sizes:
+                        budget.observe(num_events, num_bytes)
+                num_events = sum(size[1] for size in sizes)
+                num_bytes = sum(size[2] for size in sizes)
+                LOGGER.info(
+                    f"Observed {num_bytes / max(num_events, 1):.0f} bytes per "
+                    f"event in {num_events} events, estimate "
+                    f"{budget.bytes_per_event:.0f} bytes per event."
+                )
+
+        if num_workers <= 1:
+            for method, args in tasks:
+                log_progress(getattr(self, method)(*args))
+        else:
+            # Results are collected in round order, so the after death events are
+            # added in the same order as with one worker. Workers start with a
+            # copy of the generator, so the events of running tasks are not
+            # shared, which is safe as every patient is in a single chunk.
+            pending: Deque[AsyncResult] = deque()
+            with Pool(num_workers, initializer=_init_worker, initargs=(self,)) as pool:
+                for method, args in tasks:
+                    # Bound the chunks held in memory while the workers are busy.
+                    if len(pending) >= 2 * num_workers:
+                        log_progress(pending.popleft().get())
+                    pending.append(pool.apply_async(_run_task, (method, *args)))
+                while pending:
+                    log_progress(pending.popleft().get())
+        if num_shards is not None:
+            shutil.rmtree(self.shard_dir)
+        if output_layout != "rounds":
+            self._compact_sequences(
+                row_group_size,
+                compression,
+                num_partitions if output_layout == "dataset" else None,
             )
-            # filter patients based on min_visits
-            combined_events = combined_events[
-                combined_events["num_visits"] > min_visits
-            ]
-            # get mortality label
-            combined_events = combined_events.apply(
-                lambda row: self._get_mortality_label(
-                    row,
-                    patient_data.patients.iloc[row.name],
-                    patient_data.encounters.iloc[row.name],
-                ),
-                axis=1,
+            records.extend(self._report_stages())
+        self._log_stages(records)
+
+    def _tasks(
+        self,
+        chunksize: Optional[int],
+        num_shards: Optional[int],
+        options: Dict[str, Any],
+        budget: Optional[ChunkBudget],
+    ) -> Tuple[Iterable[Tuple[str, Tuple[Any, ...]]], int]:
+        """Get the tasks of the chunks or shards of a run, and count its patients.
+
+        Returns
+        -------
+        Tuple[Iterable[Tuple[str, Tuple[Any, ...]]], int]
+            The method and arguments of each task, in round order, and the number
+            of patients.
+
+        """
+        tasks: Iterable[Tuple[str, Tuple[Any, ...]]]
+        if num_shards is None:
+            num_patients = self._count_patients()
+            chunks = self._read_chunks(chunksize)
+            if budget is not None:
+                # The chunks are split lazily, with the estimate of the rounds
+                # observed meanwhile.
+                chunks = budget.chunks(chunks, self._count_events)
+            tasks = (
+                ("_run_chunks", ([dataframes], round_number, options, budget))
+                for round_number, dataframes in enumerate(chunks)
             )
-            combined_events = combined_events[
-                ~combined_events["patient_id"].isin(self.after_death_events)
+        else:
+            shard_patients = self._partition_inputs(num_shards)
+            num_patients = sum(shard_patients)
+            # A shard has at most one round per patient with a memory budget.
+            shard_rounds = [
+                count
+                if budget is not None
+                else math.ceil(count / (chunksize or max(count, 1)))
+                for count in shard_patients
             ]
-            combined_events = combined_events.apply(
-                lambda row: self._truncate_or_pad(row, pad_events=pad_events),
-                axis=1,
+            first_rounds = np.cumsum(shard_rounds) - shard_rounds
+            tasks = [
+                ("_run_shard", (shard, int(first_round), chunksize, options, budget))
+                for shard, first_round in enumerate(first_rounds)
+                if shard_rounds[shard] > 0
+            ]
+        return tasks, num_patients
+
+    def _reset_fingerprints(self, options: Dict[str, Any]) -> None:
+        """Remove the fingerprints of a previous run, and save the options."""
+        for name in os.listdir(self.fingerprint_dir):
+            os.remove(os.path.join(self.fingerprint_dir, name))
+        with open(os.path.join(self.fingerprint_dir, "options.json"), "w") as f:
+            json.dump(options, f)
+
+    def _vocab_fingerprint(self) -> Optional[str]:
+        """Get the fingerprint of the vocabulary encoding the tokens, if any."""
+        if self.concept_encoder is None:
+            return None
+        return self.concept_encoder.fingerprint
+
+    def _partition_inputs(self, num_shards: int) -> List[int]:
+        """Partition the data files into shards, and count their patients."""
+        self.stage_timer.round_number = None
+        with self.stage_timer.stage("partition", 0) as record:
+            shard_patients = partition_inputs(
+                self.data_dir,
+                INPUT_FILES,
+                self.input_format,
+                self.shard_dir,
+                num_shards,
             )
-            # get condition label for common and rare conditions
-            combined_events = combined_events.apply(
-                lambda row: self._get_condition_label(
-                    row,
-                    patient_data.conditions.iloc[row.name],
-                ),
-                axis=1,
+            record["rows_out"] = sum(shard_patients)
+        return shard_patients
+
+    def _report_stages(
+        self,
+        records: Optional[List[Dict[str, Any]]] = None,
+    ) -> List[Dict[str, Any]]:
+        """Append stage records to the run report, by default those of the timer."""
+        if records is None:
+            records = self.stage_timer.pop_records()
+        write_report(self.report_path, records)
+        return records
+
+    def _log_stages(self, records: List[Dict[str, Any]]) -> None:
+        """Log the total time, output rows and peak memory growth of each stage."""
+        for name, totals in summarize(records).items():
+            rate = totals["rows_out"] / totals["seconds"] if totals["seconds"] else 0
+            LOGGER.info(
+                f"Stage {name}: {totals['seconds']:.2f} s, "
+                f"{totals['rows_out']:.0f} rows, {rate:.0f} rows/s, "
+                f"peak RSS +{totals['peak_rss_delta'] / 2**20:.1f} MiB."
             )
-            # drop rows with nan values for events if any
-            combined_events = combined_events.dropna(
-                subset=[f"event_tokens_{self.max_seq_length}"],
+
+    def _compact_sequences(
+        self,
+        row_group_size: int,
+        compression: str,
+        num_partitions: Optional[int],
+    ) -> None:
+        """Stream the files of the rounds into one output per directory.
+
+        Parameters
+        ----------
+        row_group_size : int
+            Number of sequences per row group.
+        compression : str
+            Compression codec.
+        num_partitions : Optional[int]
+            Number of partitions of a dataset, or None for a single file.
+
+        """
+        self.stage_timer.round_number = None
+        for directory, stem in self.sequence_saver.stems().items():
+            paths = self.sequence_saver.saved_paths(directory)
+            if not paths:
+                continue
+            if num_partitions is None:
+                output_path = f"{stem}.parquet"
+            else:
+                output_path = stem
+                if os.path.exists(output_path):
+                    shutil.rmtree(output_path)
+            with self.stage_timer.stage("compact", len(paths)):
+                compact_sequences(
+                    paths,
+                    output_path,
+                    row_group_size,
+                    compression,
+                    num_partitions,
+                )
+            for path in paths:
+                os.remove(path)
+
+    def _update_round(
+        self,
+        round_number: int,
+        dataframes: List[pd.DataFrame],
+        removed_ids: Set[str],
+        options: Dict[str, Any],
+    ) -> None:
+        """Replace the sequences of some patients in the files of a round.
+
+        Parameters
+        ----------
+        round_number : int
+            The round of the files.
+        dataframes : List[pd.DataFrame]
+            The input rows of the patients of the round to recompute.
+        removed_ids : Set[str]
+            The IDs of the patients of the round removed from the inputs.
+        options : Dict[str, Any]
+            The options of ``create_patient_sequence``.
+
+        """
+        self.stage_timer.round_number = round_number
+        fingerprints = fingerprint_rows(dataframes)
+        patient_ids = dataframes[0]["patient_id"].astype(str)
+        replaced_ids = removed_ids.union(patient_ids)
+        # The sequences are merged in the files of the round, not written.
+        combined_events = (
+            self._chunk_sequences(dataframes, round_number, ("write",), **options)
+            if len(patient_ids) > 0
+            else pd.DataFrame()
+        )
+        with self.stage_timer.stage("write", len(combined_events)):
+            self.sequence_saver.update_sequences(
+                combined_events,
+                round_number,
+                replaced_ids,
             )
-            # save the combined events
-            combined_events_all = combined_events.loc[
-                :, combined_events.columns.intersection(self.get_all_column_names)
-            ]
-            combined_events_max = combined_events.loc[
-                :, combined_events.columns.intersection(self.get_max_column_names)
+        previous = pd.read_parquet(fingerprint_path(self.fingerprint_dir, round_number))
+        previous = previous[~previous["patient_id"].isin(replaced_ids)]
+        write_fingerprints(
+            self.fingerprint_dir,
+            round_number,
+            pd.concat([previous["patient_id"], patient_ids], ignore_index=True),
+            np.concatenate([previous["fingerprint"].to_numpy(), fingerprints]),
+        )
+
+    def update_patient_sequences(
+        self,
+        chunksize: Optional[int] = None,
+        num_shards: Optional[int] = None,
+    ) -> Dict[str, int]:
+        """Update the saved sequences after a change of the data files.
+
+        The fingerprints of the input rows of the patients, saved with their
+        sequences, are compared with those of the data files. Only the patients
+        whose rows changed are recomputed, and only the files of the rounds of
+        the recomputed and removed patients are rewritten. New patients are
+        saved in new rounds. The options of the last ``create_patient_sequence``
+        are used.
+
+        Parameters
+        ----------
+        chunksize : Optional[int], optional
+            Number of patients per chunk read and per new round, by default None
+            which processes all the patients as one chunk
+        num_shards : Optional[int], optional
+            Number of shards of patients, by default None which reads the data
+            files in lockstep, as in ``create_patient_sequence``
+
+        Returns
+        -------
+        Dict[str, int]
+            The number of patients skipped, recomputed, added and removed.
+
+        """
+        with open(os.path.join(self.fingerprint_dir, "options.json")) as f:
+            options = json.load(f)
+        output_layout = options.pop("output_layout", "rounds")
+        if output_layout != "rounds":
+            raise ValueError(
+                f"Only the rounds layout can be updated, the sequences were saved "
+                f"with the {output_layout} layout.",
+            )
+        if options.pop("vocab_fingerprint", None) != self._vocab_fingerprint():
+            raise ValueError(
+                "The vocabulary encoding the tokens differs from the one of the "
+                "saved sequences.",
+            )
+        previous = read_fingerprints(self.fingerprint_dir)
+        previous_fingerprints = dict(
+            zip(previous["patient_id"], previous["fingerprint"].tolist()),
+        )
+        previous_rounds = dict(zip(previous["patient_id"], previous["round"]))
+
+        # Keep the input rows of the new and changed patients.
+        if num_shards is None:
+            chunks = self._read_chunks(chunksize)
+        else:
+            shard_patients = self._partition_inputs(num_shards)
+            chunks = chain.from_iterable(
+                read_shard(
+                    self.shard_dir,
+                    shard,
+                    INPUT_FILES,
+                    self.input_format,
+                    chunksize,
+                )
+                for shard, count in enumerate(shard_patients)
+                if count > 0
+            )
+        changed_rows: List[List[pd.DataFrame]] = []
+        patient_ids: Set[str] = set()
+        for dataframes in chunks:
+            ids = dataframes[0]["patient_id"].astype(str)
+            patient_ids.update(ids)
+            changed = [
+                previous_fingerprints.get(patient_id) != fingerprint
+                for patient_id, fingerprint in zip(
+                    ids,
+                    fingerprint_rows(dataframes).tolist(),
+                )
             ]
+            if any(changed):
+                changed_rows.append(
+                    [frame[changed].reset_index(drop=True) for frame in dataframes],
+                )
+        if num_shards is not None:
+            shutil.rmtree(self.shard_dir)
+        removed = previous[~previous["patient_id"].isin(patient_ids)]
 
-            combined_events_all.to_parquet(
-                self.all_dir + f"/patient_sequences_{rounds}.parquet",
-                engine="pyarrow",
+        changed_frames = [
+            pd.concat(frames, ignore_index=True) for frames in zip(*changed_rows)
+        ]
+        changed_ids = (
+            changed_frames[0]["patient_id"].astype(str)
+            if changed_frames
+            else pd.Series(dtype=str)
+        )
+        rounds = changed_ids.map(previous_rounds).fillna(-1).astype(int).to_numpy()
+        for round_number in sorted(set(rounds[rounds >= 0]) | set(removed["round"])):
+            in_round = rounds == round_number
+            self._update_round(
+                round_number,
+                [frame[in_round].reset_index(drop=True) for frame in changed_frames],
+                set(removed.loc[removed["round"] == round_number, "patient_id"]),
+                options,
             )
-            combined_events_max.to_parquet(
-                self.max_dir
-                + f"/patient_sequences_{self.max_seq_length}_{rounds}.parquet",
-                engine="pyarrow",
+
+        added = [frame[rounds < 0].reset_index(drop=True) for frame in changed_frames]
+        num_added = int((rounds < 0).sum())
+        next_round = int(previous["round"].max()) + 1 if len(previous) else 0
+        size = chunksize or max(num_added, 1)
+        for i, start in enumerate(range(0, num_added, size)):
+            self._create_chunk_sequences(
+                [
+                    frame.iloc[start : start + size].reset_index(drop=True)
+                    for frame in added
+                ],
+                next_round + i,
+                **options,
             )
-            round_time = time.time() - start_time
-            rounds += 1
-            LOGGER.info(
-                f"Round {rounds} done in {round_time:.2f} s, {chunksize * rounds} samples done."
+
+        counts = {
+            "skipped": len(patient_ids) - len(changed_ids),
+            "recomputed": int((rounds >= 0).sum()),
+            "added": num_added,
+            "removed": len(removed),
+        }
+        LOGGER.info(
+            f"Updated sequences: {counts['skipped']} patients skipped, "
+            f"{counts['recomputed']} recomputed, {counts['added']} added and "
+            f"{counts['removed']} removed."
+        )
+        self._log_stages(self._report_stages())
+        return counts
+
+    def _truncate_table(
+        self,
+        table: pa.Table,
+        max_length: int,
+        pad_events: bool = False,
+    ) -> pa.Table:
+        """Truncate a table of sequences to the columns of a max length."""
+        truncated = truncate_table(table, max_length, self.token_config, pad_events)
+        if self.concept_encoder is not None:
+            truncated = truncated.append_column(
+                f"concept_ids_{max_length}",
+                self.concept_encoder.encode_array(
+                    truncated.column(f"event_tokens_{max_length}"),
+                    max_length,
+                ),
+            ).append_column(
+                "vocab_fingerprint",
+                pa.array([self.concept_encoder.fingerprint] * truncated.num_rows),
             )
+        # The pandas index of the sequences is kept with them.
+        return truncated.select(
+            [
+                name
+                for name in self.sequence_saver.max_column_names(max_length)
+                if name in truncated.column_names
+            ]
+            + [
+                name
+                for name in truncated.column_names
+                if name.startswith("__index_level_")
+            ],
+        )
 
     def reapply_truncation(
         self,
@@ -810,6 +1408,10 @@ class PatientSequenceGenerator:
         """
         Reapply truncation to Parquet file(s).
 
+        The files are streamed one row group at a time, and their token list
+        columns are truncated to each max sequence length on the Arrow arrays,
+        and encoded with the vocabulary of ``vocab_path`` if it is set.
+
         Parameters
         ----------
         file_paths : Union[str, List[str]]
@@ -821,19 +1423,30 @@ class PatientSequenceGenerator:
         if isinstance(file_paths, str):
             file_paths = [file_paths]
         for i, file_path in enumerate(sorted(file_paths)):
-            df = pd.read_parquet(file_path)
-            df = df.apply(
-                lambda row: self._truncate_or_pad(row, pad_events=pad_events),
-                axis=1,
-            )
-            df = df[self.get_max_column_names]
-            base_name = f"patient_sequences_{self.max_seq_length}"
+            parquet_file = pq.ParquetFile(file_path)
             suffix = f"_{i}" if len(file_paths) > 1 else ""
-            file_name = f"{base_name}{suffix}.parquet"
-            df.to_parquet(
-                os.path.join(self.max_dir, file_name),
-                engine="pyarrow",
-            )
+            writers: Dict[int, pq.ParquetWriter] = {}
+            try:
+                for row_group in range(max(parquet_file.num_row_groups, 1)):
+                    table = (
+                        parquet_file.read_row_group(row_group)
+                        if parquet_file.num_row_groups
+                        else parquet_file.read()
+                    )
+                    for max_length, max_dir in self.max_dirs.items():
+                        truncated = self._truncate_table(table, max_length, pad_events)
+                        if max_length not in writers:
+                            writers[max_length] = pq.ParquetWriter(
+                                os.path.join(
+                                    max_dir,
+                                    f"patient_sequences_{max_length}{suffix}.parquet",
+                                ),
+                                truncated.schema,
+                            )
+                        writers[max_length].write_table(truncated)
+            finally:
+                for writer in writers.values():
+                    writer.close()
 
 
 if __name__ == "__main__":
@@ -847,4 +1460,6 @@ if __name__ == "__main__":
         chunksize=10,
         min_events=10,
         min_visits=0,
+        num_workers=os.cpu_count() or 1,
+        output_layout="file",
     )
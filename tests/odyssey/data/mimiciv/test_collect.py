@@ -1,16 +1,328 @@
 """Test FHIRDataCollector."""
 
+import copy
+import filecmp
+import json
+import logging
+import multiprocessing
 import os
+import random
 import shutil
+import signal
+import threading
+import time
+import tracemalloc
+from ast import literal_eval
+from pkgutil import resolve_name
+from typing import Any, Callable, Dict, List, Optional
 from unittest import TestCase
+from unittest.mock import patch
 
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import JSON, Column, MetaData, String, Table, create_engine
+
+from odyssey.data.io import parquet_files, parse_literal
 from odyssey.data.mimiciv.collect import (
     DATA_COLLECTION_CONFIG,
+    LAB,
     PATIENT,
     FHIRDataCollector,
+    parse_conditions,
+    parse_encounters,
+    parse_lab_events,
+    parse_medication_requests,
+    parse_patient,
+    parse_procedures,
 )
 
 
+LOGGER = logging.getLogger(__name__)
+
+
+NUM_PATIENTS = 6
+PARSERS = {
+    "encounter": parse_encounters,
+    "procedure": parse_procedures,
+    "medication_request": parse_medication_requests,
+    "observation_labevents": parse_lab_events,
+    "condition": parse_conditions,
+}
+
+
+def _patient_id(i: int) -> str:
+    """Return a UUID-like patient ID."""
+    return f"00000000-0000-0000-0000-{i:012d}"
+
+
+def _reference(resource_type: str, resource_id: str) -> Dict[str, str]:
+    """Return a FHIR reference."""
+    return {"reference": f"{resource_type}/{resource_id}"}
+
+
+def _fhir_resources(
+    num_patients: int = NUM_PATIENTS,
+) -> Dict[str, List[Dict[str, Any]]]:
+    """Create fixture FHIR resources for a few patients, keyed by table name."""
+    tables: Dict[str, List[Dict[str, Any]]] = {
+        "patient": [],
+        "encounter": [],
+        "procedure": [],
+        "medication_request": [],
+        "medication": [],
+        "observation_labevents": [],
+        "condition": [],
+    }
+    for code in ["1001", "1002", "abc"]:
+        tables["medication"].append(
+            {
+                "resourceType": "Medication",
+                "id": f"med-{code}",
+                "code": {"coding": [{"code": code}]},
+            },
+        )
+    # Insert in reverse order so that the table order differs from patient order.
+    for i in reversed(range(num_patients)):
+        patient_id = _patient_id(i)
+        patient = {
+            "resourceType": "Patient",
+            "id": patient_id,
+            "gender": "female" if i % 2 else "male",
+            "birthDate": f"20{i}0-01-01",
+        }
+        if i == 2:
+            patient["deceasedDateTime"] = "2155-03-04"
+        tables["patient"].append(patient)
+        # The last patient has no encounters.
+        if i == NUM_PATIENTS - 1:
+            continue
+        subject = _reference("Patient", patient_id)
+        for j in range(i % 3 + 1):
+            encounter_id = f"enc-{i}-{j}"
+            encounter_ref = _reference("Encounter", encounter_id)
+            tables["encounter"].append(
+                {
+                    "resourceType": "Encounter",
+                    "id": encounter_id,
+                    "status": "finished",
+                    "class": {"code": "IMP"},
+                    "subject": subject,
+                    "period": {
+                        "start": f"215{j}-01-0{i + 1}T10:00:00-04:00",
+                        "end": f"215{j}-01-1{i}T16:30:00-04:00",
+                    },
+                },
+            )
+            procedure = {
+                "resourceType": "Procedure",
+                "id": f"proc-{i}-{j}",
+                "status": "completed",
+                "subject": subject,
+                "encounter": encounter_ref,
+                "code": {"coding": [{"code": f"P{i}{j}"}]},
+            }
+            if j % 2:
+                procedure["performedPeriod"] = {
+                    "start": f"215{j}-01-0{i + 2}T12:00:00-04:00",
+                }
+            else:
+                procedure["performedDateTime"] = f"215{j}-01-0{i + 2}T11:00:00Z"
+            tables["procedure"].append(procedure)
+            for k, medication_code in enumerate(["1001", "1002", "abc"]):
+                tables["medication_request"].append(
+                    {
+                        "resourceType": "MedicationRequest",
+                        "id": f"medreq-{i}-{j}-{k}",
+                        "status": "completed",
+                        "intent": "order",
+                        "subject": subject,
+                        "encounter": encounter_ref,
+                        "authoredOn": f"215{j}-01-0{i + 3}T09:15:00-04:00",
+                        "medicationReference": _reference(
+                            "Medication",
+                            f"med-{medication_code}",
+                        ),
+                    },
+                )
+            tables["medication_request"].append(
+                {
+                    "resourceType": "MedicationRequest",
+                    "id": f"medreq-{i}-{j}-text",
+                    "status": "completed",
+                    "intent": "order",
+                    "subject": subject,
+                    "encounter": encounter_ref,
+                    "authoredOn": f"215{j}-01-0{i + 3}T09:15:00-04:00",
+                    "medicationCodeableConcept": {"text": "free text"},
+                },
+            )
+            # Patient 3 has no lab events.
+            lab_events = (
+                []
+                if i == 3
+                else [
+                    ("50912", "mg/dL"),
+                    ("51221", "%"),
+                    ("50971", f"unit{i % 2}"),
+                ]
+            )
+            for k, (lab_code, unit) in enumerate(lab_events):
+                tables["observation_labevents"].append(
+                    {
+                        "resourceType": "Observation",
+                        "id": f"lab-{i}-{j}-{k}",
+                        "status": "final",
+                        "subject": subject,
+                        "encounter": encounter_ref,
+                        "code": {"coding": [{"code": lab_code}]},
+                        "effectiveDateTime": f"215{j}-01-0{i + 2}T0{k}:00:00-04:00",
+                        "valueQuantity": {"value": i * 1.5 + j + k, "unit": unit},
+                    },
+                )
+            tables["condition"].append(
+                {
+                    "resourceType": "Condition",
+                    "id": f"cond-{i}-{j}",
+                    "subject": subject,
+                    "encounter": encounter_ref,
+                    "code": {
+                        "coding": [
+                            {
+                                "code": f"I{i % 2}{j}",
+                                "display": "Condition",
+                                "system": "http://fhir.mimic.mit.edu/CodeSystem/"
+                                "mimic-diagnosis-icd10",
+                            },
+                        ],
+                    },
+                },
+            )
+    return tables
+
+
+def create_fhir_database(db_path: str, num_patients: int = NUM_PATIENTS) -> None:
+    """Create a SQLite stand-in of the FHIR database loaded with fixture rows."""
+    engine = create_engine(db_path)
+    metadata = MetaData()
+    rows = {}
+    for table_name, resources in _fhir_resources(num_patients).items():
+        # As in MIMIC-IV, the patient table has no patient_id column.
+        columns = [Column("id", String, primary_key=True), Column("fhir", JSON)]
+        if table_name != "patient":
+            columns.insert(1, Column("patient_id", String))
+        table = Table(table_name, metadata, *columns)
+        rows[table] = []
+        for resource in resources:
+            row = {"id": resource["id"], "fhir": resource}
+            if table_name != "patient":
+                row["patient_id"] = (
+                    resource["subject"]["reference"].split("/")[-1]
+                    if "subject" in resource
+                    else None
+                )
+            rows[table].append(row)
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        for table, table_rows in rows.items():
+            connection.execute(table.insert(), table_rows)
+    engine.dispose()
+
+
+def create_patient_table(db_path: str, num_patients: int, name_size: int) -> None:
+    """Create a SQLite patient table of large resources for memory benchmarks."""
+    engine = create_engine(db_path)
+    metadata = MetaData()
+    table = Table(
+        "patient",
+        metadata,
+        Column("id", String, primary_key=True),
+        Column("fhir", JSON),
+    )
+    metadata.create_all(engine)
+    rows = []
+    for i in range(num_patients):
+        patient_id = _patient_id(i)
+        patient = {
+            "resourceType": "Patient",
+            "id": patient_id,
+            "gender": "female" if i % 2 else "male",
+            "birthDate": "2100-01-01",
+            "name": [{"family": "x" * name_size}],
+        }
+        rows.append({"id": patient_id, "fhir": patient})
+    with engine.begin() as connection:
+        connection.execute(table.insert(), rows)
+    engine.dispose()
+
+
+def _peak_memory(func: Callable[[], Any]) -> int:
+    """Return the peak memory allocated by a function, in bytes."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def write_filtered_labs(collector: FHIRDataCollector, num_patients: int) -> None:
+    """Write random filtered labs and their vocabulary for a collector."""
+    rng = random.Random(0)
+    rows = []
+    for i in range(num_patients):
+        codes = [
+            rng.choice(["50912", "50971", "51221"]) for _ in range(rng.randint(0, 20))
+        ]
+        # One code has few distinct values, so that some of its bins are dropped.
+        values = [
+            rng.choice([1.0, 2.0]) if code == "51221" else round(rng.gauss(5, 3), 1)
+            for code in codes
+        ]
+        rows.append(
+            {
+                "patient_id": str(i),
+                "length": len(codes),
+                "lab_codes": codes,
+                "lab_values": values,
+                "lab_units": ["mg/dL"] * len(codes),
+                "lab_dates": ["2150-01-01T10:00:00-04:00"] * len(codes),
+                "encounter_ids": ["enc-0"] * len(codes),
+            },
+        )
+    collector.write_data(
+        pd.DataFrame(rows),
+        "filtered_labs.csv",
+        DATA_COLLECTION_CONFIG[LAB]["schema"],
+    )
+    with open(os.path.join(collector.vocab_dir, "lab_vocab.json"), "w") as f:
+        json.dump(["50912", "50971", "51221"], f)
+
+
+def _killed_at(func: Callable[..., Any], kill_at: int) -> Callable[..., Any]:
+    """Wrap a function to kill the process at its ``kill_at``-th call."""
+    calls = []
+
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        calls.append(None)
+        if len(calls) == kill_at:
+            os.kill(os.getpid(), signal.SIGKILL)
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def run_extraction(collector: FHIRDataCollector) -> None:
+    """Run all the extraction stages of the collector."""
+    collector.get_patient_data()
+    collector.get_encounter_data()
+    collector.get_procedure_data()
+    collector.get_medication_data()
+    collector.get_lab_data()
+    collector.get_condition_data()
+
+
 class TestFHIRDataCollector(TestCase):
     """Test FHIRDataCollector."""
 
@@ -23,12 +335,30 @@ class TestFHIRDataCollector(TestCase):
             save_dir=self.save_dir,
             buffer_size=10,
         )
+        self.db_path = f"sqlite:///{self.save_dir}/fhir.db"
+        create_fhir_database(self.db_path)
 
     def tearDown(self) -> None:
         """Tear down FHIRDataCollector."""
         if os.path.exists(self.save_dir):
             shutil.rmtree(self.save_dir)
 
+    def _sqlite_collector(
+        self,
+        name: str,
+        buffer_size: int = 2,
+        db_path: Optional[str] = None,
+        **kwargs: Any,
+    ) -> FHIRDataCollector:
+        """Create a collector reading from the SQLite stand-in."""
+        return FHIRDataCollector(
+            db_path=db_path or self.db_path,
+            schema=None,
+            save_dir=os.path.join(self.save_dir, name),
+            buffer_size=buffer_size,
+            **kwargs,
+        )
+
     def test_save_to_csv(self):
         """Test save_to_csv."""
         buffer = []
@@ -52,3 +382,383 @@ class TestFHIRDataCollector(TestCase):
             )
         self.assertTrue(os.path.exists(save_path))
         self.assertEqual(len(buffer), 5)
+
+    def _assert_same_csv_files(
+        self,
+        expected: FHIRDataCollector,
+        actual: FHIRDataCollector,
+    ) -> None:
+        """Assert that two collectors wrote byte-identical csv files."""
+        names = sorted(os.listdir(expected.csv_dir))
+        self.assertEqual(names, sorted(os.listdir(actual.csv_dir)))
+        for name in names:
+            self.assertTrue(
+                filecmp.cmp(
+                    os.path.join(expected.csv_dir, name),
+                    os.path.join(actual.csv_dir, name),
+                    shallow=False,
+                ),
+                name,
+            )
+
+    def test_bulk_extraction(self):
+        """Test that bulk extraction writes the same files as per-patient queries."""
+        per_patient = self._sqlite_collector("per_patient")
+        bulk = self._sqlite_collector("bulk", bulk=True)
+        run_extraction(per_patient)
+        run_extraction(bulk)
+        self._assert_same_csv_files(per_patient, bulk)
+
+    def test_patient_table(self):
+        """Test that the patient table, without a patient_id column, is read."""
+        for bulk in [False, True]:
+            collector = self._sqlite_collector(f"patients_{bulk}", bulk=bulk)
+            self.assertNotIn("patient_id", collector.get_table("patient").c)
+            collector.get_patient_data()
+            patients = collector.read_data(DATA_COLLECTION_CONFIG[PATIENT]["save_path"])
+            self.assertEqual(
+                patients["patient_id"].tolist(),
+                [_patient_id(i) for i in range(NUM_PATIENTS)],
+            )
+
+    def test_parallel_parsing(self):
+        """Test that parsing with a process pool writes the same files."""
+        serial = self._sqlite_collector("serial")
+        run_extraction(serial)
+        with self._sqlite_collector("parallel", num_workers=2) as parallel:
+            run_extraction(parallel)
+        self._assert_same_csv_files(serial, parallel)
+
+    def test_concurrent_run(self):
+        """Test that independent stages run concurrently and write the same files."""
+        serial = self._sqlite_collector("serial")
+        serial.run()
+        # Both stages have to reach the barrier at the same time to go on.
+        barrier = threading.Barrier(2, timeout=30)
+
+        def wait_for(stage: Callable[..., None]) -> Callable[..., None]:
+            def wrapper(*args: Any, **kwargs: Any) -> None:
+                barrier.wait()
+                stage(*args, **kwargs)
+
+            return wrapper
+
+        with patch.object(
+            FHIRDataCollector,
+            "get_procedure_data",
+            wait_for(FHIRDataCollector.get_procedure_data),
+        ), patch.object(
+            FHIRDataCollector,
+            "get_condition_data",
+            wait_for(FHIRDataCollector.get_condition_data),
+        ), self._sqlite_collector(
+            "concurrent",
+            num_workers=2,
+            max_connections=4,
+        ) as concurrent:
+            concurrent.run(max_concurrency=4)
+        self._assert_same_csv_files(serial, concurrent)
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(concurrent.vocab_dir, "condition_categories.json"),
+            ),
+        )
+
+    def test_connection_reuse(self):
+        """Test that tables are reflected once and a single connection is used."""
+        with self._sqlite_collector("stats") as collector:
+            run_extraction(collector)
+            self.assertEqual(collector.stats["reflections"], 7)
+            self.assertEqual(collector.stats["connections"], 1)
+        self.assertEqual(collector._connections, [])
+
+    def test_medication_codes_cache(self):
+        """Test that medications are fetched with one query and cached."""
+        collector = self._sqlite_collector("medication")
+        collector.get_patient_data()
+        collector.get_encounter_data()
+        queries = collector.stats["queries"]
+        collector.get_medication_data(use_cache=True)
+        # One query per patient plus one for the medication codes.
+        self.assertEqual(collector.stats["queries"] - queries, NUM_PATIENTS)
+        self.assertTrue(
+            os.path.exists(os.path.join(collector.vocab_dir, "medication_codes.json")),
+        )
+        queries = collector.stats["queries"]
+        self.assertEqual(
+            collector.get_medication_codes(use_cache=True),
+            {"med-1001": "1001", "med-1002": "1002", "med-abc": "abc"},
+        )
+        self.assertEqual(collector.stats["queries"], queries)
+
+    def test_fast_parsing(self):
+        """Test that the raw JSON extractors match the FHIR models."""
+        tables = _fhir_resources()
+        # Dates that the models normalize or reject, and missing fields.
+        lab = copy.deepcopy(tables["observation_labevents"][0])
+        tables["observation_labevents"].extend(
+            [
+                {**lab, "effectiveDateTime": "2150-01-01T10:00:00+00:00"},
+                {**lab, "effectiveDateTime": "2150-01-01T10:00:00.5-04:00"},
+                {**lab, "effectiveDateTime": "2152-02-29T10:00:00-04:00"},
+                {**lab, "effectiveDateTime": "2150-02"},
+                {**lab, "valueQuantity": {"value": 7, "unit": "mg/dL"}},
+                {**lab, "valueQuantity": {"unit": "mg/dL"}},
+                {**lab, "encounter": None},
+            ],
+        )
+        for resource in tables["patient"]:
+            self.assertEqual(
+                parse_patient(resource, fast=True),
+                parse_patient(resource),
+            )
+        for table_name, parser in PARSERS.items():
+            resources = tables[table_name]
+            self.assertEqual(
+                parser(resources, fast=True),
+                parser(resources),
+                table_name,
+            )
+        fast = self._sqlite_collector("fast", fast_parsing=True)
+        model = self._sqlite_collector("model")
+        run_extraction(fast)
+        run_extraction(model)
+        self._assert_same_csv_files(model, fast)
+
+    def test_parquet_output(self):
+        """Test that parquet files hold the same data as csv files."""
+        csv = self._sqlite_collector("csv")
+        parquet = self._sqlite_collector("parquet", output_format="parquet")
+        for collector in [csv, parquet]:
+            run_extraction(collector)
+            collector.filter_lab_data()
+            collector.process_lab_values(num_bins=3)
+        for name in sorted(os.listdir(csv.csv_dir)):
+            expected = pd.read_csv(os.path.join(csv.csv_dir, name))
+            actual = parquet.read_data(name)
+            self.assertEqual(list(expected.columns), list(actual.columns), name)
+            for column in expected.columns:
+                if actual[column].map(lambda x: isinstance(x, (list, dict))).any():
+                    expected[column] = expected[column].map(literal_eval)
+                values = expected[column].astype(object)
+                self.assertEqual(
+                    values.where(values.notna(), None).tolist(),
+                    actual[column].tolist(),
+                    f"{name}: {column}",
+                )
+        parts = parquet_files(parquet.data_path("labs.csv"))
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(
+            pq.read_schema(parts[0]).field("lab_values").type,
+            pa.list_(pa.float64()),
+        )
+        with self.assertRaises(ValueError):
+            self._sqlite_collector("json", output_format="json")
+
+    def _assert_same_data(
+        self,
+        expected: FHIRDataCollector,
+        actual: FHIRDataCollector,
+    ) -> None:
+        """Assert that two collectors saved the same data and vocabularies."""
+        if expected.output_format == "csv":
+            self._assert_same_csv_files(expected, actual)
+        else:
+            for name in DATA_COLLECTION_CONFIG.values():
+                pd.testing.assert_frame_equal(
+                    expected.read_data(name["save_path"]),
+                    actual.read_data(name["save_path"]),
+                )
+        names = sorted(os.listdir(expected.vocab_dir))
+        self.assertEqual(names, sorted(os.listdir(actual.vocab_dir)))
+        for name in names:
+            with open(os.path.join(expected.vocab_dir, name), "r") as f:
+                expected_vocab = json.load(f)
+            with open(os.path.join(actual.vocab_dir, name), "r") as f:
+                actual_vocab = json.load(f)
+            if isinstance(expected_vocab, list):
+                expected_vocab, actual_vocab = (
+                    sorted(expected_vocab),
+                    sorted(actual_vocab),
+                )
+            self.assertEqual(expected_vocab, actual_vocab, name)
+
+    def _kill_extraction(
+        self,
+        name: str,
+        target: str,
+        kill_at: int,
+        **kwargs: Any,
+    ) -> None:
+        """Run the extraction in a process killed at a call of a function."""
+
+        def extract() -> None:
+            with patch(target, new=_killed_at(resolve_name(target), kill_at)):
+                run_extraction(self._sqlite_collector(name, **kwargs))
+
+        process = multiprocessing.get_context("fork").Process(target=extract)
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, -signal.SIGKILL)
+
+    def test_resume_after_kill(self):
+        """Test that extraction killed midway resumes to the output of a clean run."""
+        kill_points = {
+            # Killed while parsing the labs of the third patient.
+            "odyssey.data.mimiciv.collect.parse_lab_events": 3,
+            # Killed after writing a buffer, before committing it.
+            "odyssey.data.mimiciv._manifest.StageCheckpoint.commit": 6,
+        }
+        for output_format in ["csv", "parquet"]:
+            clean = self._sqlite_collector(
+                f"clean_{output_format}",
+                output_format=output_format,
+            )
+            run_extraction(clean)
+            for i, (target, kill_at) in enumerate(kill_points.items()):
+                with self.subTest(output_format=output_format, target=target):
+                    name = f"resumed_{output_format}_{i}"
+                    self._kill_extraction(
+                        name,
+                        target,
+                        kill_at,
+                        output_format=output_format,
+                    )
+                    resumed = self._sqlite_collector(name, output_format=output_format)
+                    stages = resumed.manifest.stages.values()
+                    self.assertFalse(all(stage["done"] for stage in stages))
+                    run_extraction(resumed)
+                    self._assert_same_data(clean, resumed)
+            # A stage whose output was removed is extracted again.
+            labs_path = resumed.data_path("labs.csv")
+            if os.path.isdir(labs_path):
+                shutil.rmtree(labs_path)
+            else:
+                os.remove(labs_path)
+            resumed = self._sqlite_collector(name, output_format=output_format)
+            run_extraction(resumed)
+            self._assert_same_data(clean, resumed)
+
+    def test_incremental_extraction(self):
+        """Test that a new run only extracts the patients added since the last one."""
+        clean = self._sqlite_collector("clean")
+        run_extraction(clean)
+        db_path = f"sqlite:///{self.save_dir}/fhir_old.db"
+        create_fhir_database(db_path, num_patients=NUM_PATIENTS - 2)
+        with self._sqlite_collector("incremental", db_path=db_path) as collector:
+            run_extraction(collector)
+        with self._sqlite_collector("incremental") as collector:
+            run_extraction(collector)
+            # The patient table, the medication codes, and the two new patients
+            # for the encounters and the new inpatient for the other stages.
+            self.assertEqual(collector.stats["queries"], 8)
+        self._assert_same_data(clean, collector)
+        with self._sqlite_collector("incremental", resume=False) as collector:
+            run_extraction(collector)
+            # Every patient is fetched again, the last one has no encounters.
+            self.assertEqual(collector.stats["queries"], 28)
+        self._assert_same_data(clean, collector)
+        # The progress of the csv files is not resumed in another format.
+        clean = self._sqlite_collector("clean_parquet", output_format="parquet")
+        run_extraction(clean)
+        with self._sqlite_collector(
+            "incremental",
+            output_format="parquet",
+        ) as collector:
+            run_extraction(collector)
+            self.assertEqual(collector.stats["queries"], 28)
+        self._assert_same_data(clean, collector)
+
+    def test_process_lab_values(self):
+        """Test quantile binning against a per-code scan of every value."""
+        collector = self._sqlite_collector("labs")
+        write_filtered_labs(collector, 200)
+        collector.process_lab_values(num_bins=5)
+        labs = collector.read_data("processed_labs.csv")
+        for col in ["lab_codes", "lab_values", "binned_values"]:
+            labs[col] = labs[col].map(literal_eval)
+        for code in ["50912", "50971", "51221"]:
+            all_values = [
+                value
+                for values, codes in zip(labs["lab_values"], labs["lab_codes"])
+                for value, value_code in zip(values, codes)
+                if value_code == code
+            ]
+            edges = pd.qcut(all_values, q=5, duplicates="drop").categories.right
+            for values, codes, binned in zip(
+                labs["lab_values"],
+                labs["lab_codes"],
+                labs["binned_values"],
+            ):
+                for value, value_code, bin_index in zip(values, codes, binned):
+                    if value_code == code:
+                        self.assertEqual(
+                            bin_index,
+                            np.digitize(value, edges, right=False),
+                        )
+
+    def test_process_lab_values_sketch(self):
+        """Test that sketched quantile bins agree with exact bins."""
+        for output_format in ["csv", "parquet"]:
+            exact = self._sqlite_collector(
+                f"exact_{output_format}",
+                output_format=output_format,
+            )
+            sketch = self._sqlite_collector(
+                f"sketch_{output_format}",
+                output_format=output_format,
+                buffer_size=16,
+            )
+            for collector in [exact, sketch]:
+                write_filtered_labs(collector, 200)
+            exact.process_lab_values(num_bins=5)
+            sketch.process_lab_values(num_bins=5, sketch=True, relative_accuracy=0.001)
+            expected = exact.read_data("processed_labs.csv")
+            actual = sketch.read_data("processed_labs.csv")
+            self.assertEqual(len(expected), len(actual))
+            expected_bins = np.concatenate(
+                expected["binned_values"].map(parse_literal).tolist(),
+            )
+            actual_bins = np.concatenate(
+                actual["binned_values"].map(parse_literal).tolist(),
+            )
+            self.assertGreater(np.mean(expected_bins == actual_bins), 0.99)
+            pd.testing.assert_frame_equal(
+                expected.drop(columns="binned_values"),
+                actual.drop(columns="binned_values"),
+            )
+
+    def test_streaming_memory_benchmark(self):
+        """Test that the peak memory of the patient stage is bounded by the buffer."""
+        db_path = f"sqlite:///{self.save_dir}/patients.db"
+        create_patient_table(db_path, num_patients=4000, name_size=2000)
+        collector = self._sqlite_collector(
+            "streaming",
+            buffer_size=100,
+            db_path=db_path,
+            fast_parsing=True,
+        )
+        table_memory = _peak_memory(lambda: list(collector.execute_query("patient")))
+        stage_memory = _peak_memory(collector.get_patient_data)
+        LOGGER.info(
+            f"Peak memory of {stage_memory / 1e6:.1f} MB to extract the patients, "
+            f"{table_memory / 1e6:.1f} MB to hold the table",
+        )
+        self.assertEqual(len(collector.read_data("patients.csv")), 4000)
+        self.assertLess(stage_memory, table_memory / 5)
+
+    def test_fast_parsing_benchmark(self):
+        """Report the resources parsed per second with and without the models."""
+        tables = _fhir_resources()
+        for table_name, parser in PARSERS.items():
+            resources = tables[table_name] * 50
+            rates = {}
+            for fast in [False, True]:
+                start = time.perf_counter()
+                parser(resources, fast=fast)
+                rates[fast] = len(resources) / (time.perf_counter() - start)
+            LOGGER.info(
+                f"{table_name}: {rates[False]:.0f} resources/s with the models, "
+                f"{rates[True]:.0f} resources/s from the raw JSON",
+            )
+            self.assertGreater(rates[True], 0)
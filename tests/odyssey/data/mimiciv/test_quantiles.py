@@ -0,0 +1,65 @@
+"""Test the quantile bins of lab values."""
+
+from unittest import TestCase
+
+import numpy as np
+
+from odyssey.data.mimiciv._quantiles import (
+    QuantileSketch,
+    assign_bins,
+    quantile_bin_edges,
+)
+
+
+class TestQuantileSketch(TestCase):
+    """Test QuantileSketch."""
+
+    def setUp(self) -> None:
+        """Create values with negatives, zeros and missing values."""
+        rng = np.random.default_rng(0)
+        self.values = np.concatenate(
+            [
+                rng.normal(0, 5, 2000),
+                np.zeros(20),
+                rng.lognormal(2, 1, 2000),
+                [np.nan] * 5,
+            ],
+        )
+        self.levels = np.linspace(0, 1, 21)
+
+    def test_relative_accuracy(self):
+        """Test that quantiles are within the relative accuracy."""
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        sketch.update(self.values)
+        exact = np.nanquantile(self.values, self.levels)
+        np.testing.assert_allclose(sketch.quantiles(self.levels), exact, rtol=0.01)
+        self.assertEqual(sketch.count, 4020)
+
+    def test_merge(self):
+        """Test that merged sketches of chunks equal the sketch of all values."""
+        expected = QuantileSketch()
+        expected.update(self.values)
+        merged = QuantileSketch()
+        for chunk in np.array_split(self.values, 7):
+            sketch = QuantileSketch()
+            sketch.update(chunk)
+            merged.merge(sketch)
+        np.testing.assert_array_equal(
+            merged.quantiles(self.levels),
+            expected.quantiles(self.levels),
+        )
+        with self.assertRaises(ValueError):
+            merged.merge(QuantileSketch(relative_accuracy=0.05))
+
+    def test_bin_edges(self):
+        """Test that sketched bins agree with exact bins for most values."""
+        sketch = QuantileSketch(relative_accuracy=0.001)
+        sketch.update(self.values)
+        values = self.values[~np.isnan(self.values)]
+        exact = assign_bins(values, quantile_bin_edges(values, 5))
+        sketched = assign_bins(values, sketch.bin_edges(5))
+        self.assertGreater(np.mean(exact == sketched), 0.99)
+        self.assertEqual(
+            assign_bins(np.array([0.5, 1.0, 2.5]), np.array([1.0, 2.0])).tolist(),
+            np.digitize([0.5, 1.0, 2.5], [1.0, 2.0], right=False).tolist(),
+        )
@@ -0,0 +1,45 @@
+"""Test ChunkBudget."""
+
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from odyssey.data.seq._budget import ChunkBudget, count_items
+
+
+class TestChunkBudget(TestCase):
+    """Test ChunkBudget."""
+
+    def test_count_items(self):
+        """Test that lists and their string literals are counted."""
+        counts = count_items(["['a', 'b', 'c']", "[]", None, np.nan, ["a"], []])
+        self.assertEqual(counts.tolist(), [3, 0, 0, 0, 1, 0])
+
+    def test_split(self):
+        """Test that chunks fill the budget, with at least one patient."""
+        budget = ChunkBudget(10, bytes_per_event=1)
+        self.assertEqual(budget.split(np.array([3, 4, 1, 20, 0, 0])), [2, 3, 4, 6])
+        self.assertEqual(budget.split(np.array([], dtype=int)), [])
+
+    def test_observe(self):
+        """Test that the estimate is the ratio of all the observed rounds."""
+        budget = ChunkBudget(10)
+        self.assertEqual(budget.observe(10, 300), 30)
+        self.assertEqual(budget.observe(30, 500), 500 / 30)
+        self.assertEqual(budget.bytes_per_event, 20)
+        with self.assertRaises(ValueError):
+            ChunkBudget(0)
+
+    def test_chunks(self):
+        """Test that the patients left in a block are carried to the next one."""
+        budget = ChunkBudget(6, bytes_per_event=1)
+        blocks = [
+            [pd.DataFrame({"events": [1, 1, 4]})],
+            [pd.DataFrame({"events": [0, 2]})],
+        ]
+        chunks = budget.chunks(blocks, lambda block: block[0]["events"].to_numpy())
+        self.assertEqual(
+            [chunk[0]["events"].tolist() for chunk in chunks],
+            [[1, 1], [4, 0], [2]],
+        )
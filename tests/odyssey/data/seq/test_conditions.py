@@ -0,0 +1,97 @@
+"""Test ConditionIndex."""
+
+import json
+import logging
+import os
+import random
+import shutil
+import time
+from typing import Dict, List
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from odyssey.data.seq._conditions import ConditionIndex
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def label_codes(json_dir: str, codes: List[str]) -> Dict[str, List[int]]:
+    """Flag the condition groups of some codes, reading the groups each time."""
+    labels = {}
+    for name in ["common", "rare"]:
+        with open(os.path.join(json_dir, f"{name}_conditions.json")) as f:
+            groups = json.load(f)
+        labels[f"{name}_conditions"] = [
+            int(bool(set(group_codes).intersection(codes)))
+            for group_codes in groups.values()
+        ]
+    return labels
+
+
+class TestConditionIndex(TestCase):
+    """Test ConditionIndex."""
+
+    def setUp(self) -> None:
+        """Write condition groups, more than 64 of them sharing some codes."""
+        self.json_dir = "./_conditions_data"
+        os.makedirs(self.json_dir, exist_ok=True)
+        self.rng = random.Random(0)
+        self.codes = [f"C{i:03d}" for i in range(300)]
+        for name, num_groups in [("common", 150), ("rare", 20)]:
+            groups = {
+                f"{name}-{i}": self.rng.sample(self.codes, self.rng.randint(1, 5))
+                for i in range(num_groups)
+            }
+            with open(os.path.join(self.json_dir, f"{name}_conditions.json"), "w") as f:
+                json.dump(groups, f)
+        self.index = ConditionIndex(self.json_dir)
+
+    def tearDown(self) -> None:
+        """Remove the condition groups."""
+        shutil.rmtree(self.json_dir)
+
+    def _patients(self, num_patients: int) -> List[List[str]]:
+        """Draw the condition codes of patients, some of them in no group."""
+        return [
+            self.rng.sample(self.codes + ["OTHER1", "OTHER2"], self.rng.randint(0, 8))
+            for _ in range(num_patients)
+        ]
+
+    def test_label_codes(self):
+        """Test that the codes get the labels of their groups."""
+        for codes in self._patients(200):
+            self.assertEqual(
+                self.index.label_codes(codes),
+                label_codes(self.json_dir, codes),
+            )
+
+    def test_label_rows(self):
+        """Test that the labels of a chunk are those of each patient."""
+        patients = self._patients(200)
+        rows = np.repeat(np.arange(len(patients)), [len(codes) for codes in patients])
+        codes = np.array([code for codes in patients for code in codes], dtype=object)
+        labels = self.index.label_rows(rows, codes, len(patients))
+        for i, patient_codes in enumerate(patients):
+            for name, flags in self.index.label_codes(patient_codes).items():
+                self.assertEqual(labels[name][i].tolist(), flags)
+
+    def test_label_benchmark(self):
+        """Test that the groups are read once, and not for every patient."""
+        patients = self._patients(300)
+        start = time.perf_counter()
+        expected = [label_codes(self.json_dir, codes) for codes in patients]
+        reading = time.perf_counter() - start
+        with patch("builtins.open", wraps=open) as opened:
+            start = time.perf_counter()
+            labels = [self.index.label_codes(codes) for codes in patients]
+            compiled = time.perf_counter() - start
+        LOGGER.info(
+            f"300 patients: {reading:.3f} s reading the groups, "
+            f"{compiled:.3f} s with the compiled index",
+        )
+        # The index is compiled on first use, from one file per group kind.
+        self.assertEqual(opened.call_count, 2)
+        self.assertEqual(labels, expected)
@@ -0,0 +1,194 @@
+"""Test EventProcessor."""
+
+import logging
+import os
+import random
+import shutil
+import time
+from itertools import chain
+from typing import Any
+from unittest import TestCase
+
+import pandas as pd
+from test_generator import _date, make_cohort, write_cohort
+
+from odyssey.data.constants import LAB, MED, PROC
+from odyssey.data.io import parse_literal
+from odyssey.data.seq._data_containers import EventData, PatientData
+from odyssey.data.seq._encounters import EncounterProcessor
+from odyssey.data.seq._events import EventProcessor
+from odyssey.data.seq._timestamps import EpochIndex
+from odyssey.data.seq._tokens import TokenConfig
+from odyssey.data.seq.generator import PatientSequenceGenerator
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_patient(num_encounters: int, num_events: int, seed: int = 0) -> tuple:
+    """Create the encounter and procedure rows of a patient with long stays."""
+    rng = random.Random(seed)
+    encounter_row = pd.Series(
+        {
+            "encounter_ids": [f"encounter-{i}" for i in range(num_encounters)],
+            "starts": [_date(10 * i) for i in range(num_encounters)],
+            "ends": [_date(10 * i + 5) for i in range(num_encounters)],
+        },
+    )
+    encounters = [rng.randrange(num_encounters) for _ in range(num_events)]
+    row = pd.Series(
+        {
+            "length": num_events,
+            "encounter_ids": [f"encounter-{i}" for i in encounters],
+            "proc_codes": ["0DTJ4ZZ"] * num_events,
+            "proc_dates": [_date(10 * i, rng.randint(-6, 130)) for i in encounters],
+        },
+    )
+    encounter_row = EncounterProcessor().index_encounters(encounter_row)
+    epochs = EpochIndex(
+        chain(encounter_row["starts"], encounter_row["ends"], row["proc_dates"]),
+    )
+    return row, encounter_row, epochs
+
+
+def sort_events(patient_data: PatientData, i: int) -> list:
+    """Sort the events of a patient by date string and encounter order."""
+    events = []
+    for event_type in [PROC, MED, LAB]:
+        row = patient_data.events[event_type].data.iloc[i]
+        codes = [code.upper() for code in row[f"{event_type}_codes"]]
+        if event_type == LAB:
+            codes = [
+                f"{code}_{value}" for code, value in zip(codes, row["binned_values"])
+            ]
+        type_id = TokenConfig().token_type_mapping[event_type]
+        events.extend(
+            (date, code, encounter_id, type_id)
+            for date, code, encounter_id in zip(
+                row[f"{event_type}_dates"],
+                codes,
+                row["encounter_ids"],
+            )
+        )
+    encounter_ids = patient_data.encounters.iloc[i]["encounter_ids"]
+    encounter_order = {encounter: j for j, encounter in enumerate(encounter_ids)}
+    return sorted(events, key=lambda event: (event[0], encounter_order[event[2]]))
+
+
+class CountingDict(dict):
+    """Dictionary counting the lookups of its keys."""
+
+    lookups = 0
+
+    def __getitem__(self, key: Any) -> Any:
+        """Count the lookup and get the value of a key."""
+        self.lookups += 1
+        return super().__getitem__(key)
+
+
+class CountingList(list):
+    """List counting the linear searches of its items."""
+
+    searches = 0
+
+    def index(self, *args: Any) -> int:
+        """Count the search and get the position of an item."""
+        self.searches += 1
+        return super().index(*args)
+
+
+class TestEventProcessor(TestCase):
+    """Test EventProcessor."""
+
+    def setUp(self) -> None:
+        """Set up the event processor."""
+        self.processor = EventProcessor(TokenConfig())
+
+    def _process(self, row: pd.Series, encounter_row: pd.Series, epochs) -> float:
+        """Run the event stages using the encounter index, and time them."""
+        start = time.perf_counter()
+        row = self.processor.edit_event_datetimes(row, encounter_row, PROC, epochs)
+        self.processor.calculate_time_after_admission(row, encounter_row, epochs)
+        return time.perf_counter() - start
+
+    def test_edit_event_datetimes(self):
+        """Test that the events are clipped to their encounter."""
+        row, encounter_row, epochs = make_patient(20, 200)
+        dates = list(row["proc_dates"])
+        row = self.processor.edit_event_datetimes(
+            row.copy(),
+            encounter_row,
+            PROC,
+            epochs,
+        )
+        row = self.processor.calculate_time_after_admission(row, encounter_row, epochs)
+        for encounter_id, date, edited, elapsed in zip(
+            row["encounter_ids"],
+            dates,
+            row["proc_dates"],
+            row["elapsed_time"],
+        ):
+            i = encounter_row["encounter_ids"].index(encounter_id)
+            start = encounter_row["starts"][i]
+            end = encounter_row["ends"][i]
+            expected = min(max(epochs.utc(date), epochs.utc(start)), epochs.utc(end))
+            self.assertEqual(epochs.utc(edited), expected)
+            self.assertEqual(elapsed, round((expected - epochs.utc(start)) / 3600, 2))
+
+    def test_combine_events(self):
+        """Test that the events of a chunk are sorted as the patient lists."""
+        save_dir = "./_events_data"
+        self.addCleanup(shutil.rmtree, save_dir, ignore_errors=True)
+        data_dir = os.path.join(save_dir, "data_files")
+        write_cohort(make_cohort(30), data_dir, os.path.join(save_dir, "json"))
+        generator = PatientSequenceGenerator(
+            max_seq_length=32,
+            data_dir=data_dir,
+            save_dir=save_dir,
+        )
+        patients, encounters, procedures, medications, labs, conditions = next(
+            generator._read_chunks(),
+        )
+        patient_data = PatientData(
+            patients=patients,
+            encounters=encounters,
+            conditions=conditions,
+            events={
+                PROC: EventData(event_type=PROC, data=procedures),
+                MED: EventData(event_type=MED, data=medications),
+                LAB: EventData(event_type=LAB, data=labs),
+            },
+        )
+        patient_data = generator._normalize_timestamps(patient_data)
+        patient_data = generator._process_encounters(patient_data)
+        patient_data = generator._process_events(patient_data)
+        patient_data.conditions["encounter_conditions"] = patient_data.conditions[
+            "encounter_conditions"
+        ].map(parse_literal)
+        expected = [sort_events(patient_data, i) for i in range(len(procedures))]
+        combined = self.processor.combine_events(patient_data)
+        for i, events in enumerate(expected):
+            self.assertEqual(combined.at[i, "length"], len(events))
+            for j, name in enumerate(
+                ["proc_dates", "proc_codes", "encounter_ids", "type_ids"],
+            ):
+                self.assertEqual(
+                    combined.at[i, name],
+                    [event[j] for event in events],
+                )
+
+    def test_encounter_lookups(self):
+        """Test that the event stages scale with the events, not the encounters."""
+        for num_encounters in [5, 500]:
+            row, encounter_row, epochs = make_patient(num_encounters, 20000)
+            encounter_row["encounter_ids"] = CountingList(
+                encounter_row["encounter_ids"],
+            )
+            encounter_row["encounter_index"] = CountingDict(
+                encounter_row["encounter_index"],
+            )
+            duration = self._process(row, encounter_row, epochs)
+            LOGGER.info(f"{num_encounters} encounters, 20000 events: {duration:.3f} s")
+            # One hashed lookup per event and stage, and no search of the list.
+            self.assertEqual(encounter_row["encounter_index"].lookups, 2 * 20000)
+            self.assertEqual(encounter_row["encounter_ids"].searches, 0)
@@ -0,0 +1,679 @@
+"""Test PatientSequenceGenerator."""
+
+import json
+import logging
+import os
+import random
+import shutil
+import time
+from typing import Any, Dict, List
+from unittest import TestCase
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from odyssey.data.mimiciv.collect import (
+    CONDITION,
+    DATA_COLLECTION_CONFIG,
+    ENCOUNTER,
+    LAB,
+    MEDICATION,
+    PATIENT,
+    PROCEDURE,
+)
+from odyssey.data.seq._pipeline import ChunkBatch, Stage
+from odyssey.data.seq.generator import PatientSequenceGenerator
+
+
+LOGGER = logging.getLogger(__name__)
+NUM_PATIENTS = 12
+MAX_SEQ_LENGTH = 32
+COMMON_CONDITIONS = {"hypertension": ["I10"], "diabetes": ["E119", "E118"]}
+RARE_CONDITIONS = {"sepsis": ["A419"]}
+PROCESSED_LAB_SCHEMA = DATA_COLLECTION_CONFIG[LAB]["schema"].append(
+    pa.field("binned_values", pa.list_(pa.int64())),
+)
+# Intermediate files read by the generator, with the schema of their rows.
+COHORT_FILES = {
+    "inpatient": DATA_COLLECTION_CONFIG[PATIENT]["schema"],
+    "encounters": DATA_COLLECTION_CONFIG[ENCOUNTER]["schema"],
+    "procedures": DATA_COLLECTION_CONFIG[PROCEDURE]["schema"],
+    "med_requests": DATA_COLLECTION_CONFIG[MEDICATION]["schema"],
+    "processed_labs": PROCESSED_LAB_SCHEMA,
+    "conditions": DATA_COLLECTION_CONFIG[CONDITION]["schema"],
+}
+
+
+def _date(day: int, hour: int = 0, offset: str = "-04:00") -> str:
+    """Return an ISO datetime ``day`` days after 2150-01-01."""
+    timestamp = pd.Timestamp("2150-01-01") + pd.Timedelta(days=day, hours=hour)
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S") + offset
+
+
+def _events(
+    rng: random.Random,
+    encounters: List[Dict[str, Any]],
+    codes: List[str],
+) -> Dict[str, List[Any]]:
+    """Create events of one type, some of them outside their encounter."""
+    events: Dict[str, List[Any]] = {"codes": [], "dates": [], "encounter_ids": []}
+    for encounter in encounters:
+        for _ in range(rng.randint(0, 3)):
+            events["codes"].append(rng.choice(codes))
+            hour = rng.randint(-6, 24 * encounter["days"] + 6)
+            events["dates"].append(
+                _date(encounter["day"], hour, offset=encounter["offset"]),
+            )
+            events["encounter_ids"].append(encounter["id"])
+    return events
+
+
+def make_cohort(num_patients: int, seed: int = 0) -> Dict[str, List[Dict]]:
+    """Create a synthetic cohort of collected patient data, keyed by file name.
+
+    Rows of every file are aligned by patient, as written by FHIRDataCollector.
+    Encounters are unsorted and some of them overlap or have no events.
+
+    """
+    rng = random.Random(seed)
+    cohort: Dict[str, List[Dict]] = {name: [] for name in COHORT_FILES}
+    for i in range(num_patients):
+        patient_id = f"patient-{i}"
+        encounters = []
+        day = rng.randint(0, 30)
+        for j in range(rng.randint(1, 5)):
+            encounters.append(
+                {
+                    "id": f"encounter-{i}-{j}",
+                    "day": day,
+                    "days": rng.randint(0, 4),
+                    "offset": rng.choice(["-04:00", "-05:00"]),
+                },
+            )
+            # At most one pair of overlapping encounters per patient.
+            day += -1 if j == 0 and i % 3 == 0 else rng.choice([8, 20, 90, 400])
+        rng.shuffle(encounters)
+        deceased = i % 4 == 1
+        cohort["inpatient"].append(
+            {
+                "patient_id": patient_id,
+                "birthDate": f"{2080 + i}-0{1 + i % 9}-15",
+                "gender": rng.choice(["male", "female"]),
+                "deceasedBoolean": None,
+                "deceasedDateTime": _date(day + 30)[:10] if deceased else None,
+            },
+        )
+        cohort["encounters"].append(
+            {
+                "patient_id": patient_id,
+                "length": len(encounters),
+                "encounter_ids": [e["id"] for e in encounters],
+                "starts": [_date(e["day"], offset=e["offset"]) for e in encounters],
+                "ends": [
+                    _date(e["day"] + e["days"], 12, offset=e["offset"])
+                    for e in encounters
+                ],
+            },
+        )
+        procedures = _events(rng, encounters, ["0DTJ4ZZ", "5A1955Z", "02HV33Z"])
+        cohort["procedures"].append(
+            {
+                "patient_id": patient_id,
+                "length": len(procedures["codes"]),
+                "proc_codes": procedures["codes"],
+                "proc_dates": procedures["dates"],
+                "encounter_ids": procedures["encounter_ids"],
+            },
+        )
+        medications = _events(rng, encounters, ["1001", "1002", "1003"])
+        cohort["med_requests"].append(
+            {
+                "patient_id": patient_id,
+                "length": len(medications["codes"]),
+                "med_codes": medications["codes"],
+                "med_dates": medications["dates"],
+                "encounter_ids": medications["encounter_ids"],
+            },
+        )
+        labs = _events(rng, encounters, ["50912", "50971", "51221"])
+        cohort["processed_labs"].append(
+            {
+                "patient_id": patient_id,
+                "length": len(labs["codes"]),
+                "lab_codes": labs["codes"],
+                "lab_values": [round(rng.uniform(0, 10), 1) for _ in labs["codes"]],
+                "lab_units": ["mg/dL" for _ in labs["codes"]],
+                "lab_dates": labs["dates"],
+                "encounter_ids": labs["encounter_ids"],
+                "binned_values": [rng.randint(0, 2) for _ in labs["codes"]],
+            },
+        )
+        encounter_conditions = {
+            e["id"]: rng.sample(["I10", "E119", "A419", "J189"], rng.randint(1, 2))
+            for e in encounters
+            if rng.random() < 0.7
+        }
+        cohort["conditions"].append(
+            {
+                "patient_id": patient_id,
+                "length": sum(len(codes) for codes in encounter_conditions.values()),
+                "encounter_conditions": encounter_conditions,
+            },
+        )
+    return cohort
+
+
+def write_cohort(
+    cohort: Dict[str, List[Dict]],
+    data_dir: str,
+    json_dir: str,
+    output_format: str = "csv",
+) -> None:
+    """Write a cohort and its condition groups as the collector would."""
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(json_dir, exist_ok=True)
+    for name, rows in cohort.items():
+        path = os.path.join(data_dir, f"{name}.{output_format}")
+        if output_format == "parquet":
+            pq.write_table(
+                pa.Table.from_pylist(rows, schema=COHORT_FILES[name]),
+                path,
+            )
+        else:
+            pd.DataFrame(rows, columns=COHORT_FILES[name].names).to_csv(
+                path,
+                index=False,
+            )
+    with open(os.path.join(json_dir, "common_conditions.json"), "w") as f:
+        json.dump(COMMON_CONDITIONS, f)
+    with open(os.path.join(json_dir, "rare_conditions.json"), "w") as f:
+        json.dump(RARE_CONDITIONS, f)
+
+
+def read_sequences(save_dir: str) -> pd.DataFrame:
+    """Read the sequences saved by a generator, with lists as native lists."""
+    sequences = pd.read_parquet(save_dir)
+    for column in sequences.columns:
+        sequences[column] = [
+            value.tolist() if hasattr(value, "tolist") else value
+            for value in sequences[column]
+        ]
+    return sequences
+
+
+def read_patient_sequences(save_dir: str) -> pd.DataFrame:
+    """Read the sequences of all the files of a directory, sorted by patient."""
+    sequences = pd.concat(
+        [read_sequences(os.path.join(save_dir, name)) for name in os.listdir(save_dir)],
+        ignore_index=True,
+    )
+    sequences = sequences.sort_values("patient_id", ignore_index=True)
+    return sequences.sort_index(axis=1)
+
+
+def label_long_sequences(batch: ChunkBatch) -> ChunkBatch:
+    """Flag the sequences longer than the max sequence length."""
+    batch.sequences["long_sequence"] = (
+        batch.sequences["token_length"] > MAX_SEQ_LENGTH
+    ).astype(int)
+    return batch
+
+
+def assert_same_sequences(test: TestCase, expected_dir: str, actual_dir: str) -> None:
+    """Assert that two generators saved the same sequences in the same files."""
+    test.assertEqual(sorted(os.listdir(expected_dir)), sorted(os.listdir(actual_dir)))
+    for name in os.listdir(expected_dir):
+        expected = read_sequences(os.path.join(expected_dir, name))
+        actual = read_sequences(os.path.join(actual_dir, name))
+        pd.testing.assert_frame_equal(
+            expected.sort_index(axis=1),
+            actual.sort_index(axis=1),
+        )
+
+
+class TestPatientSequenceGenerator(TestCase):
+    """Test PatientSequenceGenerator."""
+
+    def setUp(self) -> None:
+        """Set up the synthetic cohort."""
+        self.save_dir = "./_seq_data"
+        self.json_dir = os.path.join(self.save_dir, "json_files")
+        self.cohort = make_cohort(NUM_PATIENTS)
+
+    def tearDown(self) -> None:
+        """Remove the generated files."""
+        if os.path.exists(self.save_dir):
+            shutil.rmtree(self.save_dir)
+
+    def _generator(self, name: str, **kwargs: Any) -> PatientSequenceGenerator:
+        """Create a generator reading the cohort written in its input format."""
+        data_dir = os.path.join(self.save_dir, name, "data_files")
+        write_cohort(
+            self.cohort,
+            data_dir,
+            self.json_dir,
+            kwargs.get("input_format", "csv"),
+        )
+        kwargs.setdefault("max_seq_length", MAX_SEQ_LENGTH)
+        return PatientSequenceGenerator(
+            data_dir=data_dir,
+            json_dir=self.json_dir,
+            save_dir=os.path.join(self.save_dir, name, "sequences"),
+            **kwargs,
+        )
+
+    def test_parquet_input(self):
+        """Test that parquet input files give the same sequences as csv files."""
+        csv = self._generator("csv")
+        parquet = self._generator("parquet", input_format="parquet")
+        csv.create_patient_sequence(chunksize=5)
+        parquet.create_patient_sequence(chunksize=5)
+        for directory in ["all", str(MAX_SEQ_LENGTH)]:
+            expected = read_sequences(os.path.join(csv.all_dir, "..", directory))
+            actual = read_sequences(os.path.join(parquet.all_dir, "..", directory))
+            self.assertGreater(len(expected), 0)
+            self.assertTrue(expected["deceased"].any())
+            pd.testing.assert_frame_equal(expected, actual)
+
+    def test_invalid_input_format(self):
+        """Test that an unknown input format is rejected."""
+        with self.assertRaises(ValueError):
+            PatientSequenceGenerator(
+                max_seq_length=MAX_SEQ_LENGTH,
+                save_dir=self.save_dir,
+                input_format="json",
+            )
+
+    def test_columnar_engine(self):
+        """Test that the columnar engine creates the same sequences."""
+        for input_format in ["csv", "parquet"]:
+            for kwargs in [{}, {"min_events": 4, "pad_events": True}]:
+                row = self._generator(f"row_{input_format}", input_format=input_format)
+                columnar = self._generator(
+                    f"columnar_{input_format}",
+                    input_format=input_format,
+                    engine="columnar",
+                )
+                row.create_patient_sequence(chunksize=5, **kwargs)
+                columnar.create_patient_sequence(chunksize=5, **kwargs)
+                for directory in ["all", str(MAX_SEQ_LENGTH)]:
+                    assert_same_sequences(
+                        self,
+                        os.path.join(row.all_dir, "..", directory),
+                        os.path.join(columnar.all_dir, "..", directory),
+                    )
+                shutil.rmtree(self.save_dir)
+
+    def test_columnar_engine_benchmark(self):
+        """Test the engines on a larger cohort, logging their throughput."""
+        self.cohort = make_cohort(200, seed=1)
+        for engine in ["row", "columnar"]:
+            generator = self._generator(engine, engine=engine)
+            start = time.perf_counter()
+            generator.create_patient_sequence(chunksize=100)
+            duration = time.perf_counter() - start
+            LOGGER.info(f"{engine} engine: {200 / duration:.0f} patients/s")
+        assert_same_sequences(
+            self,
+            os.path.join(self.save_dir, "row", "sequences", "all"),
+            os.path.join(self.save_dir, "columnar", "sequences", "all"),
+        )
+
+    def test_invalid_engine(self):
+        """Test that an unknown engine is rejected."""
+        with self.assertRaises(ValueError):
+            PatientSequenceGenerator(
+                max_seq_length=MAX_SEQ_LENGTH,
+                save_dir=self.save_dir,
+                engine="vectorized",
+            )
+
+    def test_max_seq_lengths(self):
+        """Test that several lengths give the sequences of one length each."""
+        lengths = [MAX_SEQ_LENGTH, 16, 64]
+        for engine in ["row", "columnar"]:
+            generator = self._generator(
+                f"lengths_{engine}",
+                max_seq_length=lengths,
+                engine=engine,
+            )
+            self.assertEqual(generator.max_seq_length, MAX_SEQ_LENGTH)
+            generator.create_patient_sequence(chunksize=5, pad_events=True)
+            for max_length in lengths:
+                expected = self._generator(
+                    f"length_{engine}_{max_length}",
+                    max_seq_length=max_length,
+                    engine=engine,
+                )
+                expected.create_patient_sequence(chunksize=5, pad_events=True)
+                for directory in ["all", str(max_length)]:
+                    assert_same_sequences(
+                        self,
+                        os.path.join(expected.all_dir, "..", directory),
+                        os.path.join(generator.all_dir, "..", directory),
+                    )
+        with self.assertRaises(ValueError):
+            self._generator("duplicate_lengths", max_seq_length=[16, 16])
+
+    def test_reapply_truncation(self):
+        """Test that truncating saved sequences again gives the same sequences."""
+        lengths = [MAX_SEQ_LENGTH, 16]
+        for pad_events in [False, True]:
+            expected = self._generator("expected", max_seq_length=lengths)
+            expected.create_patient_sequence(chunksize=5, pad_events=pad_events)
+            # Sequences larger than memory are read by row groups.
+            all_path = os.path.join(self.save_dir, "all.parquet")
+            read_patient_sequences(expected.all_dir).to_parquet(
+                all_path,
+                row_group_size=5,
+            )
+            self.assertGreater(pq.ParquetFile(all_path).num_row_groups, 1)
+            generator = self._generator("reapplied", max_seq_length=lengths[::-1])
+            generator.reapply_truncation(all_path, pad_events=pad_events)
+            for max_length in lengths:
+                pd.testing.assert_frame_equal(
+                    read_patient_sequences(expected.max_dirs[max_length]),
+                    read_patient_sequences(generator.max_dirs[max_length]),
+                    check_dtype=False,
+                )
+            shutil.rmtree(self.save_dir)
+
+    def test_concept_ids(self):
+        """Test that the truncated event tokens are encoded with a vocabulary."""
+        lengths = [MAX_SEQ_LENGTH, 16]
+        plain = self._generator("plain")
+        plain.create_patient_sequence()
+        tokens = sorted(
+            set().union(*read_patient_sequences(plain.all_dir)["event_tokens"]),
+        )
+        # Some tokens are left out of the vocabulary, as unknown tokens.
+        vocab = {token: i for i, token in enumerate(["[PAD]", "[UNK]"] + tokens[::2])}
+        vocab_path = os.path.join(self.save_dir, "tokenizer.json")
+        with open(vocab_path, "w") as f:
+            json.dump(
+                {
+                    "pad_token": "[PAD]",
+                    "unknown_token": "[UNK]",
+                    "tokenizer_vocab": vocab,
+                },
+                f,
+            )
+        generator = self._generator(
+            "encoded",
+            max_seq_length=lengths,
+            vocab_path=vocab_path,
+        )
+        generator.create_patient_sequence(chunksize=5)
+        for max_length in lengths:
+            max_dir = generator.max_dirs[max_length]
+            column = f"concept_ids_{max_length}"
+            sequences = read_patient_sequences(max_dir)
+            for events, ids in zip(
+                sequences[f"event_tokens_{max_length}"],
+                sequences[column],
+            ):
+                self.assertEqual(
+                    ids,
+                    [vocab.get(token, 1) for token in events]
+                    + [0] * (max_length - len(events)),
+                )
+            self.assertEqual(
+                set(sequences["vocab_fingerprint"]),
+                {generator.concept_encoder.fingerprint},
+            )
+            path = os.path.join(max_dir, os.listdir(max_dir)[0])
+            self.assertEqual(
+                pq.read_schema(path).field(column).type,
+                pa.list_(pa.int32()),
+            )
+
+            # The Arrow truncation encodes the tokens in the same way.
+            all_path = os.path.join(self.save_dir, "all.parquet")
+            read_patient_sequences(generator.all_dir).to_parquet(all_path)
+            reapplied = self._generator(
+                "reapplied",
+                max_seq_length=max_length,
+                vocab_path=vocab_path,
+            )
+            reapplied.reapply_truncation(all_path)
+            pd.testing.assert_frame_equal(
+                sequences,
+                read_patient_sequences(reapplied.max_dir),
+                check_dtype=False,
+            )
+
+        # The sequences are only updated with the same vocabulary.
+        with self.assertRaises(ValueError):
+            self._generator("encoded").update_patient_sequences()
+
+    def test_output_layout(self):
+        """Test that the rounds are streamed into a single file or dataset."""
+        rounds = self._generator("rounds")
+        rounds.create_patient_sequence(chunksize=2)
+        for output_layout in ["file", "dataset"]:
+            generator = self._generator(output_layout)
+            generator.create_patient_sequence(
+                chunksize=2,
+                output_layout=output_layout,
+                row_group_size=5,
+                num_partitions=3,
+            )
+            for directory, stem in generator.sequence_saver.stems().items():
+                expected = read_patient_sequences(
+                    os.path.join(rounds.all_dir, "..", os.path.basename(directory)),
+                )
+                if output_layout == "file":
+                    path = f"{stem}.parquet"
+                    self.assertEqual(os.listdir(directory), [os.path.basename(path)])
+                    row_groups = pq.ParquetFile(path).metadata
+                    self.assertEqual(
+                        [
+                            row_groups.row_group(i).num_rows
+                            for i in range(row_groups.num_row_groups)
+                        ],
+                        [5, 5, len(expected) - 10],
+                    )
+                else:
+                    path = stem
+                    self.assertEqual(
+                        pq.read_metadata(os.path.join(path, "_metadata")).num_rows,
+                        len(expected),
+                    )
+                actual = read_sequences(path).drop(columns="shard", errors="ignore")
+                actual = actual.sort_values("patient_id", ignore_index=True)
+                pd.testing.assert_frame_equal(
+                    expected,
+                    actual.sort_index(axis=1),
+                    check_dtype=False,
+                )
+            with self.assertRaises(ValueError):
+                generator.update_patient_sequences(chunksize=2)
+        with self.assertRaises(ValueError):
+            rounds.create_patient_sequence(output_layout="json")
+
+    def test_run_report(self):
+        """Test that the stages of every round are in the run report."""
+        stages = {
+            "encounters",
+            "events",
+            "combine",
+            "tokens",
+            "mortality",
+            "truncation",
+            "conditions",
+            "write",
+        }
+        for engine in ["row", "columnar"]:
+            generator = self._generator(engine, engine=engine)
+            generator.create_patient_sequence(chunksize=5, num_workers=2)
+            with open(generator.report_path) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual({record["round"] for record in records}, {0, 1, 2})
+            for round_number in range(3):
+                self.assertEqual(
+                    {
+                        record["stage"]
+                        for record in records
+                        if record["round"] == round_number
+                    },
+                    stages,
+                )
+            for record in records:
+                self.assertGreaterEqual(record["seconds"], 0)
+                self.assertGreaterEqual(record["peak_rss_delta"], 0)
+            self.assertEqual(
+                sum(
+                    record["rows_out"]
+                    for record in records
+                    if record["stage"] == "write"
+                ),
+                len(read_patient_sequences(generator.all_dir)),
+            )
+
+    def test_custom_stages(self):
+        """Test that a task label can be added as a stage, and stages skipped."""
+        for engine in ["row", "columnar"]:
+            generator = self._generator(
+                engine,
+                engine=engine,
+                stages=[
+                    Stage(
+                        "long_sequence",
+                        label_long_sequences,
+                        requires=("tokens",),
+                        columns=("long_sequence",),
+                    ),
+                ],
+                skip_stages=["conditions"],
+            )
+            generator.create_patient_sequence(chunksize=5)
+            for directory in [generator.all_dir, generator.max_dir]:
+                sequences = read_patient_sequences(directory)
+                self.assertNotIn("common_conditions", sequences.columns)
+                self.assertEqual(
+                    sequences["long_sequence"].tolist(),
+                    (sequences["token_length"] > MAX_SEQ_LENGTH).astype(int).tolist(),
+                )
+            self.assertIn(1, sequences["long_sequence"].tolist())
+        with self.assertRaises(ValueError):
+            self._generator("invalid", skip_stages=["tokens"])
+
+    def test_num_workers(self):
+        """Test that chunks dispatched to workers give the same files."""
+        for engine in ["row", "columnar"]:
+            serial = self._generator(f"serial_{engine}", engine=engine)
+            parallel = self._generator(f"parallel_{engine}", engine=engine)
+            serial.after_death_events.append("patient-0")
+            parallel.after_death_events.append("patient-0")
+            serial.create_patient_sequence(chunksize=3)
+            parallel.create_patient_sequence(chunksize=3, num_workers=2)
+            self.assertEqual(len(os.listdir(parallel.all_dir)), NUM_PATIENTS // 3)
+            self.assertEqual(serial.after_death_events, parallel.after_death_events)
+            for directory in ["all", str(MAX_SEQ_LENGTH)]:
+                assert_same_sequences(
+                    self,
+                    os.path.join(serial.all_dir, "..", directory),
+                    os.path.join(parallel.all_dir, "..", directory),
+                )
+
+    def test_num_shards(self):
+        """Test that sharded inputs in any order give the same sequences."""
+        expected_generator = self._generator("lockstep")
+        expected_generator.create_patient_sequence(chunksize=5)
+        expected = read_patient_sequences(expected_generator.all_dir)
+        # Remove the conditions of a patient, and shuffle the rows of the files.
+        expected = expected.set_index("patient_id")
+        rng = random.Random(1)
+        for name in list(self.cohort)[1:]:
+            rng.shuffle(self.cohort[name])
+        self.cohort["conditions"] = [
+            row for row in self.cohort["conditions"] if row["patient_id"] != "patient-3"
+        ]
+        self.assertTrue(any(expected.at["patient-3", "common_conditions"]))
+        expected.at["patient-3", "common_conditions"] = [0, 0]
+        expected.at["patient-3", "rare_conditions"] = [0]
+        expected = expected.reset_index().sort_index(axis=1)
+
+        for input_format in ["csv", "parquet"]:
+            for num_workers in [1, 2]:
+                generator = self._generator(
+                    f"sharded_{input_format}_{num_workers}",
+                    input_format=input_format,
+                )
+                generator.create_patient_sequence(
+                    chunksize=2,
+                    num_workers=num_workers,
+                    num_shards=3,
+                )
+                self.assertFalse(os.path.exists(generator.shard_dir))
+                pd.testing.assert_frame_equal(
+                    expected,
+                    read_patient_sequences(generator.all_dir),
+                    check_dtype=False,
+                )
+
+    def test_memory_budget(self):
+        """Test that chunks sized to a memory budget give the same sequences."""
+        expected_generator = self._generator("chunksize")
+        expected_generator.create_patient_sequence(chunksize=5)
+        expected = read_patient_sequences(expected_generator.all_dir)
+        for num_workers, num_shards in [(1, None), (2, None), (1, 2), (2, 2)]:
+            generator = self._generator(f"budget_{num_workers}_{num_shards}")
+            generator.create_patient_sequence(
+                chunksize=4,
+                num_workers=num_workers,
+                num_shards=num_shards,
+                memory_budget=20_000,
+            )
+            # The chunks vary in patients, and get smaller than the blocks read.
+            self.assertGreater(len(os.listdir(generator.all_dir)), NUM_PATIENTS // 4)
+            pd.testing.assert_frame_equal(
+                expected,
+                read_patient_sequences(generator.all_dir),
+                check_dtype=False,
+            )
+        generator.create_patient_sequence(output_layout="file")
+        self.assertEqual(os.listdir(generator.all_dir), ["patient_sequences.parquet"])
+        with self.assertRaises(ValueError):
+            generator.create_patient_sequence(memory_budget=0)
+
+    def test_update_patient_sequences(self):
+        """Test that only the rounds of changed patients are rewritten."""
+        generator = self._generator("update")
+        generator.create_patient_sequence(chunksize=5)
+        paths = [
+            os.path.join(generator.all_dir, f"patient_sequences_{i}.parquet")
+            for i in range(3)
+        ]
+        modified = [os.path.getmtime(path) for path in paths]
+
+        # Change a patient of round 0, remove one of round 1 and add one.
+        self.cohort = make_cohort(NUM_PATIENTS + 1)
+        self.cohort["inpatient"][1]["birthDate"] = "2070-01-01"
+        for rows in self.cohort.values():
+            del rows[7]
+        generator = self._generator("update")
+        counts = generator.update_patient_sequences(chunksize=5)
+        self.assertEqual(
+            counts,
+            {"skipped": 10, "recomputed": 1, "added": 1, "removed": 1},
+        )
+        self.assertNotEqual(os.path.getmtime(paths[0]), modified[0])
+        self.assertNotEqual(os.path.getmtime(paths[1]), modified[1])
+        self.assertEqual(os.path.getmtime(paths[2]), modified[2])
+
+        expected = self._generator("full")
+        expected.create_patient_sequence(chunksize=5)
+        for directory in ["all", str(MAX_SEQ_LENGTH)]:
+            pd.testing.assert_frame_equal(
+                read_patient_sequences(os.path.join(expected.all_dir, "..", directory)),
+                read_patient_sequences(
+                    os.path.join(generator.all_dir, "..", directory)
+                ),
+                check_dtype=False,
+            )
+        self.assertEqual(
+            generator.update_patient_sequences(chunksize=5),
+            {"skipped": 12, "recomputed": 0, "added": 0, "removed": 0},
+        )
@@ -0,0 +1,82 @@
+"""Test StagePipeline."""
+
+from typing import List
+from unittest import TestCase
+
+import pandas as pd
+
+from odyssey.data.seq._data_containers import PatientData
+from odyssey.data.seq._pipeline import ChunkBatch, Stage, StagePipeline
+from odyssey.data.seq._timing import StageTimer
+
+
+def append_stage(name: str, requires: List[str]) -> Stage:
+    """Get a stage appending its name to the state of the batch."""
+
+    def run(batch: ChunkBatch) -> ChunkBatch:
+        batch.state.setdefault("order", []).append(name)
+        return batch
+
+    return Stage(name, run, requires=tuple(requires))
+
+
+class TestStagePipeline(TestCase):
+    """Test StagePipeline."""
+
+    def setUp(self) -> None:
+        """Set up a batch of three patients."""
+        self.batch = ChunkBatch(
+            PatientData(
+                patients=pd.DataFrame({"patient_id": ["a", "b", "c"]}),
+                encounters=pd.DataFrame(),
+                conditions=pd.DataFrame(),
+                events={},
+            ),
+            after_death_events=[],
+        )
+        self.timer = StageTimer()
+
+    def test_order(self):
+        """Test that stages run after their requirements, and otherwise in order."""
+        pipeline = StagePipeline(
+            [
+                append_stage("labels", ["tokens"]),
+                append_stage("combine", []),
+                append_stage("tokens", ["combine"]),
+                append_stage("write", []),
+            ],
+            self.timer,
+        )
+        batch = pipeline.run(self.batch)
+        self.assertEqual(batch.state["order"], ["combine", "tokens", "labels", "write"])
+        self.assertEqual(
+            [(record["stage"], record["rows_out"]) for record in self.timer.records],
+            [("combine", 3), ("tokens", 3), ("labels", 3), ("write", 3)],
+        )
+
+    def test_skip(self):
+        """Test that only the stages that nothing requires can be skipped."""
+        pipeline = StagePipeline(
+            [
+                append_stage("combine", []),
+                append_stage("tokens", ["combine"]),
+                append_stage("labels", ["tokens"]),
+            ],
+            self.timer,
+            skip=["labels"],
+        )
+        self.assertEqual(pipeline.run(self.batch).state["order"], ["combine", "tokens"])
+        with self.assertRaises(ValueError):
+            pipeline.run(self.batch, skip=["combine"])
+        with self.assertRaises(ValueError):
+            pipeline.run(self.batch, skip=["missing"])
+
+    def test_invalid_stages(self):
+        """Test that duplicate, unknown and cyclic requirements are rejected."""
+        for stages in [
+            [append_stage("tokens", []), append_stage("tokens", [])],
+            [append_stage("tokens", ["combine"])],
+            [append_stage("tokens", ["labels"]), append_stage("labels", ["tokens"])],
+        ]:
+            with self.assertRaises(ValueError):
+                StagePipeline(stages, self.timer)
@@ -0,0 +1,100 @@
+"""Test the epoch index of the sequence timestamps."""
+
+import logging
+import time
+from datetime import datetime, timezone
+from itertools import chain
+from unittest import TestCase
+
+from dateutil import parser
+from test_generator import make_cohort
+
+from odyssey.data.constants import LAB, MED, PROC
+from odyssey.data.seq._timestamps import DAY, EpochIndex
+
+
+LOGGER = logging.getLogger(__name__)
+EPOCH = datetime(1970, 1, 1)
+
+
+def _epochs(date: str) -> tuple:
+    """Get the UTC and local epoch seconds of a date string with dateutil."""
+    timestamp = parser.parse(date)
+    local = int((timestamp.replace(tzinfo=None) - EPOCH).total_seconds())
+    if timestamp.tzinfo is None:
+        return local, local
+    utc = int((timestamp - EPOCH.replace(tzinfo=timezone.utc)).total_seconds())
+    return utc, local
+
+
+class TestEpochIndex(TestCase):
+    """Test EpochIndex."""
+
+    def test_epochs(self):
+        """Test that the epochs are those of dateutil."""
+        dates = [
+            "2150-01-01T10:00:00-04:00",
+            "2150-01-01T10:00:00+05:30",
+            "2150-01-01 10:00:00Z",
+            "2150-01-01T10:00",
+            "2150-01-01",
+            "1960-05-03T01:02:03-0500",
+            "Jan 3 2150 10:00",
+        ]
+        epochs = EpochIndex([*dates, None, dates[0]])
+        self.assertEqual(len(epochs), len(dates))
+        self.assertEqual(epochs.num_fallbacks, 1)
+        for date in dates:
+            utc, local = _epochs(date)
+            self.assertEqual(epochs.utc(date), utc)
+            self.assertEqual(epochs.local(date), local)
+            self.assertEqual(epochs.local_day(date), local // DAY)
+
+    def test_empty(self):
+        """Test an index without dates."""
+        self.assertEqual(len(EpochIndex([])), 0)
+
+    def test_parse_benchmark(self):
+        """Report the date parsing calls saved per patient by the index."""
+        cohort = make_cohort(200, seed=2)
+        parse_calls = 0
+        dates = []
+        for i, encounters in enumerate(cohort["encounters"]):
+            events = [
+                cohort[name][i][f"{event_type}_dates"]
+                for name, event_type in [
+                    ("procedures", PROC),
+                    ("med_requests", MED),
+                    ("processed_labs", LAB),
+                ]
+            ]
+            num_events = sum(map(len, events))
+            encounter_ids = {
+                encounter_id
+                for name in ["procedures", "med_requests", "processed_labs"]
+                for encounter_id in cohort[name][i]["encounter_ids"]
+            }
+            num_encounters = len(encounter_ids)
+            # Calls of the processors parsing the dates of the events, of the
+            # encounter times, ages and intervals, and of the mortality label.
+            parse_calls += 5 * num_events + 1 + num_encounters
+            parse_calls += 2 * (num_encounters - 1)
+            if cohort["inpatient"][i]["deceasedDateTime"] is not None:
+                parse_calls += 3
+            dates.extend(chain(encounters["starts"], encounters["ends"], *events))
+
+        start = time.perf_counter()
+        for date in dates:
+            parser.parse(date)
+        dateutil_time = time.perf_counter() - start
+        start = time.perf_counter()
+        epochs = EpochIndex(dates)
+        index_time = time.perf_counter() - start
+        LOGGER.info(
+            f"Date parsing calls per patient: {parse_calls / 200:.1f} with dateutil, "
+            f"{epochs.num_fallbacks / 200:.1f} with the index, which parses "
+            f"{len(epochs) / 200:.1f} distinct dates per patient in "
+            f"{index_time:.3f} s instead of {dateutil_time:.3f} s for one pass.",
+        )
+        self.assertEqual(epochs.num_fallbacks, 0)
+        self.assertLess(len(epochs), parse_calls)